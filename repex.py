@@ -13,20 +13,54 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
+import io
 import os
 import re
 import sys
 import imp
+import bz2
+import copy
+import gzip
+import glob
+import json
 import time
+import mmap
+import errno
+import bisect
+import hashlib
+import select
 import shutil
+import socket
+import struct
 import logging
+import platform
 import difflib
+import functools
+import importlib
+import tempfile
+import threading
+import contextlib
 from datetime import datetime
 
 import yaml
 import click
 import jsonschema
 
+# Modules only used by the async API, archives, xz files, the regex worker,
+# `--low-priority`, `--watch` and the daemon are imported where they are
+# used, as every run, even one forwarded to a daemon, imports this module.
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
 
 ERRORS = {
     'invalid_yaml': '`config` must be a valid repex config in YAML form',
@@ -45,11 +79,45 @@ ERRORS = {
                             'not found',
     'validation_failed': 'Validation failed!',
     'validator_path_not_found': 'Path to validator script not found',
-    'validator_function_not_found': 'Validation function not found in script'
+    'validator_function_not_found': 'Validation function not found in script',
+    'daemon_already_running': 'A daemon is already listening on socket',
+    'daemon_not_supported': 'Unix domain sockets are not supported on this '
+                            'platform',
+    'daemon_connection_lost': 'Connection to the daemon was lost',
+    'invalid_shard': 'Shard must be of the form INDEX/COUNT where '
+                     '0 <= INDEX < COUNT',
+    'invalid_report': 'Could not read report',
+    'report_mismatch': 'Reports are not of the same run',
+    'regex_timeout': 'Regular expression timed out',
+    'engine_not_installed': 'Regex engine is not installed',
+    'invalid_pattern': 'Pattern could not be compiled',
+    'not_an_archive': 'File is not a tar or zip archive',
+    'not_compressed': 'File is not compressed with the declared compression',
+    'output_directory_and_to_file': '`to_file` and `output_directory` '
+                                    'cannot both be set',
+    'outside_base_directory': 'File is not under `base_directory`',
+    'file_changed': 'File was changed by another process while being handled'
 }
 
 
 _REPEX_VAR_PREFIX = 'REPEX_VAR_'
+_BINARY_SNIFF_SIZE = 8192
+_TEMP_FILE_SUFFIX = '.repex.tmp'
+# Read once, as reading the umask requires setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+_JOURNAL_FILE_SUFFIX = '.repex.journal'
+_CHUNK_SIZE = 64 * 1024 ** 2
+_DIGEST_BLOCK_SIZE = 1024 ** 2
+_BATCH_SEPARATOR = '\0'
+_BATCH_MAX_HIT_RATIO = 0.5
+_ENGINES = ('re', 'regex', 're2')
+# The modules of the compressions, imported when first used
+_CODECS = {'gzip': 'gzip', 'bz2': 'bz2', 'xz': 'lzma'}
+_DEDUPE_CACHE_SIZE = 256
+_REPEX_CACHE_SIZE = 1024
+# The Linux ioctl which makes a file share the extents of another
+_FICLONE = 0x40049409
 
 
 def setup_logger():
@@ -69,18 +137,61 @@ def set_verbose():
     logger.setLevel(logging.DEBUG)
 
 
+def _stat_key(path):
+    """Return a tuple which changes whenever the file is written to
+    or None if the file does not exist anymore.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+class _Cache(object):
+    """Objects kept between runs by a long running process (see `serve`)
+
+    Every entry is stored along with the `_stat_key` of the file (or
+    directories) it was built from and is rebuilt once those change.
+    """
+    def __init__(self):
+        self.configs = {}
+        self.includes = {}
+        self.repexes = {}
+        self.validators = {}
+        self.indexes = {}
+
+
+# Caching is only enabled by the daemon. Single runs gain nothing from it.
+_cache = None
+# Progress is only tracked when reporting it (see `--progress`)
+_progress = None
+# Files are only staged by transactional runs (see `_transacting`)
+_transaction = None
+
+
 def _import_yaml(config_file_path):
     """Return a configuration object
     """
+    if _cache is not None:
+        key = _stat_key(config_file_path)
+        cached = _cache.configs.get(os.path.abspath(config_file_path))
+        if key and cached and cached[0] == key:
+            logger.info('Using cached config %s...', config_file_path)
+            return copy.deepcopy(cached[1])
     try:
         logger.info('Importing config %s...', config_file_path)
         with open(config_file_path) as config_file:
-            return yaml.safe_load(config_file.read())
+            config = yaml.safe_load(config_file.read())
     except IOError as ex:
         raise RepexError('{0}: {1} ({2})'.format(
             ERRORS['config_file_not_found'], config_file_path, ex))
     except (yaml.parser.ParserError, yaml.scanner.ScannerError) as ex:
         raise RepexError('{0} ({1})'.format(ERRORS['invalid_yaml'], ex))
+    if _cache is not None:
+        _cache.configs[os.path.abspath(config_file_path)] = \
+            (key, copy.deepcopy(config))
+    return config
 
 
 def _get_config(config_file_path=None, config=None):
@@ -89,12 +200,43 @@ def _get_config(config_file_path=None, config=None):
 
     if config_file_path:
         config = _import_yaml(config_file_path)
+    else:
+        # Includes are merged into the config, which the caller may pass
+        # again (e.g. with other tags)
+        config = copy.deepcopy(config)
 
     config = config or {}
     config['variables'] = config.get('variables', {})
     return config
 
 
+def _get_engine(engine=None):
+    """Return the module of a regex engine
+
+    `re` is the default. `regex` and `re2` (a linear time engine) are
+    imported when first used.
+    """
+    if not engine or engine == 're':
+        return re
+    try:
+        return importlib.import_module(engine)
+    except ImportError:
+        raise RepexError('{0}: {1}'.format(
+            ERRORS['engine_not_installed'], engine))
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile(pattern, engine=None):
+    """Compile a pattern using a regex engine
+    """
+    engine_module = _get_engine(engine)
+    try:
+        return engine_module.compile(pattern)
+    except engine_module.error as ex:
+        raise RepexError('{0} by {1}: {2} ({3})'.format(
+            ERRORS['invalid_pattern'], engine or 're', pattern, ex))
+
+
 def _normalize_excluded_paths(base_dir, excluded_paths):
     excluded_paths = excluded_paths or []
     excluded_paths = [os.path.join(base_dir, excluded_path).rstrip('/')
@@ -106,13 +248,15 @@ def _set_match_parameters(filename,
                           filepath,
                           filename_regex,
                           excluded_filename_regex,
-                          excluded_paths):
+                          excluded_paths,
+                          engine=None):
     filename_regex = r'{0}'.format(filename_regex)
     excluded_filename_regex = r'{0}'.format(excluded_filename_regex)
 
     is_file = os.path.isfile(filepath)
-    matched = re.match(filename_regex, filename)
-    excluded_filename = re.match(excluded_filename_regex, filename)
+    matched = _compile(filename_regex, engine).match(filename)
+    excluded_filename = \
+        _compile(excluded_filename_regex, engine).match(filename)
     excluded_path = filepath in excluded_paths
     return is_file, matched, excluded_filename, excluded_path
 
@@ -121,7 +265,9 @@ def _get_all_files(filename_regex,
                    path,
                    base_dir,
                    excluded_paths=None,
-                   excluded_filename_regex=None):
+                   excluded_filename_regex=None,
+                   engine=None,
+                   follow_symlinks=False):
     """Get all files for processing.
 
     This starts iterating from `base_dir` and checks for all files
@@ -129,6 +275,9 @@ def _get_all_files(filename_regex,
     all paths under the `excluded_paths` list, whether they are files
     or folders. `excluded_paths` are explicit paths, not regex.
     `excluded_filename_regex` are files to be excluded as well.
+    Symlinks to directories are only followed if `follow_symlinks` is
+    set, in which case symlinks to a directory within which they are
+    found are not followed, to avoid cycles.
     """
     # For windows
     def replace_backslashes(string):
@@ -143,11 +292,29 @@ def _get_all_files(filename_regex,
     if excluded_filename_regex:
         logger.info('Excluding file names: %s', excluded_filename_regex)
 
-    path_expression = re.compile(replace_backslashes(path))
+    if _cache is not None:
+        index_key = (filename_regex, path, base_dir, tuple(excluded_paths),
+                     excluded_filename_regex, engine, follow_symlinks)
+        cached = _cache.indexes.get(index_key)
+        if cached and all(_stat_key(directory) == key
+                          for directory, key in cached[0].items()):
+            logger.debug('Using cached list of files')
+            return list(cached[1])
+    directory_keys = {}
 
-    target_files = []
+    path_expression = _compile(replace_backslashes(path), engine)
 
-    for root, _, files in os.walk(base_dir):
+    target_files = []
+    # The directories each directory is within, by device and inode
+    ancestors = {base_dir: frozenset()}
+
+    for root, directories, files in os.walk(
+            base_dir, followlinks=follow_symlinks):
+        if _progress is not None:
+            _progress.walked(len(target_files))
+        if follow_symlinks:
+            _prune_cycles(root, directories, ancestors)
+        directory_keys[root] = _stat_key(root)
         if not root.startswith(tuple(excluded_paths)) \
                 and path_expression.search(replace_backslashes(root)):
             for filename in files:
@@ -158,15 +325,104 @@ def _get_all_files(filename_regex,
                         filepath,
                         filename_regex,
                         excluded_filename_regex,
-                        excluded_paths)
+                        excluded_paths,
+                        engine)
+                # Temp files are those of runs in progress (e.g. staged
+                # files of a transaction)
                 if is_file and matched and not excluded_filename \
-                        and not excluded_path:
+                        and not excluded_path \
+                        and not _is_temp_file(filename):
                     logger.debug('%s is a match. Appending to list...',
                                  filepath)
                     target_files.append(filepath)
+    if _cache is not None:
+        _cache.indexes[index_key] = (directory_keys, list(target_files))
     return target_files
 
 
+def _prune_cycles(root, directories, ancestors):
+    """Remove the directories within `root` which are `root` or one of
+    the directories it is within, from the directories to walk
+    """
+    root_stat = os.stat(root)
+    within = ancestors.pop(root) | {(root_stat.st_dev, root_stat.st_ino)}
+    for directory in list(directories):
+        path = os.path.join(root, directory)
+        directory_stat = os.stat(path)
+        if (directory_stat.st_dev, directory_stat.st_ino) in within:
+            logger.debug('%s links to a directory it is within. '
+                         'Skipping...', path)
+            directories.remove(directory)
+        else:
+            ancestors[path] = within
+
+
+def _unique_files(files):
+    """Return a single path to each of the files, which may be found
+    more than once via hard links or symlinks
+
+    The path kept is the first, by name, of those which are not symlinks,
+    so that the same one is kept regardless of the order files are
+    found in.
+    """
+    unique = {}
+    for file_to_handle in files:
+        file_stat = os.stat(file_to_handle)
+        key = (file_stat.st_dev, file_stat.st_ino)
+        preference = (os.path.islink(file_to_handle), file_to_handle)
+        if key not in unique or preference < unique[key][0]:
+            unique[key] = (preference, file_to_handle)
+    if len(unique) < len(files):
+        logger.info('Skipping %s paths to files found more than once',
+                    len(files) - len(unique))
+    kept = set(file_to_handle for _, file_to_handle in unique.values())
+    return [file_to_handle for file_to_handle in files
+            if file_to_handle in kept]
+
+
+def _is_binary(path, compression=None):
+    """Return True if the first block of the file contains a NUL byte
+
+    This is the same heuristic git and grep use and only reads
+    `_BINARY_SNIFF_SIZE` bytes of the file (decompressed if
+    `compression` is set).
+    """
+    with _open_decompressed(path, compression) as sniffed_file:
+        return b'\0' in sniffed_file.read(_BINARY_SNIFF_SIZE)
+
+
+def _filter_files(files,
+                  max_file_size=None,
+                  skip_binary=False,
+                  compression=None):
+    """Remove oversized and binary files from the list of files to handle
+
+    Both checks are cheap (a `stat` and a read of a single block)
+    and are done before a file is ever read in full.
+    """
+    if max_file_size is None and not skip_binary:
+        return files
+
+    filtered_files = []
+    oversized = 0
+    binary = 0
+    for file_to_handle in files:
+        if max_file_size is not None and \
+                os.stat(file_to_handle).st_size > max_file_size:
+            logger.debug('%s is larger than %s bytes. Skipping...',
+                         file_to_handle, max_file_size)
+            oversized += 1
+        elif skip_binary and _is_binary(file_to_handle, compression):
+            logger.debug('%s is a binary file. Skipping...', file_to_handle)
+            binary += 1
+        else:
+            filtered_files.append(file_to_handle)
+    if oversized or binary:
+        logger.info('Skipped %s files (%s oversized, %s binary)',
+                    oversized + binary, oversized, binary)
+    return filtered_files
+
+
 class _Validator(object):
     def __init__(self, validator_config):
         self.validation_type = validator_config.get('type', 'per_file')
@@ -198,9 +454,19 @@ class _Validator(object):
             raise RepexError(ERRORS['validator_path_not_found'])
 
     def _import_validator(self):
+        if _cache is not None:
+            key = _stat_key(self.validator_path)
+            cached = _cache.validators.get(
+                os.path.abspath(self.validator_path))
+            if cached and cached[0] == key:
+                return cached[1]
         logger.debug('Importing validator: %s', self.validator_path)
-        return imp.load_source(
+        validator = imp.load_source(
             os.path.basename(self.validator_path), self.validator_path)
+        if _cache is not None:
+            _cache.validators[os.path.abspath(self.validator_path)] = \
+                (key, validator)
+        return validator
 
 
 class _VariablesHandler(object):
@@ -214,6 +480,10 @@ class _VariablesHandler(object):
 
     _variable_string_expression = re.compile(r'{{ \..+? }}')
 
+    @classmethod
+    def has_variables(cls, string):
+        return bool(cls._variable_string_expression.search(string))
+
     def expand(self, repex_vars, fields):
         r"""Receive a dict of variables and a dict of fields
         and iterates through them to expand a variable in an field, then
@@ -340,13 +610,109 @@ def _match_tags(repex_tags, path_tags):
     return False
 
 
+def _load_config(config_file_path,
+                 config,
+                 variables,
+                 tags,
+                 validate,
+                 engine=None):
+    # TODO: Check if tags can be a tuple instead of a list
+    if not isinstance(variables or {}, dict):
+        raise TypeError(ERRORS['variables_not_dict'])
+    if not isinstance(tags or [], list):
+        raise TypeError(ERRORS['tags_not_list'])
+
+    config = _get_config(config_file_path, config)
+    if validate:
+        _validate_config_schema(config, engine)
+    base_directory = os.path.dirname(config_file_path) \
+        if config_file_path else os.curdir
+    seen = set([os.path.abspath(config_file_path)]) \
+        if config_file_path else set()
+    _include(config, base_directory, tags or [], validate, engine, seen)
+    if engine:
+        config['paths'] = [dict(path, engine=path.get('engine') or engine)
+                           for path in config['paths']]
+    return config
+
+
+def _include(config, base_directory, tags, validate, engine, seen):
+    """Add the paths and variables of the configs a config includes,
+    and those they include, to it
+
+    Includes whose tags can't match the chosen `tags` are skipped without
+    being read. Included paths are tagged with the tags of their includes.
+    `seen` holds the config files included so far, which are never
+    included again.
+    """
+    config['paths'] = config.get('paths', [])
+    config['variables'] = config.get('variables') or {}
+    for include in config.pop('include', []):
+        if not isinstance(include, dict):
+            include = {'path': include}
+        include_tags = include.get('tags', [])
+        if include_tags and not _match_tags(tags, include_tags):
+            logger.debug('No matching tags found for include: %s. '
+                         'Skipping...', include['path'])
+            continue
+        pattern = os.path.join(base_directory, include['path'])
+        included_files = sorted(glob.glob(pattern)) \
+            if glob.has_magic(pattern) else [pattern]
+        for included_file in included_files:
+            if os.path.abspath(included_file) in seen:
+                logger.debug('%s was already included. Skipping...',
+                             included_file)
+                continue
+            seen.add(os.path.abspath(included_file))
+            included = _load_included_config(included_file, validate, engine)
+            _include(included, os.path.dirname(included_file), tags,
+                     validate, engine, seen)
+            for path in included['paths']:
+                path_tags = path.get('tags', [])
+                path['tags'] = path_tags + [
+                    tag for tag in include_tags if tag not in path_tags]
+                config['paths'].append(path)
+            # Variables of the including config take precedence
+            variables = dict(included['variables'])
+            variables.update(config['variables'])
+            config['variables'] = variables
+
+
+def _load_included_config(config_file_path, validate, engine=None):
+    """Return an included config, validated if `validate` is set
+
+    Included configs are kept, as validated, by a long running process,
+    until their file changes.
+    """
+    key = _stat_key(config_file_path)
+    cache_key = (os.path.abspath(config_file_path), validate, engine)
+    if _cache is not None:
+        cached = _cache.includes.get(cache_key)
+        if key and cached and cached[0] == key:
+            logger.debug('Using cached include %s...', config_file_path)
+            return copy.deepcopy(cached[1])
+    config = _import_yaml(config_file_path) or {}
+    if not isinstance(config, dict):
+        raise RepexError('{0}: {1}'.format(
+            ERRORS['invalid_yaml'], config_file_path))
+    if validate:
+        _validate_config_schema(config, engine)
+    if _cache is not None:
+        _cache.includes[cache_key] = (key, copy.deepcopy(config))
+    return config
+
+
 def iterate(config_file_path=None,
             config=None,
             variables=None,
             tags=None,
             validate=True,
             validate_only=False,
-            with_diff=False):
+            with_diff=False,
+            shard=None,
+            report_path=None,
+            engine=None,
+            transactional=False):
     """Iterate over all paths in `config_file_path`
 
     :param string config_file_path: a path to a repex config file
@@ -356,16 +722,20 @@ def iterate(config_file_path=None,
     :param bool validate: whether to perform schema validation on the config
     :param bool validate_only: only perform validation without running
     :param bool with_diff: whether to write a diff of all changes to a file
+    :param shard: an (index, count) tuple or an `INDEX/COUNT` string.
+     If provided, only the files which belong to this shard are handled.
+    :param string report_path: a path to write a JSON report of all
+     handled files to. Reports of shards can be merged with `merge_reports`
+    :param string engine: the regex engine (`re`, `regex` or `re2`) to use
+     for paths which do not choose one
+    :param bool transactional: whether to only change files once all paths
+     were handled and validated, and either change all of them or none
+    :return: a list of the `FileOutcome` of each handled file, in the
+     order they were handled in
     """
-    # TODO: Check if tags can be a tuple instead of a list
-    if not isinstance(variables or {}, dict):
-        raise TypeError(ERRORS['variables_not_dict'])
-    if not isinstance(tags or [], list):
-        raise TypeError(ERRORS['tags_not_list'])
-
-    config = _get_config(config_file_path, config)
-    if validate or validate_only:
-        _validate_config_schema(config)
+    config = _load_config(
+        config_file_path, config, variables, tags, validate or validate_only,
+        engine)
     if validate_only:
         logger.info('Config file validation completed successfully!')
         sys.exit(0)
@@ -373,21 +743,420 @@ def iterate(config_file_path=None,
     repex_vars = _merge_variables(config['variables'], variables or {})
     repex_tags = tags or []
     logger.debug('Chosen tags: %s', repex_tags)
-
-    for path in config['paths']:
-        _process_path(path, repex_tags, repex_vars, with_diff)
-
-
-def _process_path(path, repex_tags, repex_vars, with_diff):
+    shard = _parse_shard(shard) if shard else None
+    report = _Report(shard) if report_path else None
+
+    paths = config['paths']
+    # Reports record each path of the config separately
+    if report is None:
+        paths = _combine_literal_paths(paths, repex_vars)
+    outcomes = []
+    with _transacting(transactional):
+        for path in paths:
+            outcomes.extend(_process_path(
+                path, repex_tags, repex_vars, with_diff, shard, report))
+
+    if report is not None:
+        report.write(report_path)
+    return outcomes
+
+
+def _process_path(path,
+                  repex_tags,
+                  repex_vars,
+                  with_diff,
+                  shard=None,
+                  report=None):
     path_tags = path.get('tags', [])
     logger.debug('Checking for matching tags: %s', path_tags)
     tags_match = _match_tags(repex_tags, path_tags)
     if tags_match:
         logger.debug('Matching tag(s) found for path: %s...', path)
-        handle_path(path, repex_vars, with_diff)
-    else:
-        logger.debug('No matching tags found for path: %s. Skipping...',
-                     path)
+        return handle_path(path, repex_vars, with_diff, shard, report)
+    logger.debug('No matching tags found for path: %s. Skipping...', path)
+    return []
+
+
+def _literal(pattern):
+    """Return the only string a regular expression can match, or None if
+    it can match more than one
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return None
+    if parsed.state.flags & ~re.UNICODE or \
+            any(op is not sre_constants.LITERAL for op, _ in parsed):
+        return None
+    return ''.join(chr(value) for _, value in parsed)
+
+
+def _overlap(first, second):
+    """Check whether an occurrence of one string might overlap an
+    occurrence of the other
+    """
+    if first in second or second in first:
+        return True
+    shortest = min(len(first), len(second))
+    return any(first.endswith(second[:length]) or
+               second.endswith(first[:length])
+               for length in range(1, shortest))
+
+
+def _literal_rule(pathobj):
+    """Return a (match, replacement) tuple for a path object which
+    replaces a literal string with another, or None
+    """
+    if pathobj.get('validator') or pathobj['must_include'] or \
+            pathobj['to_file'] or '\\' in pathobj['with']:
+        return None
+    match = _literal(pathobj['match'])
+    replace = _literal(pathobj['replace'])
+    if not match or not replace or replace not in match:
+        return None
+    new_string = match.replace(replace, pathobj['with'])
+    return (match, new_string) if new_string else None
+
+
+def _combine_literal_paths(paths, variables):
+    """Return the paths of a config with consecutive paths which replace
+    literal strings within the same files combined into a single path
+
+    A combined path scans each file once for all of their strings. Paths
+    are only combined if replacing their strings in any order produces
+    the same content as replacing them one path after the other, i.e. if
+    no string, or replacement, can overlap another path's string.
+    """
+    combined = []
+    group = []
+
+    def flush():
+        if len(group) > 1:
+            combined.append(_combine_paths(group))
+        else:
+            combined.extend(path for path, _, _ in group)
+        del group[:]
+
+    for path in paths:
+        try:
+            prepared = _prepare_path(copy.deepcopy(path), variables)
+        except RepexError:
+            # Let handling the path raise the error
+            prepared = None
+        rule = _literal_rule(prepared) if prepared else None
+        if rule is None:
+            flush()
+            combined.append(path)
+            continue
+        key = dict((k, v) for k, v in prepared.items()
+                   if k not in ('description', 'match', 'replace', 'with'))
+        if group and (key != group[0][1] or any(
+                _overlap(rule[0], match) or _overlap(rule[1], match) or
+                _overlap(rule[0], new_string)
+                for _, _, (match, new_string) in group)):
+            flush()
+        group.append((path, key, rule))
+    flush()
+    return combined
+
+
+def _combine_paths(group):
+    rules = [rule for _, _, rule in group]
+    logger.debug('Combining %s paths replacing literal strings', len(group))
+    pathobj = copy.deepcopy(group[0][1])
+    # Longer strings first, so that they are preferred
+    expression = '|'.join(re.escape(match) for match, _ in
+                          sorted(rules, key=lambda rule: -len(rule[0])))
+    descriptions = [path.get('description') for path, _, _ in group]
+    pathobj.update({
+        'description': ', '.join(d for d in descriptions if d) or None,
+        'match': expression,
+        'replace': expression,
+        'with': ', '.join(new_string for _, new_string in rules),
+        '_literals': dict(rules)
+    })
+    return pathobj
+
+
+def _parse_shard(shard):
+    """Return an (index, count) tuple from a tuple or an `INDEX/COUNT`
+    string where `INDEX` is zero based
+    """
+    try:
+        if isinstance(shard, str):
+            shard = shard.split('/')
+        index, count = (int(part) for part in shard)
+    except (TypeError, ValueError):
+        raise RepexError('{0}: {1}'.format(ERRORS['invalid_shard'], shard))
+    if count < 1 or not 0 <= index < count:
+        raise RepexError('{0}: {1}'.format(
+            ERRORS['invalid_shard'], '{0}/{1}'.format(index, count)))
+    return index, count
+
+
+def _in_shard(path, base_dir, shard):
+    """Return True if `path` belongs to `shard`
+
+    The path relative to `base_dir` is hashed so that every machine
+    assigns the same files to the same shard regardless of where the
+    tree is mounted and of the order in which files are found.
+    """
+    index, count = shard
+    relative_path = os.path.relpath(path, base_dir).replace('\\', '/')
+    digest = hashlib.sha1(relative_path.encode('utf-8')).hexdigest()
+    return int(digest, 16) % count == index
+
+
+class _Report(object):
+    """A JSON serializable record of all files handled in a run
+
+    Reports of different shards of the same run can be merged
+    using `merge_reports`.
+    """
+    def __init__(self, shard=None):
+        self.shards = [list(shard)] if shard else []
+        self.paths = []
+
+    def add_path(self, description):
+        self.paths.append({'description': description, 'files': []})
+
+    def add_file(self, path, pre, post):
+        diff = list(difflib.unified_diff(pre, post))
+        self.paths[-1]['files'].append({
+            'path': path,
+            'changed': bool(diff),
+            'diff': diff
+        })
+
+    def to_dict(self):
+        files = [f for path in self.paths for f in path['files']]
+        return {
+            'shards': self.shards,
+            'stats': {
+                'files': len(files),
+                'changed': len([f for f in files if f['changed']])
+            },
+            'paths': self.paths
+        }
+
+    def write(self, report_path):
+        logger.info('Writing report to %s...', report_path)
+        with open(report_path, 'w') as report_file:
+            json.dump(self.to_dict(), report_file, indent=2)
+
+
+class _Progress(object):
+    """Track the progress of handling the files of a path object and
+    report it to `stream` every `interval` seconds
+
+    Progress is reported as a line which is rewritten in place or, if
+    `structured` is set, as a JSON event per line. Tracking only updates
+    counters, reporting is done by a thread of its own, so that a run
+    stuck on a single file (or in a validator) is reported as well.
+    """
+    def __init__(self, stream, structured=False, interval=None):
+        self.stream = stream
+        self.structured = structured
+        self.interval = interval or (1.0 if structured else 0.2)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._state = None
+        self._thread = threading.Thread(target=self._report_periodically)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def path_started(self, path):
+        now = time.monotonic()
+        with self._lock:
+            self._state = {
+                'path': path,
+                'stage': 'walking',
+                'discovered': 0,
+                'processed': 0,
+                'changed': 0,
+                'bytes': 0,
+                'started': now,
+                'current': None,
+                'current_started': now
+            }
+
+    def path_done(self):
+        self._report(done=True)
+        with self._lock:
+            self._state = None
+
+    def walked(self, discovered):
+        self._update(stage='walking', discovered=discovered)
+
+    def discovered(self, count):
+        self._update(stage='handling', discovered=count)
+
+    def validating(self, path):
+        self._update(stage='validating', current=path,
+                     current_started=time.monotonic())
+
+    def file_started(self, path, size):
+        with self._lock:
+            if self._state is not None:
+                self._state.update(stage='handling',
+                                   current=path,
+                                   current_started=time.monotonic())
+                self._state['bytes'] += size
+
+    def file_changed(self):
+        with self._lock:
+            if self._state is not None:
+                self._state['changed'] += 1
+
+    def file_done(self):
+        with self._lock:
+            if self._state is not None:
+                self._state['processed'] += 1
+                self._state['current'] = None
+
+    def _update(self, **values):
+        with self._lock:
+            if self._state is not None:
+                self._state.update(values)
+
+    def _report_periodically(self):
+        while not self._stopped.wait(self.interval):
+            self._report()
+
+    def _report(self, done=False):
+        with self._lock:
+            if self._state is None:
+                return
+            state = dict(self._state)
+        now = time.monotonic()
+        elapsed = max(now - state.pop('started'), 1e-6)
+        current_started = state.pop('current_started')
+        remaining = state['discovered'] - state['processed']
+        event = dict(
+            state,
+            event='path_done' if done else 'progress',
+            elapsed=round(elapsed, 3),
+            bytes_per_second=int(state['bytes'] / elapsed),
+            eta=round(elapsed / state['processed'] * remaining, 1)
+            if state['processed'] and state['stage'] == 'handling' else None,
+            current_elapsed=round(now - current_started, 1)
+            if state['current'] else None)
+        if self.structured:
+            self.stream.write(json.dumps(event, sort_keys=True) + '\n')
+        else:
+            self.stream.write('\r\x1b[K' + _format_progress(event) +
+                              ('\n' if done else ''))
+        self.stream.flush()
+
+
+def _format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+    return '{0:.1f}{1}'.format(size, unit)
+
+
+def _format_progress(event):
+    """Return a line describing a progress event of `_Progress`
+    """
+    line = '{0}: {1} {2}/{3} files, {4} changed, {5} ({6}/s)'.format(
+        event['path'],
+        event['stage'],
+        event['processed'],
+        event['discovered'],
+        event['changed'],
+        _format_size(event['bytes']),
+        _format_size(event['bytes_per_second']))
+    if event['eta'] is not None:
+        line += ', ETA {0}s'.format(int(event['eta']))
+    if event['current']:
+        line += ' - {0} ({1}s)'.format(
+            event['current'], int(event['current_elapsed']))
+    return line
+
+
+@contextlib.contextmanager
+def _reporting_progress(mode, stream=None):
+    """Report the progress of the paths handled within the context, as a
+    line (`tty`) or as JSON events (`json`), to `stream` (stderr by
+    default), unless `mode` is None
+    """
+    global _progress
+    if mode is None:
+        yield
+        return
+    _progress = _Progress(stream or sys.stderr, structured=mode == 'json')
+    _progress.start()
+    try:
+        yield
+    finally:
+        _progress.stop()
+        _progress = None
+
+
+@contextlib.contextmanager
+def _reporting_path(path):
+    if _progress is None:
+        yield
+        return
+    _progress.path_started(path)
+    try:
+        yield
+    finally:
+        _progress.path_done()
+
+
+def merge_reports(report_paths, output_path=None):
+    """Merge the reports written by the shards of a run into one
+
+    :param list report_paths: paths to the reports to merge
+    :param string output_path: where to write the merged report to
+    :return: the merged report as a dict
+    """
+    merged = _Report()
+    for report_path in report_paths:
+        logger.info('Merging report %s...', report_path)
+        try:
+            with open(report_path) as report_file:
+                report = json.load(report_file)
+        except (IOError, ValueError) as ex:
+            raise RepexError('{0}: {1} ({2})'.format(
+                ERRORS['invalid_report'], report_path, ex))
+        merged.shards.extend(report['shards'])
+        for index, path in enumerate(report['paths']):
+            if index == len(merged.paths):
+                merged.add_path(path['description'])
+            elif merged.paths[index]['description'] != path['description']:
+                raise RepexError('{0}: {1}'.format(
+                    ERRORS['report_mismatch'], report_path))
+            merged.paths[index]['files'].extend(path['files'])
+
+    for path in merged.paths:
+        path['files'].sort(key=lambda f: f['path'])
+    merged.shards.sort()
+    counts = set(count for _, count in merged.shards)
+    if len(counts) > 1:
+        raise RepexError('{0}: {1}'.format(
+            ERRORS['report_mismatch'], sorted(counts)))
+    if counts:
+        missing = sorted(set(range(counts.pop())) -
+                         set(index for index, _ in merged.shards))
+        if missing:
+            logger.warning('Reports of shards %s are missing', missing)
+
+    merged = merged.to_dict()
+    if output_path:
+        logger.info('Writing merged report to %s...', output_path)
+        with open(output_path, 'w') as report_file:
+            json.dump(merged, report_file, indent=2)
+    return merged
 
 
 def _get_current_time():
@@ -398,6 +1167,25 @@ def _get_current_time():
     return datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
 
 
+def _get_contents(rpx, path):
+    """Return the lines of a file, decompressed if `rpx` handles
+    compressed files or, if it handles archives, those of the matching
+    members of an archive, each preceded by its name
+    """
+    rpx.throttle(os.path.getsize(path))
+    if rpx.compression:
+        with _open_decompressed(path, rpx.compression) as f:
+            return io.TextIOWrapper(f).readlines()
+    if not rpx.archive_member:
+        return _get_file_contents(path)
+    lines = []
+    for name, content in _archive_members(
+            path, _compile(rpx.archive_member, rpx.engine)):
+        lines.append('[{0}]\n'.format(name))
+        lines.extend(content.splitlines(True))
+    return lines
+
+
 def _get_file_contents(path):
     with open(path) as open_file:
         return open_file.readlines()
@@ -410,6 +1198,11 @@ def _normalize_current_time(current_time):
     return 'T'.join(timestamp)
 
 
+# Diffs of files handled concurrently (see `async_handle_path`) are
+# written to the same file.
+_diff_lock = threading.Lock()
+
+
 def _write_diff(pre, post, output_file_path):
     diff = difflib.unified_diff(pre, post)
     items = [line for line in diff]
@@ -419,7 +1212,7 @@ def _write_diff(pre, post, output_file_path):
         os.makedirs(_DIFF_HOME)
 
     if items:
-        with open(_DIFF_FILE_PATH, 'a+') as diff_log:
+        with _diff_lock, open(_DIFF_FILE_PATH, 'a+') as diff_log:
             diff_log.write(_get_current_time() + ' ' + output_file_path)
             diff_log.write('\n')
             for index, line in enumerate(items):
@@ -429,66 +1222,242 @@ def _write_diff(pre, post, output_file_path):
 
 
 def _assert_validated(validator, file_to_validate):
+    file_to_validate = _staged(file_to_validate)
+    if _progress is not None:
+        _progress.validating(file_to_validate)
     if not validator.validate(file_to_validate):
         raise RepexError(ERRORS['validation_failed'])
 
 
+def _handle_file(rpx, file_to_handle, pathobj, diff, report=None):
+    diff = pathobj.get('diff') or diff
+    if diff or report is not None:
+        pre = _get_contents(rpx, _staged(rpx._working_copy(file_to_handle)))
+        outcome = rpx.handle_file(file_to_handle)
+        post = _get_contents(rpx, _staged(outcome.output_path))
+        if diff:
+            _write_diff(pre, post, outcome.output_path)
+        if report is not None:
+            report.add_file(outcome.output_path, pre, post)
+        return outcome
+    return rpx.handle_file(file_to_handle)
+
+
 def _handle_single_file(rpx,
                         path_to_handle,
                         pathobj,
                         validate,
                         diff,
-                        validator=None):
+                        validator=None,
+                        report=None):
     if os.path.isfile(path_to_handle):
-        if pathobj.get('diff') or diff:
-            pre = _get_file_contents(path_to_handle)
-            output_file_path = rpx.handle_file(path_to_handle)
-            post = _get_file_contents(output_file_path)
-            _write_diff(pre, post, output_file_path)
-        else:
-            rpx.handle_file(path_to_handle)
+        if _progress is not None:
+            _progress.discovered(1)
+        outcome = _handle_file(rpx, path_to_handle, pathobj, diff, report)
         if validate:
-            _assert_validated(validator, path_to_handle)
+            _assert_validated(validator, rpx._working_copy(path_to_handle))
+        return outcome
     else:
         raise RepexError('{0}: {1}'.format(
             ERRORS['file_not_found'], path_to_handle))
 
 
-def _handle_multiple_files(rpx,
-                           path_to_handle,
-                           pathobj,
-                           validate,
-                           diff,
-                           validator=None,
-                           validator_type=None):
-    if os.path.isfile(path_to_handle):
-        raise RepexError(ERRORS['type_path_collision'])
-    if pathobj.get('to_file'):
-        raise RepexError(ERRORS['to_file_requires_explicit_path'])
-
+def _find_files(pathobj, shard=None):
     files = _get_all_files(
         pathobj['type'],
         pathobj['path'],
         pathobj['base_directory'],
-        pathobj['excluded']
+        pathobj['excluded'],
+        engine=pathobj['engine'],
+        follow_symlinks=pathobj['follow_symlinks']
     )
+    files = _unique_files(files)
+    if shard:
+        files = [f for f in files
+                 if _in_shard(f, pathobj['base_directory'], shard)]
+    # Archives always look binary, their binary members are skipped instead
+    return _filter_files(
+        files,
+        pathobj['max_file_size'],
+        pathobj['skip_binary'] and not pathobj.get('archive_member'),
+        pathobj.get('compression'))
+
+
+def _check_multiple_files_path(path_to_handle, pathobj):
+    if os.path.isfile(path_to_handle):
+        raise RepexError(ERRORS['type_path_collision'])
+    if pathobj.get('to_file'):
+        raise RepexError(ERRORS['to_file_requires_explicit_path'])
+
+
+def _read_for_batch(rpx, file_to_handle, batch_size):
+    """Return the content of a file as `Repex.handle_file` would read it,
+    or None if it can't be scanned as part of a batch
+    """
+    file_to_handle = _staged(file_to_handle)
+    try:
+        size = os.path.getsize(file_to_handle)
+        if size >= batch_size or (rpx.mmap_threshold is not None and
+                                  size >= max(rpx.mmap_threshold, 1)):
+            return None
+        rpx.throttle(size)
+        with open(file_to_handle) as f:
+            content = f.read()
+    except (IOError, OSError, UnicodeDecodeError):
+        # Let handling the file raise the error
+        return None
+    return None if _BATCH_SEPARATOR in content else content
+
+
+def _scan_batch(rpx, batch, contents):
+    """Return the files of a batch which might have matches or which might
+    lack required strings
+    """
+    buffer = _BATCH_SEPARATOR.join(contents)
+    starts = []
+    position = 0
+    for content in contents:
+        starts.append(position)
+        position += len(content) + len(_BATCH_SEPARATOR)
+
+    def spanned(hit):
+        first = bisect.bisect_right(starts, hit.start()) - 1
+        last = bisect.bisect_right(starts, max(hit.end() - 1, hit.start())) - 1
+        return first, last
+
+    candidates = set()
+    # A hit spanning files might hide matches in the files it spans, so all
+    # of them are handled.
+    for hit in rpx.match_expression.finditer(buffer):
+        first, last = spanned(hit)
+        candidates.update(batch[first:last + 1])
+    for string in rpx.must_include:
+        included = set()
+        for hit in _compile(string, rpx.engine).finditer(buffer):
+            first, last = spanned(hit)
+            if first == last:
+                included.add(batch[first])
+        candidates.update(f for f in batch if f not in included)
+    return candidates
+
+
+def _batch_candidates(rpx, files, batch_size):
+    """Return the files among `files` which must be handled
+
+    Files are read into batches of up to `batch_size` characters, separated
+    by NUL characters, over which the expressions are run once. Files in
+    which nothing matches and which include all required strings would not
+    be changed by handling them, so they are left out. Files which can't be
+    batched are always handled.
+
+    Candidates are read again when they are handled, so once most of the
+    files scanned so far turned out to be candidates, the rest of the files
+    are handled without being scanned.
+    """
+    patterns = [rpx.match_regex] + list(rpx.must_include)
+    if rpx.in_place or rpx.archive_member or rpx.compression or \
+            rpx.output_directory or \
+            rpx.regex_timeout is not None or \
+            any(_CONTEXT_DEPENDENT.search(pattern) for pattern in patterns):
+        logger.debug('Not batching files')
+        return set(files)
+
+    candidates = set()
+    batch = []
+    contents = []
+    size = 0
+    scanned = 0
+    hits = 0
+    for index, file_to_handle in enumerate(files):
+        content = _read_for_batch(rpx, file_to_handle, batch_size)
+        if content is None:
+            candidates.add(file_to_handle)
+            continue
+        if batch and size + len(content) > batch_size:
+            found = _scan_batch(rpx, batch, contents)
+            candidates.update(found)
+            scanned += len(batch)
+            hits += len(found)
+            batch, contents, size = [], [], 0
+            if hits > scanned * _BATCH_MAX_HIT_RATIO:
+                logger.info('Most scanned files have to be handled. '
+                            'Handling the rest without batching them')
+                candidates.update(files[index:])
+                break
+        batch.append(file_to_handle)
+        contents.append(content)
+        size += len(content)
+    if batch:
+        candidates.update(_scan_batch(rpx, batch, contents))
+    logger.info('Found %s of %s files to handle', len(candidates), len(files))
+    return candidates
+
+
+def _handle_file_of_type(rpx,
+                         file_to_handle,
+                         pathobj,
+                         diff,
+                         validator=None,
+                         validator_type=None,
+                         report=None,
+                         candidates=None):
+    if candidates is None or file_to_handle in candidates:
+        outcome = _handle_file(rpx, file_to_handle, pathobj, diff, report)
+    else:
+        if _progress is not None:
+            _progress.file_done()
+        if report is not None:
+            # The file would not have been changed by handling it
+            rpx.throttle(os.path.getsize(_staged(file_to_handle)))
+            contents = _get_file_contents(_staged(file_to_handle))
+            report.add_file(file_to_handle, contents, contents)
+        size = os.path.getsize(_staged(file_to_handle))
+        outcome = FileOutcome(file_to_handle,
+                              rpx._working_copy(file_to_handle),
+                              False, size, size)
+    if validator and validator_type == 'per_file':
+        _assert_validated(validator, rpx._working_copy(file_to_handle))
+    return outcome
+
 
+def _handle_multiple_files(rpx,
+                           path_to_handle,
+                           pathobj,
+                           validate,
+                           diff,
+                           validator=None,
+                           validator_type=None,
+                           files=None,
+                           shard=None,
+                           report=None):
+    _check_multiple_files_path(path_to_handle, pathobj)
+
+    if files is None:
+        files = _find_files(pathobj, shard)
+    if _progress is not None:
+        _progress.discovered(len(files))
+    candidates = None
+    if pathobj.get('batch_size'):
+        candidates = _batch_candidates(rpx, files, pathobj['batch_size'])
+
+    outcomes = []
     for file_to_handle in files:
-        if pathobj.get('diff') or diff:
-            pre = _get_file_contents(file_to_handle)
-            output_file_path = rpx.handle_file(file_to_handle)
-            post = _get_file_contents(output_file_path)
-            _write_diff(pre, post, output_file_path)
-        else:
-            rpx.handle_file(file_to_handle)
-        if validate and validator_type == 'per_file':
-            _assert_validated(validator, file_to_handle)
+        outcomes.append(_handle_file_of_type(
+            rpx,
+            file_to_handle,
+            pathobj,
+            diff,
+            validator if validate else None,
+            validator_type,
+            report,
+            candidates))
 
     # Need to check that `files` isn't an empty list or `file_to_handle`
     # will be undefined.
     if files and file_to_handle and validate and \
             validator_type == 'per_type':
-        _assert_validated(validator, file_to_handle)
+        _assert_validated(validator, rpx._working_copy(file_to_handle))
+    return outcomes
 
 
 def _set_path_defaults(pathobj):
@@ -497,102 +1466,668 @@ def _set_path_defaults(pathobj):
     pathobj['to_file'] = pathobj.get('to_file', False)
     pathobj['must_include'] = pathobj.get('must_include', [])
     pathobj['excluded'] = pathobj.get('excluded', [])
+    pathobj['max_file_size'] = pathobj.get('max_file_size')
+    pathobj['skip_binary'] = pathobj.get('skip_binary', False)
+    pathobj['in_place'] = pathobj.get('in_place', False)
+    pathobj['mmap_threshold'] = pathobj.get('mmap_threshold')
+    pathobj['line_mode'] = pathobj.get('line_mode', False)
+    pathobj['record_separator'] = pathobj.get('record_separator')
+    pathobj['batch_size'] = pathobj.get('batch_size')
+    pathobj['regex_timeout'] = pathobj.get('regex_timeout')
+    pathobj['engine'] = pathobj.get('engine') or 're'
+    pathobj['archive_member'] = pathobj.get('archive_member')
+    pathobj['compression'] = pathobj.get('compression')
+    pathobj['output_directory'] = pathobj.get('output_directory')
+    pathobj['follow_symlinks'] = pathobj.get('follow_symlinks', False)
+    pathobj['dedupe_content'] = pathobj.get('dedupe_content', False)
+    pathobj['max_bytes_per_second'] = pathobj.get('max_bytes_per_second')
+    pathobj['max_files_per_second'] = pathobj.get('max_files_per_second')
+    return pathobj
+
+
+def _prepare_path(pathobj, variables=None):
+    """Return a path object with its variables expanded and its
+    defaults set
+    """
+    variables = variables or {}
+    variable_expander = _VariablesHandler()
+    pathobj = variable_expander.expand(variables, pathobj)
+    pathobj = _set_path_defaults(pathobj)
+    if pathobj['output_directory']:
+        # Files written to the output directory are never handled again
+        output_directory = os.path.relpath(
+            pathobj['output_directory'],
+            pathobj['base_directory'] or os.curdir)
+        if not _is_outside(output_directory):
+            pathobj['excluded'] = \
+                pathobj['excluded'] + [output_directory]
     return pathobj
 
 
-def handle_path(pathobj, variables=None, diff=False):
+def _get_validator(pathobj):
+    """Return a tuple of (validator, validator_type) for a path object
+
+    Both are None if the path object does not declare a validator.
+    """
+    if 'validator' not in pathobj:
+        return None, None
+    validator_config = pathobj['validator']
+    return (_Validator(validator_config),
+            validator_config.get('type', 'per_type'))
+
+
+def _get_repex(pathobj):
+    repex_class = _LiteralRepex if '_literals' in pathobj else Repex
+    if _cache is None:
+        return repex_class(pathobj)
+    key = json.dumps(pathobj, sort_keys=True, default=str)
+    # Kept least recently used first, as path objects with different
+    # variables are cached separately
+    rpx = _cache.repexes.pop(key, None)
+    if rpx is None:
+        rpx = repex_class(pathobj)
+        if len(_cache.repexes) >= _REPEX_CACHE_SIZE:
+            del _cache.repexes[next(iter(_cache.repexes))]
+    _cache.repexes[key] = rpx
+    return rpx
+
+
+def handle_path(pathobj,
+                variables=None,
+                diff=False,
+                shard=None,
+                report=None,
+                transactional=False):
     """Iterate over all chosen files in a path
 
     :param dict pathobj: a dict of a specific path in the config
     :param dict variables: a dict of variables (can be None)
+    :param tuple shard: an (index, count) tuple. If provided, only the
+     files which belong to this shard are handled.
+    :param report: a `_Report` to add each handled file to
+    :param bool transactional: whether to only change files once all of
+     them were handled and validated (see `iterate`)
+    :return: a list of the `FileOutcome` of each handled file
     """
+    with _transacting(transactional):
+        return _handle_path(pathobj, variables, diff, shard, report)
+
+
+def _handle_path(pathobj, variables, diff, shard, report):
     logger.info('Handling path with description: %s',
                 pathobj.get('description'))
 
-    variables = variables or {}
-    variable_expander = _VariablesHandler()
-    pathobj = variable_expander.expand(variables, pathobj)
-
-    pathobj = _set_path_defaults(pathobj)
+    pathobj = _prepare_path(pathobj, variables)
+    if report is not None:
+        report.add_path(pathobj.get('description'))
 
     path_to_handle = os.path.join(pathobj['base_directory'], pathobj['path'])
     logger.debug('Path to process: %s', path_to_handle)
 
-    validate = 'validator' in pathobj
-    if validate:
-        validator_config = pathobj['validator']
-        validator = _Validator(validator_config)
-        validator_type = validator_config.get('type', 'per_type')
-
-    rpx = Repex(pathobj)
-
-    if not pathobj.get('type'):
-        _handle_single_file(
+    validator, validator_type = _get_validator(pathobj)
+    validate = validator is not None
+
+    rpx = _get_repex(pathobj)
+    if pathobj['output_directory']:
+        _mirror_tree(pathobj['base_directory'],
+                     pathobj['output_directory'],
+                     rpx.throttle)
+
+    with _reporting_path(pathobj.get('description') or path_to_handle):
+        if not pathobj.get('type'):
+            if shard and not _in_shard(
+                    path_to_handle, pathobj['base_directory'], shard):
+                logger.info('%s belongs to another shard. Skipping...',
+                            path_to_handle)
+                return []
+            return [_handle_single_file(
+                rpx=rpx,
+                path_to_handle=path_to_handle,
+                pathobj=pathobj,
+                validate=validate,
+                diff=diff,
+                validator=validator,
+                report=report)]
+        return _handle_multiple_files(
             rpx=rpx,
             path_to_handle=path_to_handle,
             pathobj=pathobj,
             validate=validate,
             diff=diff,
-            validator=validator if validate else None)
-    else:
-        _handle_multiple_files(
+            validator=validator,
+            validator_type=validator_type,
+            shard=shard,
+            report=report)
+
+
+_DEFAULT_CONCURRENCY = 8
+
+
+@contextlib.asynccontextmanager
+async def _executor_for(executor, concurrency):
+    import asyncio
+    import concurrent.futures
+
+    if executor is not None:
+        yield executor
+        return
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        yield executor
+    finally:
+        # Files which started being handled are waited for, so that none
+        # is changed once we return (e.g. after failing or being cancelled),
+        # without blocking the event loop meanwhile
+        await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(
+                executor.shutdown, wait=True, cancel_futures=True))
+
+
+async def _async_handle_files(executor,
+                              rpx,
+                              files,
+                              pathobj,
+                              diff,
+                              validator,
+                              validator_type,
+                              concurrency,
+                              progress):
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    handled = []
+    candidates = None
+    if pathobj.get('batch_size'):
+        candidates = await loop.run_in_executor(
+            executor, _batch_candidates, rpx, files, pathobj['batch_size'])
+
+    async def handle(file_to_handle):
+        async with semaphore:
+            outcome = await loop.run_in_executor(executor, functools.partial(
+                _handle_file_of_type,
+                rpx,
+                file_to_handle,
+                pathobj,
+                diff,
+                validator,
+                validator_type,
+                candidates=candidates))
+        handled.append(file_to_handle)
+        if progress:
+            progress(file_to_handle, len(handled), len(files))
+        return outcome
+
+    tasks = [asyncio.ensure_future(handle(f)) for f in files]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # Either a file failed or we were cancelled. Files which have not
+        # started yet are not handled at all.
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def _async_handle_path(executor,
+                             pathobj,
+                             variables,
+                             diff,
+                             concurrency,
+                             progress):
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    logger.info('Handling path with description: %s',
+                pathobj.get('description'))
+
+    pathobj = _prepare_path(pathobj, variables)
+
+    path_to_handle = os.path.join(pathobj['base_directory'], pathobj['path'])
+    logger.debug('Path to process: %s', path_to_handle)
+
+    validator, validator_type = _get_validator(pathobj)
+    rpx = _get_repex(pathobj)
+    if pathobj['output_directory']:
+        await loop.run_in_executor(
+            executor,
+            _mirror_tree,
+            pathobj['base_directory'],
+            pathobj['output_directory'],
+            rpx.throttle)
+
+    if not pathobj.get('type'):
+        outcome = await loop.run_in_executor(executor, functools.partial(
+            _handle_single_file,
             rpx=rpx,
             path_to_handle=path_to_handle,
             pathobj=pathobj,
-            validate=validate,
+            validate=validator is not None,
             diff=diff,
-            validator=validator if validate else None,
-            validator_type=validator_type if validate else None)
+            validator=validator))
+        if progress:
+            progress(path_to_handle, 1, 1)
+        return [outcome]
+
+    _check_multiple_files_path(path_to_handle, pathobj)
+    files = await loop.run_in_executor(
+        executor, functools.partial(_find_files, pathobj))
+    outcomes = await _async_handle_files(
+        executor,
+        rpx,
+        files,
+        pathobj,
+        diff,
+        validator,
+        validator_type,
+        concurrency,
+        progress)
+    if files and validator and validator_type == 'per_type':
+        await loop.run_in_executor(executor, functools.partial(
+            _assert_validated, validator, rpx._working_copy(files[-1])))
+    return outcomes
+
+
+async def async_handle_path(pathobj,
+                            variables=None,
+                            diff=False,
+                            concurrency=_DEFAULT_CONCURRENCY,
+                            progress=None,
+                            executor=None):
+    """Asynchronous version of `handle_path`
+
+    Finding, reading, replacing in and validating files is done in
+    `executor` so that the event loop is never blocked. Up to
+    `concurrency` files are handled at the same time.
+
+    :param int concurrency: maximum number of files handled concurrently
+    :param callable progress: called with the path of each handled file,
+     the amount of files handled so far and the total amount of files
+    :param executor: a `concurrent.futures.Executor` to use. If omitted,
+     a thread pool of `concurrency` threads is used.
+    """
+    async with _executor_for(executor, concurrency) as executor:
+        return await _async_handle_path(
+            executor, pathobj, variables, diff, concurrency, progress)
+
+
+async def async_iterate(config_file_path=None,
+                        config=None,
+                        variables=None,
+                        tags=None,
+                        validate=True,
+                        with_diff=False,
+                        concurrency=_DEFAULT_CONCURRENCY,
+                        progress=None,
+                        executor=None,
+                        engine=None):
+    """Asynchronous version of `iterate`
+
+    Paths are handled one after the other, as a path may depend on the
+    changes made by a previous one, while the files of each path are
+    handled concurrently. See `async_handle_path` for the rest of the
+    parameters.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    async with _executor_for(executor, concurrency) as executor:
+        config = await loop.run_in_executor(executor, functools.partial(
+            _load_config, config_file_path, config, variables, tags, validate,
+            engine))
+
+        repex_vars = _merge_variables(config['variables'], variables or {})
+        repex_tags = tags or []
+        logger.debug('Chosen tags: %s', repex_tags)
+
+        outcomes = []
+        for path in _combine_literal_paths(config['paths'], repex_vars):
+            if _match_tags(repex_tags, path.get('tags', [])):
+                outcomes.extend(await _async_handle_path(
+                    executor,
+                    path,
+                    repex_vars,
+                    with_diff,
+                    concurrency,
+                    progress))
+            else:
+                logger.debug(
+                    'No matching tags found for path: %s. Skipping...', path)
+        return outcomes
+
+
+class FileOutcome(object):
+    """The outcome of handling a file
+
+    `path` is the file which was handled and `output_path` the file its
+    content was written to, if it was `changed`. `size_before` and
+    `size_after` are the sizes of the file before and after handling it.
+    """
+
+    def __init__(self,
+                 path,
+                 output_path,
+                 changed,
+                 size_before,
+                 size_after,
+                 sha256=None):
+        self.path = path
+        self.output_path = output_path
+        self.changed = changed
+        self.size_before = size_before
+        self.size_after = size_after
+        self._sha256 = sha256
+
+    @property
+    def sha256(self):
+        """The SHA-256 hex digest of the file's content after handling it
+
+        Files are only read to hash them once this is first used, from
+        their staged copy if a transaction has not been committed yet.
+        """
+        if self._sha256 is None:
+            self._sha256 = _file_digest(_staged(
+                self.output_path if self.changed else self.path))
+        return self._sha256
+
+    def to_dict(self):
+        return {
+            'path': self.path,
+            'output_path': self.output_path,
+            'changed': self.changed,
+            'size_before': self.size_before,
+            'size_after': self.size_after,
+            'sha256': self.sha256
+        }
+
+    def __repr__(self):
+        return 'FileOutcome({0!r}, changed={1})'.format(
+            self.path, self.changed)
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_DIGEST_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_changed_files(outcomes, manifest_path):
+    """Write the absolute paths of the files changed in `outcomes` to
+    `manifest_path`, one per line, so that steps which depend on them
+    only need to redo their work for those files
+    """
+    changed = _unique(os.path.abspath(outcome.output_path)
+                      for outcome in outcomes if outcome.changed)
+    temp_file_path = _temp_path(manifest_path)
+    with open(temp_file_path, 'w') as manifest:
+        for path in changed:
+            manifest.write(path + '\n')
+    os.replace(temp_file_path, manifest_path)
+    return changed
 
 
 class Repex(object):
     def __init__(self, pathobj):
         # Ideally, we're receive **pathobj instead, but it contains a `with`
         # key which makes it impossible.
-        self.match_regex = pathobj['match']
+        self.match_regex = pathobj.get('match', pathobj['replace'])
         self.pattern_to_replace = pathobj['replace']
-        self.match_expression = \
-            re.compile('(?P<matchgroup>{0})'.format(pathobj['match']))
-        self.replace_expression = re.compile(self.pattern_to_replace)
+        self.engine = pathobj.get('engine') or 're'
+        self.match_expression = _compile(
+            '(?P<matchgroup>{0})'.format(self.match_regex), self.engine)
+        self.replace_expression = \
+            _compile(self.pattern_to_replace, self.engine)
 
         self.replace_with = pathobj['with']
-        self.to_file = pathobj['to_file']
-        self.must_include = pathobj['must_include']
+        self.to_file = pathobj.get('to_file', False)
+        self.must_include = pathobj.get('must_include', [])
+        self.in_place = pathobj.get('in_place', False)
+        self.mmap_threshold = pathobj.get('mmap_threshold')
+        self.record_separator = pathobj.get('record_separator') or \
+            ('\n' if pathobj.get('line_mode') else None)
+        self.regex_timeout = pathobj.get('regex_timeout')
+        self.archive_member = pathobj.get('archive_member')
+        self.compression = pathobj.get('compression')
+        self.output_directory = pathobj.get('output_directory')
+        self.base_directory = pathobj.get('base_directory')
+        if self.to_file and self.output_directory:
+            raise RepexError(ERRORS['output_directory_and_to_file'])
+        self.dedupe_content = pathobj.get('dedupe_content', False)
+        self._transformed = {}
+        self._transformed_lock = threading.Lock()
+        self._handling = threading.local()
+        self._bytes_bucket = _TokenBucket(pathobj.get('max_bytes_per_second'))
+        self._files_bucket = _TokenBucket(pathobj.get('max_files_per_second'))
+        self.description = pathobj.get('description')
+        self._bytes_expressions = None
+        self._required_expressions = {}
+
+    def throttle(self, size, files=0):
+        """Wait until `size` more bytes and `files` more files may be read
+        or written within `max_bytes_per_second` and `max_files_per_second`
+        """
+        self._files_bucket.take(files)
+        self._bytes_bucket.take(size)
 
     def handle_file(self, file_to_handle):
+        """Replace within a file and return its `FileOutcome`
+        """
+        size = os.path.getsize(file_to_handle)
+        if _progress is None:
+            return self._handle_file(file_to_handle, size)
+        _progress.file_started(file_to_handle, size)
+        try:
+            return self._handle_file(file_to_handle, size)
+        finally:
+            _progress.file_done()
+
+    def _handle_file(self, file_to_handle, size):
+        self.throttle(size, files=1)
+        handled_file_path = file_to_handle
+        if self.output_directory:
+            handled_file_path = self._working_copy(file_to_handle)
+        elif not self.to_file:
+            # Replace within the file a symlink points to, not the symlink
+            handled_file_path = os.path.realpath(file_to_handle)
+        handled_file_path = _staged(handled_file_path)
+        with _file_lock(handled_file_path):
+            _recover_journal(handled_file_path)
+            self._handling.expected = \
+                (handled_file_path, _stat_key(handled_file_path))
+            self._handling.changed = False
+            try:
+                output_file_path = self._handle_locked_file(handled_file_path)
+                changed = self._handling.changed
+                if not changed:
+                    # Nothing was written, not even to `to_file`
+                    output_file_path = handled_file_path
+                return FileOutcome(
+                    file_to_handle,
+                    _target(output_file_path),
+                    changed,
+                    size,
+                    os.path.getsize(output_file_path))
+            finally:
+                self._handling.expected = None
+
+    def _handle_locked_file(self, file_to_handle):
+        if self.archive_member:
+            return self._handle_archive(file_to_handle)
+        if self.compression:
+            compression = _resolve_compression(
+                file_to_handle, self.compression)
+            if compression:
+                return self._handle_compressed_file(
+                    file_to_handle, compression)
+        # Files in the output directory may be hard links to the originals
+        # and transactions stage changes rather than write them
+        if self.in_place and not self.to_file and \
+                not self.output_directory and _transaction is None and \
+                self._patch_in_place(file_to_handle):
+            return file_to_handle
+        if self.record_separator and self.regex_timeout is None and \
+                os.path.getsize(file_to_handle) >= 2 * _CHUNK_SIZE:
+            output_file_path = self._handle_chunked_file(file_to_handle)
+            if output_file_path:
+                return output_file_path
+        if self.mmap_threshold is not None and \
+                os.path.getsize(file_to_handle) >= \
+                max(self.mmap_threshold, 1):
+            output_file_path = self._handle_mapped_file(file_to_handle)
+            if output_file_path:
+                return output_file_path
+
         with open(file_to_handle) as f:
-            content = f.read()
+            original = f.read()
+
+        content, _, _ = self._transform_once(original, file_to_handle)
+        output_file_path = self._init_file(file_to_handle)
+        # Matches may be replaced with themselves
+        if content != original:
+            self._write_final_content(content, output_file_path)
+        return output_file_path
+
+    def transform(self, content):
+        """Replace within a string, or bytes, rather than within a file
+
+        `must_include` is checked just as it is for files. Returns a tuple
+        of the transformed content and a dict of stats: the number of unique
+        `matches` found and of `replacements` made.
+        """
+        content, matches, replacements = \
+            self._transform(content, '<content>')
+        return content, {'matches': len(matches),
+                         'replacements': replacements}
+
+    def transform_stream(self, reader, writer):
+        """Replace within the content read from the file-like `reader` and
+        write the result to the file-like `writer`
+
+        All of the content is read before any of it is written, as a string
+        matched anywhere in it is replaced everywhere in it. Bytes beyond
+        the first `_CHUNK_SIZE` are spilled to a temp file, which is then
+        mapped and replaced within as a file would be (see
+        `_handle_mapped_file`), so that memory use is bounded. Text is held
+        in memory.
+
+        If the path declares a `record_separator` (or `line_mode`), text is
+        spilled as well, and the content is scanned and replaced within a
+        block of whole records at a time instead (see `_scan_blocks`),
+        which gives the same output. Returns the same stats as `transform`.
+        """
+        if not self._in_blocks():
+            return self._transform_whole_stream(reader, writer)
+
+        content = reader.read(_CHUNK_SIZE)
+        is_text = isinstance(content, str)
+        with tempfile.SpooledTemporaryFile(
+                max_size=_CHUNK_SIZE,
+                mode='w+' if is_text else 'w+b',
+                newline='' if is_text else None) as spool:
+            spool.write(content)
+            del content
+            shutil.copyfileobj(reader, spool)
+            spool.seek(0)
+            scanned = self._scan_blocks(spool, '<stream>')
+            spool.seek(0)
+            if scanned is None:
+                return self._transform_whole_stream(spool, writer)
+            matches, replacements = scanned
+            _write_replaced_blocks(
+                spool, replacements, self.record_separator, writer)
+        return {'matches': len(matches), 'replacements': len(replacements)}
+
+    def _transform_whole_stream(self, reader, writer):
+        """Replace within all of the content read from `reader` at once
+        """
+        content = reader.read(_CHUNK_SIZE)
+        if isinstance(content, str):
+            content += reader.read()
+        rest = None if isinstance(content, str) else reader.read(1)
+        if not rest:
+            content, stats = self.transform(content)
+            writer.write(content)
+            return stats
+
+        logger.debug('Spilling the stream to a temp file...')
+        with tempfile.NamedTemporaryFile() as spool:
+            spool.write(content)
+            spool.write(rest)
+            del content
+            shutil.copyfileobj(reader, spool)
+            spool.flush()
+            # The spool is named so that a regex worker can map it too
+            with _mapped(spool.name) as mapped:
+                matches, replacements = \
+                    self._mapped_replacements(mapped, spool.name)
+                _write_replaced(mapped, replacements, writer)
+        return {'matches': len(matches), 'replacements': len(replacements)}
+
+    def _transform_once(self, content, source):
+        """Return `_transform(content, source)`, reusing the result for
+        content which was transformed before if `dedupe_content` is set
+        """
+        if not self.dedupe_content:
+            return self._transform(content, source)
+        digest = hashlib.sha256(
+            content.encode('utf-8', 'surrogateescape')).digest()
+        with self._transformed_lock:
+            result = self._transformed.get(digest)
+        if result is not None:
+            logger.info('%s has the same content as a file handled before',
+                        source)
+            return result
+        result = self._transform(content, source)
+        with self._transformed_lock:
+            if len(self._transformed) >= _DEDUPE_CACHE_SIZE:
+                del self._transformed[next(iter(self._transformed))]
+            self._transformed[digest] = result
+        return result
+
+    def _in_blocks(self):
+        """Return True if content can be handled a block of whole records
+        at a time
+        """
+        patterns = [self.match_regex] + list(self.must_include)
+        return bool(self.record_separator) and not any(
+            _CONTEXT_DEPENDENT.search(pattern) for pattern in patterns)
 
-        if self.must_include and not \
-                self.validate_before(content, file_to_handle):
+    def _transform(self, content, source, validate=True):
+        """Return a tuple of the transformed content, the unique matches
+        found and the number of them which were replaced
+        """
+        if validate and self.must_include and \
+                not self.validate_before(content, source):
             raise RepexError(ERRORS['prevalidation_failed'])
 
-        replacements_found = False
-        output_file_path = self._init_file(file_to_handle)
-        matches = self.find_matches(content, file_to_handle)
+        replacements = 0
+        matches = self.find_matches(content, source)
         logger.info(
             'Replacing all strings that match %s and are contained in '
             '%s with %s...', self.pattern_to_replace, self.match_regex,
             self.replace_with)
         for match in matches:
             if self.is_in_string(match):
-                replacements_found = True
+                replacements += 1
                 content = self.replace(match, content)
-        if not replacements_found:
+        if not replacements:
             logger.info('Found nothing to replace within matches')
-        if matches:
-            self._write_final_content(content, output_file_path)
-        else:
-            os.remove(output_file_path + '.repex.tmp')
-        return output_file_path
+        return content, matches, replacements
 
     def validate_before(self, content, file_to_handle):
         """Verify that all required strings are in the file
         """
         logger.debug('Looking for required strings: %s', self.must_include)
+        found = self._run_regex(
+            _search_required, self._required_expressions_for(content),
+            content, file_to_handle)
         included = True
-        for string in self.must_include:
-            if not re.search(r'{0}'.format(string), content):
+        for string, string_found in zip(self.must_include, found):
+            # Strings after the first one not found are not looked for
+            if string_found is False:
                 logger.error('Required string `%s` not found in %s',
                              string, file_to_handle)
                 included = False
@@ -605,53 +2140,1569 @@ class Repex(object):
     def find_matches(self, content, file_to_handle):
         """Find all matches of an expression in a file
         """
-        # look for all match groups in the content
-        groups = [match.groupdict() for match in
-                  self.match_expression.finditer(content)]
-        # filter out content not in the matchgroup
-        matches = [group['matchgroup'] for group in groups
-                   if group.get('matchgroup')]
+        match_expression, _, _ = self._expressions_for(content)
+        matches = self._run_regex(
+            _find_all, match_expression, content, file_to_handle)
 
         logger.info('Found %s matches in %s', len(matches), file_to_handle)
         # We only need the unique strings found as we'll be replacing each
         # of them. No need to replace the ones already replaced.
-        return list(set(matches))
+        # They are kept in the order they were found in so that replacing
+        # them one after the other always produces the same content.
+        return _unique(matches)
+
+    def _run_regex(self, function, patterns, content, file_to_handle):
+        """Return `function(patterns, content)`, run in a separate process
+        which is killed if it takes longer than `regex_timeout`
+        """
+        if self.regex_timeout is None or self.engine == 're2':
+            # re2 runs in linear time
+            return function(patterns, content)
+        if self.engine == 'regex':
+            # regex supports timeouts of its own
+            try:
+                return function(patterns, content,
+                                timeout=self.regex_timeout)
+            except TimeoutError:
+                raise self._timeout_error(file_to_handle)
+        if isinstance(content, mmap.mmap):
+            # The worker maps the file itself rather than receive its content
+            arguments = (patterns, None, file_to_handle)
+        else:
+            arguments = (patterns, content)
+        try:
+            return _get_regex_worker().run(
+                function, arguments, self.regex_timeout)
+        except _RegexTimeout:
+            raise self._timeout_error(file_to_handle)
+
+    def _timeout_error(self, file_to_handle):
+        return RepexError(
+            '{0}: scanning {1} for path `{2}` took more than {3} seconds. '
+            'Pattern: {4}'.format(
+                ERRORS['regex_timeout'], file_to_handle,
+                self.description or self.match_regex,
+                self.regex_timeout, self.match_regex))
 
     def is_in_string(self, match):
-        return True if self.replace_expression.search(match) else False
+        _, replace_expression, _ = self._expressions_for(match)
+        return True if replace_expression.search(match) else False
 
     def replace(self, match, content):
         """Replace all occurences of the regex in all matches
         from a file with a specific value.
         """
-        new_string = self.replace_expression.sub(self.replace_with, match)
+        new_string = self._replacement_for(match)
         logger.info('Replacing: [ %s ] --> [ %s ]', match, new_string)
         new_content = content.replace(match, new_string)
         return new_content
 
-    def _init_file(self, file_to_handle):
-        temp_file_path = file_to_handle + '.repex.tmp'
-        output_file_path = self.to_file if self.to_file else file_to_handle
-        if not self.to_file:
-            shutil.copy2(output_file_path, temp_file_path)
-        return output_file_path
+    def _replacement_for(self, match):
+        _, replace_expression, replace_with = self._expressions_for(match)
+        return replace_expression.sub(replace_with, match)
 
-    def _write_final_content(self, content, output_file_path):
-        temp_file_path = output_file_path + '.repex.tmp'
-        if self.to_file:
-            logger.info('Writing output to %s...', output_file_path)
-        else:
-            logger.debug('Writing output to %s...', output_file_path)
-        with open(temp_file_path, "w") as temp_file:
+    def _expressions_for(self, content):
+        """Return the match and replace expressions and the replacement
+        value of the same type as `content`
+
+        Mapped files are matched as bytes, so the expressions are compiled
+        again, UTF-8 encoded, the first time they are needed for bytes.
+        """
+        if isinstance(content, str):
+            return \
+                self.match_expression, self.replace_expression, \
+                self.replace_with
+        if self._bytes_expressions is None:
+            self._bytes_expressions = (
+                _compile(self.match_expression.pattern.encode('utf-8'),
+                         self.engine),
+                _compile(self.replace_expression.pattern.encode('utf-8'),
+                         self.engine),
+                self.replace_with.encode('utf-8'))
+        return self._bytes_expressions
+
+    def _maps_as_text(self, content):
+        """Return True if matching the bytes of a mapped file gives the
+        same results as matching the text it is read as
+
+        Text is read with universal newlines, and some expressions (e.g.
+        `\\s`, `\\w` and `.`) match differently in text than in bytes once
+        either the file or the patterns are not ASCII.
+        """
+        patterns = [self.match_regex, self.pattern_to_replace,
+                    self.replace_with] + list(self.must_include)
+        return os.linesep == '\n' and \
+            all(pattern.isascii() for pattern in patterns) and \
+            not _NOT_MAPPABLE.search(content)
+
+    def _required_expressions_for(self, content):
+        """Return a (combined, expressions) tuple of the compiled
+        `must_include` patterns of the same type as `content`
+
+        See `_search_required`.
+        """
+        content_type = str if isinstance(content, str) else bytes
+        if content_type not in self._required_expressions:
+            patterns = self.must_include
+            if content_type is bytes:
+                patterns = [pattern.encode('utf-8') for pattern in patterns]
+            self._required_expressions[content_type] = (
+                _combine_required(self.must_include, self.engine,
+                                  content_type is bytes),
+                [_compile(pattern, self.engine) for pattern in patterns])
+        return self._required_expressions[content_type]
+
+    def _find_patches(self, content, file_to_handle):
+        """Return the (offset, original, replacement) byte ranges to
+        overwrite in a mapped file, sorted by offset
+
+        None is returned if a replacement would change the length of its
+        match or if the ranges overlap, as the file must then be rewritten.
+        """
+        patches = []
+        for match in self.find_matches(content, file_to_handle):
+            if not self.is_in_string(match):
+                continue
+            new_string = self._replacement_for(match)
+            if len(new_string) != len(match):
+                logger.debug('Replacing [ %s ] changes its length', match)
+                return None
+            if new_string == match:
+                continue
+            logger.info('Replacing: [ %s ] --> [ %s ]', match, new_string)
+            # Only the bytes which actually differ are overwritten
+            start = 0
+            while match[start] == new_string[start]:
+                start += 1
+            end = len(match)
+            while match[end - 1] == new_string[end - 1]:
+                end -= 1
+            offset = content.find(match)
+            while offset != -1:
+                patches.append((offset + start,
+                                match[start:end],
+                                new_string[start:end]))
+                offset = content.find(match, offset + len(match))
+        patches.sort()
+        for previous, current in zip(patches, patches[1:]):
+            if previous[0] + len(previous[1]) > current[0]:
+                logger.debug('Replacements overlap at offset %s', current[0])
+                return None
+        return patches
+
+    def _patch_in_place(self, file_to_handle):
+        """Overwrite only the replaced byte ranges of a file
+
+        The original bytes are journaled before the file is touched so that
+        an interrupted run can be rolled back (see `_recover_journal`).
+        False is returned, and nothing is written, if the file has to be
+        rewritten instead, as it is when its bytes would not be matched as
+        its text would (see `_maps_as_text`).
+        """
+        if not hasattr(os, 'pwrite') or not os.path.getsize(file_to_handle):
+            return False
+        with open(file_to_handle, 'r+b') as f:
+            content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if not self._maps_as_text(content):
+                    logger.info('%s can\'t be patched as bytes. '
+                                'Rewriting it instead', file_to_handle)
+                    return False
+                if self.must_include and not \
+                        self.validate_before(content, file_to_handle):
+                    raise RepexError(ERRORS['prevalidation_failed'])
+                logger.info(
+                    'Replacing all strings that match %s and are contained '
+                    'in %s with %s...', self.pattern_to_replace,
+                    self.match_regex, self.replace_with)
+                patches = self._find_patches(content, file_to_handle)
+            finally:
+                content.close()
+            if patches is None:
+                logger.info('Replacements in %s change its length. '
+                            'Rewriting it instead', file_to_handle)
+                return False
+            if not patches:
+                logger.info('Found nothing to replace within matches')
+                return True
+
+            _write_journal(file_to_handle, patches)
+            logger.debug('Patching %s byte ranges in %s...',
+                         len(patches), file_to_handle)
+            self.throttle(sum(len(patch[2]) for patch in patches))
+            for offset, _, new_bytes in patches:
+                os.pwrite(f.fileno(), new_bytes, offset)
+            os.fsync(f.fileno())
+            self._changed()
+        os.remove(file_to_handle + _JOURNAL_FILE_SUFFIX)
+        return True
+
+    def _handle_chunked_file(self, file_to_handle):
+        """Replace within a file split into chunks of whole records, each
+        of which is handled in a separate process
+
+        The matches are first collected from all chunks and then replaced,
+        in the order they were found in, within all chunks, which produces
+        the same content as replacing within the whole file would. None is
+        returned, without writing anything, if a match spans records.
+        """
+        patterns = [self.match_regex] + list(self.must_include)
+        if any(_CONTEXT_DEPENDENT.search(pattern) for pattern in patterns):
+            logger.info('Patterns for %s contain anchors or lookarounds. '
+                        'Handling it as a whole instead', file_to_handle)
+            return None
+        chunks = _split_records(file_to_handle, self.record_separator)
+        logger.info('Handling %s in %s chunks...', file_to_handle, len(chunks))
+        import concurrent.futures
+
+        workers = min(len(chunks), os.cpu_count() or 1)
+        count = len(chunks)
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            scans = list(executor.map(
+                _scan_chunk, [file_to_handle] * count, chunks,
+                [self.match_expression.pattern] * count,
+                [self.must_include] * count,
+                [self.engine] * count))
+
+            matches = _unique(
+                match for chunk_matches, _ in scans for match in chunk_matches)
+            logger.info('Found %s matches in %s', len(matches), file_to_handle)
+            if any(character in match for match in matches
+                   for character in self.record_separator):
+                logger.info('Matches in %s span records. Handling it as a '
+                            'whole instead', file_to_handle)
+                return None
+            included = set().union(*(found for _, found in scans))
+            missing = [string for string in self.must_include
+                       if string not in included]
+            for string in missing:
+                logger.error('Required string `%s` not found in %s',
+                             string, file_to_handle)
+            if missing:
+                raise RepexError(ERRORS['prevalidation_failed'])
+
+            logger.info(
+                'Replacing all strings that match %s and are contained in '
+                '%s with %s...', self.pattern_to_replace, self.match_regex,
+                self.replace_with)
+            replacements = []
+            for match in matches:
+                if self.is_in_string(match):
+                    new_string = self._replacement_for(match)
+                    logger.info('Replacing: [ %s ] --> [ %s ]',
+                                match, new_string)
+                    replacements.append((match, new_string))
+            if not replacements:
+                logger.info('Found nothing to replace within matches')
+            output_file_path = \
+                self.to_file if self.to_file else file_to_handle
+            if not _changes(replacements):
+                return output_file_path
+
+            temp_file_path = _temp_path(output_file_path)
+            logger.debug('Writing output to %s...', output_file_path)
+            with open(temp_file_path, 'wb') as temp_file:
+                for data in executor.map(
+                        _replace_chunk, [file_to_handle] * count, chunks,
+                        [replacements] * count):
+                    temp_file.write(data)
+        if not self.to_file:
+            shutil.copystat(file_to_handle, temp_file_path)
+        self._commit(temp_file_path, output_file_path)
+        return output_file_path
+
+    def _handle_mapped_file(self, file_to_handle):
+        """Replace within a file without reading it into memory
+
+        The file is mapped and matched as bytes, so that only the matches
+        are copied out of it, and the output is written from slices of the
+        mapped file between the replacements. None is returned, and
+        nothing is written, if matching the bytes of the file could give a
+        different result than matching its text, as the file must then be
+        read instead.
+        """
+        output_file_path = self.to_file if self.to_file else file_to_handle
+        with _mapped(file_to_handle) as content:
+            if not self._maps_as_text(content):
+                logger.info('%s can not be matched as bytes. '
+                            'Reading it instead', file_to_handle)
+                return None
+            _, replacements = \
+                self._mapped_replacements(content, file_to_handle)
+            if not _changes(replacements.items()):
+                return output_file_path
+
+            temp_file_path = _temp_path(output_file_path)
+            logger.debug('Writing output to %s...', output_file_path)
+            with open(temp_file_path, 'wb') as temp_file:
+                _write_replaced(content, replacements, temp_file,
+                                os.path.dirname(temp_file_path))
+        if not self.to_file:
+            shutil.copystat(file_to_handle, temp_file_path)
+        self._commit(temp_file_path, output_file_path)
+        return output_file_path
+
+    def _mapped_replacements(self, content, source):
+        """Return the unique matches found in mapped content and a dict of
+        the replacement of each of them which is replaced, in order
+        """
+        if self.must_include and not self.validate_before(content, source):
+            raise RepexError(ERRORS['prevalidation_failed'])
+
+        matches = self.find_matches(content, source)
+        return matches, self._replacements_for(matches)
+
+    def _replacements_for(self, matches):
+        """Return a dict of the replacement of each of `matches` which is
+        replaced, in order
+        """
+        logger.info(
+            'Replacing all strings that match %s and are contained in '
+            '%s with %s...', self.pattern_to_replace, self.match_regex,
+            self.replace_with)
+        replacements = {}
+        for match in matches:
+            if self.is_in_string(match):
+                replacements[match] = self._replacement_for(match)
+                logger.info('Replacing: [ %s ] --> [ %s ]',
+                            match, replacements[match])
+        if not replacements:
+            logger.info('Found nothing to replace within matches')
+        return replacements
+
+    def _scan_blocks(self, reader, source):
+        """Return the unique matches found in the blocks of whole records
+        read from `reader` and a dict of the replacement of each of them
+        which is replaced, in order
+
+        Replacing all of them within each block produces the same content
+        as replacing within the whole content would, unless a match spans
+        records, in which case None is returned instead.
+        """
+        matches = []
+        missing = list(range(len(self.must_include)))
+        for block in _read_records(reader, self.record_separator):
+            if missing:
+                _, expressions = self._required_expressions_for(block)
+                missing = [index for index in missing
+                           if not expressions[index].search(block)]
+            matches.extend(self.find_matches(block, source))
+        for index in missing:
+            logger.error('Required string `%s` not found in %s',
+                         self.must_include[index], source)
+        if missing:
+            raise RepexError(ERRORS['prevalidation_failed'])
+        matches = _unique(matches)
+        separator = self.record_separator
+        if matches and not isinstance(matches[0], str):
+            separator = separator.encode('utf-8')
+        if any(character in match for match in matches
+               for character in separator):
+            logger.info('Matches in %s span records. Handling it as a '
+                        'whole instead', source)
+            return None
+        return matches, self._replacements_for(matches)
+
+    def _handle_archive(self, file_to_handle):
+        """Replace within the members of a tar or zip archive whose names
+        match `archive_member`
+
+        Matching members are read and replaced in memory. The archive is
+        only rewritten if any of them changed, in which case all members
+        are streamed into the new archive, the unchanged ones as they are.
+        """
+        member_expression = _compile(self.archive_member, self.engine)
+        changed = {}
+        for name, content in _archive_members(
+                file_to_handle, member_expression):
+            new_content, _, _ = self._transform(
+                content, '{0}:{1}'.format(file_to_handle, name))
+            if new_content != content:
+                changed[name] = new_content.encode('utf-8')
+
+        output_file_path = self.to_file if self.to_file else file_to_handle
+        if not changed:
+            logger.info('Nothing to replace in %s', file_to_handle)
+            return output_file_path
+
+        temp_file_path = _temp_path(output_file_path)
+        logger.debug('Rewriting %s members of %s...',
+                     len(changed), file_to_handle)
+        _rewrite_archive(file_to_handle, temp_file_path, changed)
+        if not self.to_file:
+            shutil.copystat(file_to_handle, temp_file_path)
+        self._commit(temp_file_path, output_file_path)
+        return output_file_path
+
+    def _handle_compressed_file(self, file_to_handle, compression):
+        """Replace within a compressed file, which is decompressed and
+        recompressed while it is being written
+
+        The file is decompressed once, to a temp file, so that it is never
+        held in memory. It is then scanned for matches and `must_include`
+        strings, a block of whole records at a time if the path declares a
+        `record_separator`, and replaced within a block at a time too (see
+        `_scan_blocks`). Otherwise, it is mapped and replaced within as a
+        file would be (see `_handle_mapped_file`). Files in which nothing
+        matches are never recompressed.
+        """
+        output_file_path = self.to_file if self.to_file else file_to_handle
+        directory, name = os.path.split(output_file_path)
+        with tempfile.NamedTemporaryFile(
+                prefix=name + '.', suffix=_TEMP_FILE_SUFFIX,
+                dir=directory or None) as spool:
+            with _codec(compression).open(file_to_handle, 'rb') as reader:
+                shutil.copyfileobj(reader, spool)
+            spool.flush()
+            scanned = None
+            if self._in_blocks():
+                spool.seek(0)
+                scanned = self._scan_blocks(spool, file_to_handle)
+            if scanned is None:
+                return self._handle_whole_compressed_file(
+                    file_to_handle, compression, output_file_path, spool)
+            _, replacements = scanned
+            if not _changes(replacements.items()):
+                logger.info('Nothing to replace in %s', file_to_handle)
+                return output_file_path
+            spool.seek(0)
+            temp_file_path = self._recompress(
+                file_to_handle, compression, output_file_path,
+                lambda writer: _write_replaced_blocks(
+                    spool, replacements, self.record_separator, writer))
+        if not self.to_file:
+            shutil.copystat(file_to_handle, temp_file_path)
+        self._commit(temp_file_path, output_file_path)
+        return output_file_path
+
+    def _recompress(self, file_to_handle, compression, output_file_path,
+                    write):
+        """Return the path of a temp file for `output_file_path` which
+        `write` wrote the content of the compressed file to
+        """
+        temp_file_path = _temp_path(output_file_path)
+        logger.debug('Recompressing %s with %s...',
+                     file_to_handle, compression)
+        try:
+            with _compressed_writer(temp_file_path, compression,
+                                    file_to_handle) as writer:
+                write(writer)
+        except BaseException:
+            os.remove(temp_file_path)
+            raise
+        return temp_file_path
+
+    def _handle_whole_compressed_file(self,
+                                      file_to_handle,
+                                      compression,
+                                      output_file_path,
+                                      spool):
+        """Replace within a compressed file, decompressed to `spool`, as
+        a whole
+        """
+        if not os.path.getsize(spool.name):
+            # Empty files can't be mapped
+            if self.must_include and \
+                    not self.validate_before(b'', file_to_handle):
+                raise RepexError(ERRORS['prevalidation_failed'])
+            logger.info('Nothing to replace in %s', file_to_handle)
+            return output_file_path
+        # The spool is named so that a regex worker can map it too
+        with _mapped(spool.name) as content:
+            _, replacements = self._mapped_replacements(content, spool.name)
+            if not _changes(replacements.items()):
+                logger.info('Nothing to replace in %s', file_to_handle)
+                return output_file_path
+            temp_file_path = self._recompress(
+                file_to_handle, compression, output_file_path,
+                lambda writer: _write_replaced(
+                    content, replacements, writer,
+                    os.path.dirname(output_file_path) or None))
+        if not self.to_file:
+            shutil.copystat(file_to_handle, temp_file_path)
+        self._commit(temp_file_path, output_file_path)
+        return output_file_path
+
+    def _working_copy(self, file_to_handle):
+        """Return the path of a file's copy in `output_directory`, linking
+        it there first if it isn't yet, or that of the file itself if the
+        path does not declare an output directory
+        """
+        if not self.output_directory:
+            return file_to_handle
+        relative_path = os.path.relpath(
+            file_to_handle, self.base_directory or os.curdir)
+        if _is_outside(relative_path):
+            raise RepexError('{0}: {1}'.format(
+                ERRORS['outside_base_directory'], file_to_handle))
+        working_copy = os.path.join(self.output_directory, relative_path)
+        if not os.path.lexists(working_copy):
+            os.makedirs(os.path.dirname(working_copy), exist_ok=True)
+            _link_or_copy(file_to_handle, working_copy, self.throttle)
+        return working_copy
+
+    def _init_file(self, file_to_handle):
+        return self.to_file if self.to_file else file_to_handle
+
+    def _write_final_content(self, content, output_file_path):
+        temp_file_path = _temp_path(output_file_path)
+        if self.to_file:
+            logger.info('Writing output to %s...', output_file_path)
+        else:
+            logger.debug('Writing output to %s...', output_file_path)
+        with open(temp_file_path, "w") as temp_file:
             temp_file.write(content)
-        shutil.move(temp_file_path, output_file_path)
+        if not self.to_file:
+            shutil.copystat(output_file_path, temp_file_path)
+        self._commit(temp_file_path, output_file_path)
+
+    def _commit(self, temp_file_path, output_file_path):
+        """Move a temp file over the output file
+
+        Files with more than one hard link are overwritten instead, so that
+        all of their links keep sharing the new content. Files in an output
+        directory may be hard links to the originals, so they are always
+        replaced. Nothing is written if the file being handled was changed
+        by a process which does not lock it since it was locked.
+
+        Within a transaction, the temp file is staged instead, and only
+        moved once the whole run succeeds.
+        """
+        self.throttle(os.path.getsize(temp_file_path))
+        expected = getattr(self._handling, 'expected', None)
+        if expected and expected[0] == output_file_path and \
+                _stat_key(output_file_path) != expected[1]:
+            os.remove(temp_file_path)
+            raise RepexError('{0}: {1}'.format(
+                ERRORS['file_changed'], output_file_path))
+        self._changed()
+        overwrite = not self.output_directory and \
+            os.path.isfile(output_file_path) and \
+            os.stat(output_file_path).st_nlink > 1
+        if _transaction is not None and \
+                not _transaction.is_staged(output_file_path):
+            _transaction.stage(temp_file_path, output_file_path, overwrite)
+        elif overwrite:
+            logger.debug('%s has other hard links. Overwriting it...',
+                         output_file_path)
+            _overwrite(temp_file_path, output_file_path)
+        else:
+            shutil.move(temp_file_path, output_file_path)
+
+    def _changed(self):
+        """Record that the file being handled was changed
+        """
+        self._handling.changed = True
+        if _progress is not None:
+            _progress.file_changed()
+
+
+# Bytes which are matched differently in text than in bytes, or which
+# are not read as they are when reading text (see `Repex._maps_as_text`)
+_NOT_MAPPABLE = re.compile(rb'[\r\x1c-\x1f\x80-\xff]')
+
+
+# Anchors and lookarounds may match differently at the edges of a chunk
+# or of a file in a batch than within the whole file.
+_CONTEXT_DEPENDENT = re.compile(r'[\^$]|\\[AZbB]|\(\?<?[=!]')
+
+
+def _changes(replacements):
+    """Return True if replacing each of the (match, replacement) pairs of
+    `replacements` changes anything, as matches may be replaced with
+    themselves
+    """
+    return any(match != new_string for match, new_string in replacements)
+
+
+def _unique(items):
+    """Return the unique items in the order they were first found in
+    """
+    return list(dict.fromkeys(items))
+
+
+def _split_records(path, separator, chunk_size=None):
+    """Return the (start, end) offsets of chunks of a file of roughly
+    `chunk_size` bytes which end with a record separator
+    """
+    chunk_size = chunk_size or _CHUNK_SIZE
+    # The separator is encoded the same way the file's content is decoded
+    # when it is read.
+    separator = separator.encode(io.TextIOWrapper(io.BytesIO()).encoding)
+    chunks = []
+    with _mapped(path) as content:
+        start = 0
+        while start < len(content):
+            end = content.find(separator, start + chunk_size)
+            while end != -1 and content[end + len(separator) - 1:
+                                        end + len(separator) + 1] == b'\r\n':
+                # Never split a line ending, which is translated as a whole
+                end = content.find(separator, end + 1)
+            end = len(content) if end == -1 else end + len(separator)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def _read_records(reader, separator, block_size=None):
+    """Yield blocks of whole records, of roughly `block_size`, read from
+    the file-like `reader`
+    """
+    block_size = block_size or _CHUNK_SIZE
+    pending = []
+    while True:
+        data = reader.read(block_size)
+        if not data:
+            break
+        if not isinstance(data, str) and isinstance(separator, str):
+            separator = separator.encode('utf-8')
+        end = data.rfind(separator)
+        if end == -1:
+            pending.append(data)
+            continue
+        end += len(separator)
+        yield data[:0].join(pending + [data[:end]])
+        pending = [data[end:]]
+    if any(pending):
+        yield pending[0][:0].join(pending)
+
+
+def _read_chunk(path, chunk):
+    start, end = chunk
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # Decoding through a text wrapper translates newlines and uses the same
+    # encoding as reading the whole file would.
+    return io.TextIOWrapper(io.BytesIO(data)).read()
+
+
+def _scan_chunk(path, chunk, match_pattern, must_include, engine=None):
+    """Return the unique matches in a chunk of a file and the required
+    strings found in it
+    """
+    content = _read_chunk(path, chunk)
+    matches = _find_all(_compile(match_pattern, engine), content)
+    found = [string for string in must_include
+             if _compile(string, engine).search(content)]
+    return _unique(match for match in matches if match), found
+
+
+def _write_replaced_blocks(reader, replacements, separator, writer):
+    """Write the blocks of whole records read from `reader` to `writer`
+    after replacing each of `replacements` within each of them, one after
+    the other (see `Repex._scan_blocks`)
+    """
+    for block in _read_records(reader, separator):
+        for match, new_string in replacements.items():
+            block = block.replace(match, new_string)
+        writer.write(block)
+
+
+def _replace_chunk(path, chunk, replacements):
+    """Return the encoded content of a chunk of a file after replacing
+    each of `replacements` within it one after the other
+    """
+    content = _read_chunk(path, chunk)
+    for match, new_string in replacements:
+        content = content.replace(match, new_string)
+    output = io.BytesIO()
+    with io.TextIOWrapper(output) as text_output:
+        text_output.write(content)
+        text_output.flush()
+        return output.getvalue()
+
+
+def _find_all(match_expression, content, path=None, **kwargs):
+    """Return the non-empty match groups of all matches of an expression
+    in `content`, or in the mapped file at `path`
+    """
+    if path:
+        with _mapped(path) as content:
+            return _find_all(match_expression, content, **kwargs)
+    # look for all match groups in the content. The match group wraps
+    # the whole expression so it is always the first group.
+    groups = [match.group(1) for match in
+              match_expression.finditer(content, **kwargs)]
+    # filter out content not in the matchgroup
+    return [group for group in groups if group]
+
+
+# Backreferences are renumbered and inline flags apply to all alternatives
+# when patterns are combined.
+_UNCOMBINABLE = re.compile(r'\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)')
+
+
+def _combine_required(patterns, engine=None, as_bytes=False):
+    """Return a single expression matching wherever any of `patterns`
+    matches, with the index of the pattern as the name of the group which
+    matched, or None if the patterns can't be combined
+    """
+    if len(patterns) < 2 or \
+            any(_UNCOMBINABLE.search(pattern) for pattern in patterns):
+        return None
+    # re2 does not support lookaheads, in which case a match of a pattern
+    # consumes the content any other pattern might have matched.
+    template = '(?P<_required{0}>{1})' if engine == 're2' \
+        else '(?=(?P<_required{0}>{1}))'
+    combined = '|'.join(template.format(index, pattern)
+                        for index, pattern in enumerate(patterns))
+    try:
+        return _compile(
+            combined.encode('utf-8') if as_bytes else combined, engine)
+    except RepexError:
+        return None
+
+
+def _search_required(expressions, content, path=None, **kwargs):
+    """Return whether each of the required `expressions` is found in
+    `content`, or in the mapped file at `path`
+
+    `expressions` is a (combined, expressions) tuple. All expressions are
+    first looked for in a single scan using the combined expression, which
+    stops as soon as all of them are found. An expression might not be
+    found by that scan if another one matched wherever it does, so those
+    not found are then looked for one by one until one is not found. None
+    is returned for the expressions which were not looked for.
+    """
+    if path:
+        with _mapped(path) as content:
+            return _search_required(expressions, content, **kwargs)
+    combined, expressions = expressions
+    found = [None] * len(expressions)
+    remaining = len(expressions)
+    if combined is not None:
+        for hit in combined.finditer(content, **kwargs):
+            index = int(hit.lastgroup[len('_required'):])
+            if not found[index]:
+                found[index] = True
+                remaining -= 1
+                if not remaining:
+                    return found
+    for index, expression in enumerate(expressions):
+        if not found[index]:
+            found[index] = bool(expression.search(content, **kwargs))
+            if not found[index]:
+                break
+    return found
+
+
+class _RegexTimeout(Exception):
+    pass
+
+
+class _RegexWorker(object):
+    """A process to run regular expressions in, so that they can be
+    stopped if they take too long
+    """
+    def __init__(self):
+        import multiprocessing
+
+        self._connection, child_connection = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=self._serve, args=(child_connection,), daemon=True)
+        self._process.start()
+        child_connection.close()
+
+    @staticmethod
+    def _serve(connection):
+        while True:
+            try:
+                function, arguments = connection.recv()
+            except EOFError:
+                return
+            try:
+                connection.send((True, function(*arguments)))
+            except Exception as ex:
+                connection.send((False, ex))
+
+    def is_alive(self):
+        return self._process.is_alive()
+
+    def run(self, function, arguments, timeout):
+        """Return `function(*arguments)` as run by the worker
+
+        If it does not return within `timeout` seconds, the worker is killed
+        and `_RegexTimeout` is raised.
+        """
+        self._connection.send((function, arguments))
+        if not self._connection.poll(timeout):
+            self.close()
+            raise _RegexTimeout()
+        succeeded, result = self._connection.recv()
+        if not succeeded:
+            raise result
+        return result
+
+    def close(self):
+        self._process.kill()
+        self._process.join()
+        self._connection.close()
+
+
+# Each thread (see `async_iterate`) gets a worker of its own
+_regex_workers = threading.local()
+
+
+def _get_regex_worker():
+    worker = getattr(_regex_workers, 'worker', None)
+    if worker is None or not worker.is_alive():
+        worker = _regex_workers.worker = _RegexWorker()
+    return worker
+
+
+class _LiteralRepex(Repex):
+    """Replace each of several literal strings with its own replacement
+
+    See `_combine_literal_paths`.
+    """
+    def __init__(self, pathobj):
+        super(_LiteralRepex, self).__init__(pathobj)
+        self.literals = pathobj['_literals']
+
+    def _replacement_for(self, match):
+        if isinstance(match, str):
+            return self.literals[match]
+        return self.literals[match.decode('utf-8')].encode('utf-8')
+
+
+@contextlib.contextmanager
+def _mapped(path):
+    """Map a file read-only for the duration of the context
+    """
+    with open(path, 'rb') as f:
+        content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield content
+        finally:
+            content.close()
+
+
+def _write_replaced(content, replacements, output, directory=None):
+    """Write `content` to `output` with every occurrence of each key of
+    `replacements` replaced by its value, one key after the other, as
+    `Repex.replace` does
+
+    Replacing a key may add or remove occurrences of the keys after it, so
+    each key is replaced in a pass of its own over the result of the
+    previous one, which is kept in a temp file in `directory` rather than
+    in memory.
+    """
+    replacements = list(replacements.items())
+    if not replacements:
+        output.write(content)
+        return
+    *passes, (last_match, last_replacement) = replacements
+    with contextlib.ExitStack() as stack:
+        for match, replacement in passes:
+            temp_file = stack.enter_context(
+                tempfile.TemporaryFile(dir=directory))
+            _replace_occurrences(content, match, replacement, temp_file)
+            temp_file.flush()
+            if not temp_file.tell():
+                content = b''
+                continue
+            content = stack.enter_context(contextlib.closing(mmap.mmap(
+                temp_file.fileno(), 0, access=mmap.ACCESS_READ)))
+        _replace_occurrences(content, last_match, last_replacement, output)
+
+
+def _replace_occurrences(content, match, replacement, output):
+    """Write `content` to `output` with all occurrences of `match`
+    replaced, as `bytes.replace` would, writing the content between them
+    without copying it
+    """
+    with memoryview(content) as view:
+        if not match:
+            # An empty match occurs before each byte and at the end
+            for index in range(len(view)):
+                output.write(replacement)
+                output.write(view[index:index + 1])
+            output.write(replacement)
+            return
+        position = 0
+        occurrence = content.find(match)
+        while occurrence != -1:
+            output.write(view[position:occurrence])
+            output.write(replacement)
+            position = occurrence + len(match)
+            occurrence = content.find(match, position)
+        output.write(view[position:])
+
+
+class _TokenBucket(object):
+    """Limit the rate at which some amount, e.g. of bytes, is taken to
+    `rate` per second, allowing bursts of up to a second's worth
+
+    Taking more than is available leaves the bucket in debt, which the
+    taker waits out, so that concurrent takers are each delayed by their
+    own share.
+    """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, amount):
+        if not self.rate or not amount:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.rate,
+                self._tokens + (now - self._updated) * self.rate) - amount
+            self._updated = now
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            logger.debug('Throttling for %.2f seconds...', wait)
+            time.sleep(wait)
+
+
+# The number of the `ioprio_set` system call on each machine
+_IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'riscv64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    's390x': 282,
+}
+# The lowest priority of the best-effort class, for the whole process
+_IOPRIO_LOWEST = (2 << 13) | 7
+_IOPRIO_WHO_PROCESS = 1
+
+
+def _lower_priority():
+    """Run the current process at the lowest CPU priority and, on Linux,
+    the lowest best-effort I/O priority
+    """
+    if hasattr(os, 'nice'):
+        logger.debug('Lowering CPU priority...')
+        os.nice(19)
+    syscall = _IOPRIO_SET.get(platform.machine())
+    if not sys.platform.startswith('linux') or syscall is None:
+        logger.warning('Lowering I/O priority is not supported on '
+                       'this platform')
+        return
+    import ctypes.util
+
+    logger.debug('Lowering I/O priority...')
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.syscall(syscall, _IOPRIO_WHO_PROCESS, 0, _IOPRIO_LOWEST) != 0:
+        logger.warning('Could not lower I/O priority: %s',
+                       os.strerror(ctypes.get_errno()))
+
+
+def _temp_path(path):
+    """Create an empty temp file next to `path` with a name unique to
+    this run and return its path
+    """
+    directory, name = os.path.split(path)
+    descriptor, temp_path = tempfile.mkstemp(
+        prefix=name + '.', suffix=_TEMP_FILE_SUFFIX, dir=directory or None)
+    os.close(descriptor)
+    # mkstemp creates files only their owner may read
+    os.chmod(temp_path, 0o666 & ~_UMASK)
+    return temp_path
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """Hold an exclusive advisory lock on a file for the duration of
+    the context
+
+    Other processes handling the same file wait for the lock to be
+    released. If the file was replaced while waiting for its lock, the
+    new file is locked instead. Files are not locked where `flock` is
+    not available.
+    """
+    if fcntl is None:
+        yield
+        return
+    while True:
+        locked_file = open(path, 'rb')
+        fcntl.flock(locked_file.fileno(), fcntl.LOCK_EX)
+        locked_stat = os.fstat(locked_file.fileno())
+        current_key = _stat_key(path)
+        if current_key and current_key[2] == locked_stat.st_ino:
+            break
+        locked_file.close()
+    try:
+        yield
+    finally:
+        locked_file.close()
+
+
+def _is_outside(relative_path):
+    return relative_path == os.pardir or \
+        relative_path.startswith(os.pardir + os.sep)
+
+
+def _link_or_copy(source, target, throttle=None):
+    """Make `target` a copy of `source` which takes (almost) no space
+
+    A reflink is made where the file system supports them, and a hard
+    link otherwise, before falling back to copying the file. Symlinks
+    are copied as symlinks. `throttle` is called with the amount of bytes
+    read and written if the file is copied.
+    """
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), target)
+        return
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as source_file, \
+                    open(target, 'wb') as target_file:
+                fcntl.ioctl(target_file.fileno(), _FICLONE,
+                            source_file.fileno())
+            shutil.copystat(source, target)
+            return
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        if throttle is not None:
+            throttle(2 * os.path.getsize(source))
+        shutil.copy2(source, target)
+
+
+def _mirror_tree(base_directory, output_directory, throttle=None):
+    """Link every file under `base_directory` into the same place under
+    `output_directory`, unless it is already there
+    """
+    base_directory = base_directory or os.curdir
+    logger.info('Mirroring %s to %s...', base_directory, output_directory)
+    output_root = os.path.abspath(output_directory)
+    linked = 0
+    for root, directories, files in os.walk(base_directory):
+        target_root = os.path.join(
+            output_directory, os.path.relpath(root, base_directory))
+        os.makedirs(target_root, exist_ok=True)
+        for directory in list(directories):
+            source = os.path.join(root, directory)
+            if os.path.abspath(source) == output_root:
+                directories.remove(directory)
+            elif os.path.islink(source):
+                # os.walk does not follow symlinks to directories
+                files.append(directory)
+        for filename in files:
+            target = os.path.join(target_root, filename)
+            if _is_temp_file(filename) or os.path.lexists(target):
+                continue
+            _link_or_copy(os.path.join(root, filename), target, throttle)
+            linked += 1
+    logger.debug('Linked %s files into %s', linked, output_directory)
+
+
+_COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+)
+
+
+def _codec(compression):
+    """Return the module which reads and writes a compression
+    """
+    return importlib.import_module(_CODECS[compression])
+
+
+def _detect_compression(path):
+    """Return the compression of a file, as one of `_CODECS`, judging by
+    its magic number, or None if it isn't compressed
+    """
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for magic, compression in _COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def _resolve_compression(path, compression):
+    """Return the compression of a file given that of its path object
+    """
+    detected = _detect_compression(path)
+    if compression == 'auto' or compression == detected:
+        return detected
+    raise RepexError('{0}: {1} ({2})'.format(
+        ERRORS['not_compressed'], path, compression))
+
+
+def _open_decompressed(path, compression=None):
+    """Open a file for reading bytes, decompressing it if `compression`
+    is set
+    """
+    if compression:
+        compression = _resolve_compression(path, compression)
+    if not compression:
+        return open(path, 'rb')
+    return _codec(compression).open(path, 'rb')
+
+
+def _gzip_header(path):
+    """Return the compression level, original file name and modification
+    time recorded in the header of a gzip file
+    """
+    with open(path, 'rb') as f:
+        header = f.read(10)
+        flags = header[3]
+        if flags & gzip.FEXTRA:
+            extra_length, = struct.unpack('<H', f.read(2))
+            f.read(extra_length)
+        name = b''
+        if flags & gzip.FNAME:
+            while True:
+                character = f.read(1)
+                if character in (b'', b'\0'):
+                    break
+                name += character
+    mtime, extra_flags = struct.unpack('<IB', header[4:9])
+    # Only the fastest and the best compression are flagged
+    level = {2: 9, 4: 1}.get(extra_flags, 6)
+    return level, name.decode('latin-1'), mtime
+
+
+@contextlib.contextmanager
+def _compressed_writer(path, compression, original):
+    """Open `path` for writing bytes compressed like the `original` file
+
+    gzip files keep their level, file name and modification time, bzip2
+    files their level and xz files their integrity check.
+    """
+    with open(original, 'rb') as f:
+        head = f.read(8)
+    with open(path, 'wb') as output:
+        if compression == 'gzip':
+            level, name, mtime = _gzip_header(original)
+            writer = gzip.GzipFile(filename=name,
+                                   mode='wb',
+                                   compresslevel=level,
+                                   fileobj=output,
+                                   mtime=mtime)
+        elif compression == 'bz2':
+            writer = bz2.BZ2File(output, 'wb', compresslevel=int(head[3:4]))
+        else:
+            import lzma
+
+            writer = lzma.LZMAFile(output, 'wb', check=head[7] & 0x0f)
+        with writer:
+            yield writer
+
+
+def _tar_compression(path):
+    """Return the compression of a tar archive as a `tarfile` mode suffix
+    """
+    compression = _detect_compression(path)
+    return {'gzip': 'gz'}.get(compression, compression or '')
+
+
+def _decode_member(content):
+    """Return the text of an archive member, or None if it is binary
+    """
+    if b'\0' in content[:_BINARY_SNIFF_SIZE]:
+        return None
+    try:
+        return content.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+
+def _archive_members(path, member_expression):
+    """Yield the name and text of each member of a tar or zip archive
+    whose name matches `member_expression`
+
+    Binary members are skipped.
+    """
+    import tarfile
+    import zipfile
+
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or \
+                        not member_expression.match(info.filename):
+                    continue
+                content = _decode_member(archive.read(info))
+                if content is None:
+                    logger.debug('Skipping binary member %s', info.filename)
+                    continue
+                yield info.filename, content
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path, 'r:*') as archive:
+            for member in archive:
+                if not member.isfile() or \
+                        not member_expression.match(member.name):
+                    continue
+                content = _decode_member(archive.extractfile(member).read())
+                if content is None:
+                    logger.debug('Skipping binary member %s', member.name)
+                    continue
+                yield member.name, content
+    else:
+        raise RepexError('{0}: {1}'.format(ERRORS['not_an_archive'], path))
+
+
+def _rewrite_archive(path, output, changed):
+    """Write a copy of the archive at `path` to `output` in which the
+    members named in `changed` have its content instead
+
+    Members are streamed one at a time, keeping their metadata, order,
+    compression and, for tar archives, the archive format.
+    """
+    import tarfile
+    import zipfile
+
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as source, \
+                zipfile.ZipFile(output, 'w') as target:
+            target.comment = source.comment
+            for info in source.infolist():
+                if info.filename in changed:
+                    target.writestr(info, changed[info.filename])
+                elif info.is_dir():
+                    target.writestr(info, b'')
+                else:
+                    with source.open(info) as member, target.open(
+                            info, 'w', force_zip64=info.file_size >
+                            zipfile.ZIP64_LIMIT) as copied:
+                        shutil.copyfileobj(member, copied)
+        return
+    with tarfile.open(path, 'r:*') as source, tarfile.open(
+            output, 'w:' + _tar_compression(path),
+            format=source.format) as target:
+        for member in source:
+            if member.name in changed:
+                content = changed[member.name]
+                member = copy.copy(member)
+                member.size = len(content)
+                member.pax_headers = dict(member.pax_headers)
+                member.pax_headers.pop('size', None)
+                target.addfile(member, io.BytesIO(content))
+            elif member.isfile():
+                target.addfile(member, source.extractfile(member))
+            else:
+                target.addfile(member)
+
+
+def _write_journal(file_to_handle, patches):
+    """Durably record the original bytes of the ranges about to be
+    overwritten in a file
+
+    The journal is written under a temporary name and renamed so that it
+    either exists in full or not at all.
+    """
+    journal_path = file_to_handle + _JOURNAL_FILE_SUFFIX
+    journal = {
+        'size': os.path.getsize(file_to_handle),
+        'patches': [[offset, old_bytes.hex(), new_bytes.hex()]
+                    for offset, old_bytes, new_bytes in patches]
+    }
+    with open(journal_path + _TEMP_FILE_SUFFIX, 'w') as journal_file:
+        json.dump(journal, journal_file)
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    os.replace(journal_path + _TEMP_FILE_SUFFIX, journal_path)
+
+
+def _recover_journal(file_to_handle):
+    """Roll back a file patched in place by an interrupted run
+
+    Any of the patches might have been written when the run was
+    interrupted, so all original byte ranges are restored. If the file was
+    changed since, i.e. its size differs or a range holds neither its
+    original nor its replaced bytes, the journal is discarded instead.
+    """
+    journal_path = file_to_handle + _JOURNAL_FILE_SUFFIX
+    if not os.path.isfile(journal_path):
+        return
+    with open(journal_path) as journal_file:
+        journal = json.load(journal_file)
+    patches = [(offset, bytes.fromhex(old_bytes), bytes.fromhex(new_bytes))
+               for offset, old_bytes, new_bytes in journal['patches']]
+    with open(file_to_handle, 'r+b') as f:
+        unchanged = os.fstat(f.fileno()).st_size == journal['size'] and \
+            all(os.pread(f.fileno(), len(old_bytes), offset)
+                in (old_bytes, new_bytes)
+                for offset, old_bytes, new_bytes in patches)
+        if unchanged:
+            logger.warning('Restoring %s from an interrupted in-place '
+                           'run...', file_to_handle)
+            for offset, old_bytes, _ in patches:
+                os.pwrite(f.fileno(), old_bytes, offset)
+            os.fsync(f.fileno())
+        else:
+            logger.warning('%s was changed since an in-place run was '
+                           'interrupted. Discarding its journal...',
+                           file_to_handle)
+    os.remove(journal_path)
+
+
+def _overwrite(source, target, sync=False):
+    """Copy the content of `source` into `target`, keeping the inode (and
+    therefore any other hard links) of `target`, and remove `source`
+    """
+    with open(source, 'rb') as source_file, \
+            open(target, 'r+b') as target_file:
+        shutil.copyfileobj(source_file, target_file)
+        target_file.truncate()
+        if sync:
+            target_file.flush()
+            os.fsync(target_file.fileno())
+    os.remove(source)
 
 
-def _validate_config_schema(config):
+def _fsync_file(path):
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_directory(path):
+    """Make the entries of a directory (e.g. renamed files) durable
+    """
+    # Directories can't be opened on Windows, where renames are durable
+    if os.name == 'nt':
+        return
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class _Transaction(object):
+    """The files staged by a transactional run
+
+    Each changed file is written to a staged temp file next to it, which
+    is handled instead of the file by later paths and validated in its
+    place. Once all paths are handled, the staged files are committed
+    together (see `commit`). If the run fails before that, they are
+    removed and no file is changed.
+    """
+    def __init__(self):
+        # The real path of each changed file -> (staged file, file,
+        # whether to overwrite the file, its `_stat_key` when staged)
+        self._entries = {}
+        self._targets = {}
+        self._lock = threading.Lock()
+
+    def staged(self, path):
+        entry = self._entries.get(os.path.realpath(path))
+        return entry[0] if entry else path
+
+    def target(self, path):
+        return self._targets.get(path, path)
+
+    def is_staged(self, path):
+        return path in self._targets
+
+    def stage(self, temp_file_path, output_file_path, overwrite):
+        key = os.path.realpath(output_file_path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                shutil.move(temp_file_path, entry[0])
+                return
+            logger.debug('Staging %s as %s...',
+                         output_file_path, temp_file_path)
+            self._entries[key] = (temp_file_path, output_file_path,
+                                  overwrite, _stat_key(output_file_path))
+            self._targets[temp_file_path] = output_file_path
+
+    def roll_back(self):
+        logger.info('Rolling back %s staged files...', len(self._entries))
+        for entry in self._entries.values():
+            if os.path.isfile(entry[0]):
+                os.remove(entry[0])
+        self._entries.clear()
+        self._targets.clear()
+
+    def commit(self):
+        """Move all staged files over the files they were staged for
+
+        Staged files and their directories are synced in a single pass
+        and a journal of the moves is durably written before any file is
+        moved, so that a commit interrupted midway is completed by the
+        next transactional run (see `_recover_transactions`). Nothing is
+        committed if any of the files was changed since it was staged.
+        """
+        entries = list(self._entries.values())
+        if not entries:
+            return
+        logger.info('Committing %s staged files...', len(entries))
+        try:
+            for staged, target, _, key in entries:
+                if _stat_key(target) != key:
+                    raise RepexError('{0}: {1}'.format(
+                        ERRORS['file_changed'], target))
+            for staged, _, _, _ in entries:
+                _fsync_file(staged)
+            for directory in _unique(
+                    os.path.dirname(os.path.abspath(entry[0]))
+                    for entry in entries):
+                _fsync_directory(directory)
+        except BaseException:
+            self.roll_back()
+            raise
+        # From here on, an interrupted commit is completed rather than
+        # rolled back, as the originals of moved files are gone
+        with _transaction_journal(entries) as journal_path:
+            _apply_transaction(entries)
+            os.remove(journal_path)
+        self._entries.clear()
+        self._targets.clear()
+
+
+@contextlib.contextmanager
+def _transaction_journal(entries):
+    """Durably write a journal of a transaction's moves and hold a lock
+    on it for the duration of the context
+
+    Journals are kept under `_TRANSACTIONS_HOME`, with absolute paths, so
+    that the next transactional run completes an interrupted commit
+    wherever it is started from.
+    """
+    os.makedirs(_TRANSACTIONS_HOME, exist_ok=True)
+    descriptor, temp_path = tempfile.mkstemp(
+        prefix='transaction-',
+        suffix=_JOURNAL_FILE_SUFFIX + _TEMP_FILE_SUFFIX,
+        dir=_TRANSACTIONS_HOME)
+    journal_path = temp_path[:-len(_TEMP_FILE_SUFFIX)]
+    with os.fdopen(descriptor, 'w') as journal_file:
+        json.dump([(os.path.abspath(staged), os.path.abspath(target),
+                    overwrite, key)
+                   for staged, target, overwrite, key in entries],
+                  journal_file)
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+        # The lock belongs to the file, so it is kept once it is renamed
+        if fcntl is not None:
+            fcntl.flock(journal_file.fileno(), fcntl.LOCK_EX)
+            os.replace(temp_path, journal_path)
+            _fsync_directory(_TRANSACTIONS_HOME)
+            yield journal_path
+            return
+    # Open files can't be renamed on Windows, where files aren't locked
+    os.replace(temp_path, journal_path)
+    _fsync_directory(_TRANSACTIONS_HOME)
+    yield journal_path
+
+
+def _apply_transaction(entries, recovering=False):
+    """Move staged files over the files they were staged for and sync
+    their directories
+
+    Entries whose staged file is gone were already moved. When recovering,
+    files which were changed since they were staged are left as they are.
+    Files which are overwritten can't be told apart from ones changed by
+    another process once overwriting them started, so they always are.
+    """
+    directories = []
+    for staged, target, overwrite, key in entries:
+        if not os.path.isfile(staged):
+            continue
+        if recovering and not overwrite and \
+                _stat_key(target) != (tuple(key) if key else None):
+            logger.warning('%s was changed since it was staged. '
+                           'Not overwriting it...', target)
+            os.remove(staged)
+            continue
+        if overwrite:
+            _overwrite(staged, target, sync=True)
+        else:
+            os.replace(staged, target)
+        directories.append(os.path.dirname(os.path.abspath(target)))
+    for directory in _unique(directories):
+        _fsync_directory(directory)
+
+
+def _recover_transactions():
+    """Complete the commits of transactional runs which were interrupted
+    while committing
+    """
+    journal_paths = glob.glob(os.path.join(
+        _TRANSACTIONS_HOME, 'transaction-*' + _JOURNAL_FILE_SUFFIX))
+    for journal_path in journal_paths:
+        with open(journal_path) as journal_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(journal_file.fileno(),
+                                fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    # The run is still committing
+                    continue
+            if not os.path.isfile(journal_path):
+                continue
+            logger.warning('Completing the commit of an interrupted '
+                           'transactional run (%s)...', journal_path)
+            _apply_transaction(json.load(journal_file), recovering=True)
+            os.remove(journal_path)
+
+
+@contextlib.contextmanager
+def _transacting(transactional=True):
+    """Stage all files changed within the context and commit them
+    together once it exits, or discard them if it raises
+
+    Contexts within a transactional context are part of its transaction.
+    """
+    global _transaction
+    if not transactional or _transaction is not None:
+        yield
+        return
+    _recover_transactions()
+    _transaction = _Transaction()
+    try:
+        try:
+            yield
+        except BaseException:
+            _transaction.roll_back()
+            raise
+        _transaction.commit()
+    finally:
+        _transaction = None
+
+
+def _staged(path):
+    """Return the path of the staged copy of a file, if the current
+    transaction changed it, or that of the file itself
+    """
+    return path if _transaction is None else _transaction.staged(path)
+
+
+def _target(path):
+    """Return the path of the file a staged file was staged for
+    """
+    return path if _transaction is None else _transaction.target(path)
+
+
+def _validate_config_schema(config, engine=None):
     schema = {
         'type': 'object',
         'properties': {
             'variables': {'type': 'object'},
+            'include': {
+                'type': 'array',
+                'items': {
+                    'anyOf': [
+                        {'type': 'string'},
+                        {
+                            'type': 'object',
+                            'properties': {
+                                'path': {'type': 'string'},
+                                'tags': {'type': 'array'}
+                            },
+                            'required': ['path'],
+                            "additionalProperties": False
+                        }
+                    ]
+                }
+            },
             'paths': {
                 'type': 'array',
                 'prefixItems': [
@@ -669,6 +3720,29 @@ def _validate_config_schema(config):
                             'to_file': {'type': 'string'},
                             'must_include': {'type': 'array'},
                             'tags': {'type': 'array'},
+                            'max_file_size': {'type': 'integer',
+                                              'minimum': 0},
+                            'skip_binary': {'type': 'boolean'},
+                            'in_place': {'type': 'boolean'},
+                            'mmap_threshold': {'type': 'integer',
+                                               'minimum': 0},
+                            'line_mode': {'type': 'boolean'},
+                            'record_separator': {'type': 'string',
+                                                 'minLength': 1},
+                            'batch_size': {'type': 'integer', 'minimum': 1},
+                            'regex_timeout': {'type': 'number',
+                                              'exclusiveMinimum': 0},
+                            'engine': {'enum': list(_ENGINES)},
+                            'archive_member': {'type': 'string'},
+                            'output_directory': {'type': 'string'},
+                            'follow_symlinks': {'type': 'boolean'},
+                            'dedupe_content': {'type': 'boolean'},
+                            'max_bytes_per_second': {'type': 'integer',
+                                                     'minimum': 1},
+                            'max_files_per_second': {
+                                'type': 'number', 'exclusiveMinimum': 0},
+                            'compression': {
+                                'enum': ['auto'] + sorted(_CODECS)},
                             'validator': {
                                 'type': 'object',
                                 'properties': {
@@ -688,7 +3762,9 @@ def _validate_config_schema(config):
                 ]
             }
         },
-        'required': ['paths'],
+        # Configs which include others may declare no paths of their own
+        'if': {'not': {'required': ['include']}},
+        'then': {'required': ['paths']},
         "additionalProperties": False
     }
     logger.info('Validating configuration...')
@@ -696,12 +3772,624 @@ def _validate_config_schema(config):
         jsonschema.validate(config, schema)
     except jsonschema.exceptions.ValidationError as ex:
         raise RepexError(ex)
+    _check_patterns(config, engine)
+
+
+def _check_patterns(config, engine=None):
+    """Check that all patterns are supported by their path's engine and
+    warn about patterns prone to catastrophic backtracking
+    """
+    for pathobj in config.get('paths', []):
+        path_engine = pathobj.get('engine') or engine or 're'
+        patterns = [pathobj.get('match', pathobj['replace']),
+                    pathobj['replace']] + \
+            pathobj.get('must_include', [])
+        if pathobj.get('type'):
+            patterns.extend(
+                [pathobj['type'], pathobj['path'].replace('\\', '/')])
+        for pattern in patterns:
+            # Patterns containing variables are compiled once expanded
+            if not _VariablesHandler.has_variables(pattern):
+                _compile(pattern, path_engine)
+            # re2 runs in linear time
+            if path_engine != 're2' and _has_nested_repeats(pattern):
+                logger.warning(
+                    'Pattern `%s` of path `%s` repeats a repeated '
+                    'expression and may take exponential time to fail '
+                    'matching. Consider setting `regex_timeout`',
+                    pattern, pathobj.get('description', pathobj['path']))
+
+
+def _has_nested_repeats(pattern):
+    """Check whether a pattern contains an unbounded repeat of an
+    expression which is itself repeated without bound, e.g. `(a+)*`
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return False
+
+    def walk(items, repeated):
+        for op, value in items:
+            if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+                _, maximum, subpattern = value
+                unbounded = maximum == sre_constants.MAXREPEAT
+                if unbounded and repeated:
+                    return True
+                if walk(subpattern, repeated or unbounded):
+                    return True
+            elif op is sre_constants.SUBPATTERN:
+                if walk(value[-1], repeated):
+                    return True
+            elif op is sre_constants.BRANCH:
+                if any(walk(branch, repeated) for branch in value[1]):
+                    return True
+            elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+                if walk(value[1], repeated):
+                    return True
+        return False
+
+    return walk(parsed, False)
 
 
 class RepexError(Exception):
     pass
 
 
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_ISDIR = 0x40000000
+_INOTIFY_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def _is_temp_file(path):
+    return path.endswith((_TEMP_FILE_SUFFIX, _JOURNAL_FILE_SUFFIX))
+
+
+class _InotifyMonitor(object):
+    """Report files written to under a set of directories using inotify
+
+    Directories created under a watched directory are watched as well.
+    """
+    def __init__(self, directories):
+        import ctypes.util
+
+        self._libc = ctypes.CDLL(
+            ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._watches = {}
+        for directory in directories:
+            self.add_directory(directory)
+
+    def add_directory(self, directory):
+        watch = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(directory), _INOTIFY_MASK)
+        if watch < 0:
+            import ctypes
+
+            logger.warning('Could not watch %s: %s', directory,
+                           os.strerror(ctypes.get_errno()))
+            return
+        self._watches[watch] = directory
+
+    def poll(self, timeout):
+        """Return the set of files changed within `timeout` seconds
+
+        None is returned if the kernel's event queue overflowed, in which
+        case changes might have been lost.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changed = set()
+        overflow = False
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError as ex:
+                if ex.errno == errno.EAGAIN:
+                    break
+                raise
+            offset = 0
+            while offset < len(data):
+                watch, mask, _, length = \
+                    _INOTIFY_EVENT.unpack_from(data, offset)
+                offset += _INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                if mask & _IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                directory = self._watches.get(watch)
+                if directory is None:
+                    continue
+                path = os.path.join(directory, name)
+                if mask & _IN_ISDIR:
+                    for root, _, files in os.walk(path):
+                        self.add_directory(root)
+                        changed.update(os.path.join(root, f) for f in files)
+                elif mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO):
+                    changed.add(path)
+        return None if overflow else changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class _PollingMonitor(object):
+    """Report files written to under a set of directories by polling
+
+    Only directories whose mtime changed are listed again and only files
+    accepted by `accept` are stat-ed on each poll, so no file is ever read.
+    """
+    def __init__(self, directories, accept):
+        self._accept = accept
+        self._directories = {}
+        self._files = {}
+        for directory in directories:
+            self.add_directory(directory)
+
+    def add_directory(self, directory):
+        """Start tracking a directory and return the files found in it
+        """
+        try:
+            self._directories[directory] = os.stat(directory).st_mtime_ns
+            names = os.listdir(directory)
+        except OSError:
+            return []
+        found = []
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and self._accept(path):
+                self._files[path] = _stat_key(path)
+                found.append(path)
+        return found
+
+    def poll(self, timeout):
+        time.sleep(timeout)
+        changed = set()
+        for directory, mtime in list(self._directories.items()):
+            current = _stat_key(directory)
+            if current is None:
+                del self._directories[directory]
+                continue
+            if current[0] == mtime:
+                continue
+            self._directories[directory] = current[0]
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if os.path.isdir(path) and path not in self._directories:
+                    for root, _, _ in os.walk(path):
+                        changed.update(self.add_directory(root))
+                elif path not in self._files and os.path.isfile(path) \
+                        and self._accept(path):
+                    self._files[path] = _stat_key(path)
+                    changed.add(path)
+        for path, key in list(self._files.items()):
+            current = _stat_key(path)
+            if current is None:
+                del self._files[path]
+            elif current != key:
+                self._files[path] = current
+                changed.add(path)
+        return changed
+
+    def close(self):
+        pass
+
+
+class _WatchedPath(object):
+    """A path object whose expanded config, compiled expressions
+    and file index are kept in memory between runs
+    """
+    def __init__(self, pathobj, variables, with_diff):
+        self.description = pathobj.get('description')
+        self.pathobj = _prepare_path(
+            copy.deepcopy(pathobj), copy.deepcopy(variables))
+        self.path_to_handle = os.path.join(
+            self.pathobj['base_directory'], self.pathobj['path'])
+        self.validator, self.validator_type = _get_validator(self.pathobj)
+        self.rpx = Repex(self.pathobj)
+        self.diff = with_diff
+        self.multiple = bool(self.pathobj.get('type'))
+        if self.multiple:
+            self._path_expression = _compile(
+                self.pathobj['path'].replace('\\', '/'),
+                self.pathobj['engine'])
+            self._excluded_paths = _normalize_excluded_paths(
+                self.pathobj['base_directory'], self.pathobj['excluded'])
+            self.files = set(_find_files(self.pathobj))
+        else:
+            self.files = set([self.path_to_handle])
+
+    @property
+    def directories(self):
+        if not self.multiple:
+            return [os.path.dirname(self.path_to_handle) or os.curdir]
+        return [root for root, _, _ in os.walk(self.pathobj['base_directory'])
+                if not root.startswith(tuple(self._excluded_paths))]
+
+    def matches(self, filepath):
+        """Return True if `filepath` should be handled by this path object
+        """
+        if filepath in self.files:
+            return True
+        if not self.multiple:
+            return False
+        root, filename = os.path.split(filepath)
+        if root.startswith(tuple(self._excluded_paths)) or \
+                not self._path_expression.search(root.replace('\\', '/')):
+            return False
+        is_file, matched, excluded_filename, excluded_path = \
+            _set_match_parameters(
+                filename,
+                filepath,
+                self.pathobj['type'],
+                None,
+                self._excluded_paths)
+        if not (is_file and matched) or excluded_filename or excluded_path:
+            return False
+        if not _filter_files([filepath],
+                             self.pathobj['max_file_size'],
+                             self.pathobj['skip_binary'] and
+                             not self.pathobj['archive_member'],
+                             self.pathobj['compression']):
+            return False
+        self.files.add(filepath)
+        return True
+
+    def handle(self, files):
+        """Handle `files` and return the paths that were written to
+        """
+        logger.info('Handling path with description: %s', self.description)
+        validate = self.validator is not None
+        if self.multiple:
+            files = sorted(f for f in files if os.path.isfile(f))
+            _handle_multiple_files(
+                rpx=self.rpx,
+                path_to_handle=self.path_to_handle,
+                pathobj=self.pathobj,
+                validate=validate,
+                diff=self.diff,
+                validator=self.validator,
+                validator_type=self.validator_type,
+                files=files)
+            return files
+        _handle_single_file(
+            rpx=self.rpx,
+            path_to_handle=self.path_to_handle,
+            pathobj=self.pathobj,
+            validate=validate,
+            diff=self.diff,
+            validator=self.validator)
+        return [self.pathobj['to_file'] or self.path_to_handle]
+
+
+class _Watcher(object):
+    """Re-apply path objects to files as they change
+
+    inotify is used on Linux. Elsewhere (or if inotify is not available),
+    the file system is polled every `interval` seconds.
+    Changes made by the watcher itself are recorded and ignored so that
+    it does not handle its own writes in a loop.
+    """
+    def __init__(self,
+                 config,
+                 variables=None,
+                 tags=None,
+                 with_diff=False,
+                 interval=1.0,
+                 polling=False):
+        repex_vars = _merge_variables(config['variables'], variables or {})
+        repex_tags = tags or []
+        self.interval = interval
+        self.paths = [_WatchedPath(path, repex_vars, with_diff)
+                      for path in config['paths']
+                      if _match_tags(repex_tags, path.get('tags', []))]
+        self._own_writes = {}
+
+        directories = sorted(set(
+            directory
+            for watched_path in self.paths
+            for directory in watched_path.directories))
+        self._monitor = None
+        if not polling and sys.platform.startswith('linux'):
+            try:
+                self._monitor = _InotifyMonitor(directories)
+                logger.debug('Watching %s directories using inotify',
+                             len(directories))
+            except (OSError, AttributeError) as ex:
+                logger.warning('Could not use inotify (%s). '
+                               'Falling back to polling...', ex)
+        if not self._monitor:
+            self._monitor = _PollingMonitor(directories, self._accept)
+            logger.debug('Polling %s directories every %s seconds',
+                         len(directories), interval)
+
+    def _accept(self, path):
+        return not _is_temp_file(path) and \
+            any(watched_path.matches(path) for watched_path in self.paths)
+
+    def _is_own_write(self, path):
+        key = self._own_writes.get(path)
+        return key is not None and key == _stat_key(path)
+
+    def _handle(self, watched_path, files):
+        try:
+            written = watched_path.handle(files)
+        except (RepexError, IOError, OSError) as ex:
+            logger.error(str(ex))
+            return 0
+        for path in written:
+            self._own_writes[path] = _stat_key(path)
+        return len(written)
+
+    def start(self):
+        """Handle all files once, like `iterate` would
+        """
+        for watched_path in self.paths:
+            self._handle(watched_path, watched_path.files)
+
+    def run_once(self, timeout=None):
+        """Wait for changes and handle them
+
+        Returns the number of files handled.
+        """
+        changed = self._monitor.poll(
+            self.interval if timeout is None else timeout)
+        if changed is None:
+            logger.warning('File system events were lost. Rescanning...')
+            for watched_path in self.paths:
+                if watched_path.multiple:
+                    watched_path.files = set(_find_files(watched_path.pathobj))
+            changed = set().union(*(p.files for p in self.paths))
+        changed = set(path for path in changed
+                      if not _is_temp_file(path) and
+                      not self._is_own_write(path))
+        if changed:
+            logger.debug('Changed files: %s', sorted(changed))
+
+        handled = 0
+        for watched_path in self.paths:
+            files = [path for path in changed if watched_path.matches(path)]
+            if files:
+                handled += self._handle(watched_path, files)
+        return handled
+
+    def run(self):
+        try:
+            self.start()
+            logger.info('Watching for changes. Press Ctrl+C to stop...')
+            while True:
+                self.run_once()
+        except KeyboardInterrupt:
+            logger.info('Stopped watching')
+        finally:
+            self.close()
+
+    def close(self):
+        self._monitor.close()
+
+
+def watch(config_file_path=None,
+          config=None,
+          variables=None,
+          tags=None,
+          validate=True,
+          with_diff=False,
+          interval=1.0,
+          engine=None):
+    """Iterate over all paths in `config_file_path` and then keep
+    re-applying them to files as they change until interrupted.
+
+    The parameters are the same as `iterate`'s.
+
+    :param float interval: seconds between polls when inotify
+     is not available
+    """
+    config = _load_config(
+        config_file_path, config, variables, tags, validate, engine)
+    _Watcher(config, variables, tags, with_diff, interval).run()
+
+
+class _StreamToClient(object):
+    """A file-like object which forwards everything written to it
+    to a daemon client as `output` messages
+    """
+    def __init__(self, wfile):
+        self._wfile = wfile
+
+    def write(self, text):
+        if text:
+            _send_message(self._wfile, {'output': text})
+
+    def flush(self):
+        self._wfile.flush()
+
+
+def _send_message(wfile, message):
+    wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+    wfile.flush()
+
+
+@contextlib.contextmanager
+def _logging_to(stream):
+    """Write all log messages to `stream` for the duration of the context
+    """
+    original_streams = [(handler, handler.setStream(stream))
+                        for handler in logger.handlers
+                        if isinstance(handler, logging.StreamHandler)]
+    try:
+        yield
+    finally:
+        for handler, original_stream in original_streams:
+            handler.setStream(original_stream)
+
+
+@contextlib.contextmanager
+def _client_context(request, stream):
+    """Run the request as if the client itself was running it
+
+    The cwd, `REPEX_VAR_` env vars, diff file location, log level and
+    output streams are set according to the client and are restored
+    once the request is done.
+    """
+    global _DIFF_HOME
+    global _DIFF_FILE_PATH
+
+    original_cwd = os.getcwd()
+    original_level = logger.level
+    original_diff = _DIFF_HOME, _DIFF_FILE_PATH
+    original_vars = dict((k, v) for k, v in os.environ.items()
+                         if k.startswith(_REPEX_VAR_PREFIX))
+    try:
+        os.chdir(request['cwd'])
+        for name in original_vars:
+            del os.environ[name]
+        os.environ.update(request['environ'])
+        _DIFF_HOME = os.path.join(request['cwd'], '.rpx')
+        _DIFF_FILE_PATH = os.path.join(_DIFF_HOME, 'diff-{0}'.format(
+            _normalize_current_time(_get_current_time())))
+        with _logging_to(stream), contextlib.redirect_stdout(stream):
+            yield
+    finally:
+        _DIFF_HOME, _DIFF_FILE_PATH = original_diff
+        for name in list(os.environ):
+            if name.startswith(_REPEX_VAR_PREFIX):
+                del os.environ[name]
+        os.environ.update(original_vars)
+        logger.setLevel(original_level)
+        os.chdir(original_cwd)
+
+
+def _daemon_server(socket_path):
+    """Return a server which runs `rpx` requests sent over a Unix domain
+    socket at `socket_path`
+
+    Requests are handled one at a time as handling one changes
+    process wide state (e.g. the cwd).
+    """
+    import socketserver
+
+    class _DaemonRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            stream = _StreamToClient(self.wfile)
+            exit_value = 0
+            with _client_context(request, stream):
+                try:
+                    _execute(request['verbose'], request['kwargs'])
+                except SystemExit as ex:
+                    exit_value = ex.code
+                except Exception as ex:
+                    logger.exception('Unexpected error')
+                    exit_value = str(ex)
+            _send_message(self.wfile, {'exit': exit_value})
+
+    class _DaemonServer(socketserver.UnixStreamServer):
+        def __init__(self):
+            global _cache
+
+            if os.path.exists(socket_path):
+                if _daemon_listening(socket_path):
+                    raise RepexError('{0}: {1}'.format(
+                        ERRORS['daemon_already_running'], socket_path))
+                os.remove(socket_path)
+            socketserver.UnixStreamServer.__init__(
+                self, socket_path, _DaemonRequestHandler)
+            _cache = _Cache()
+
+        def server_close(self):
+            global _cache
+
+            socketserver.UnixStreamServer.server_close(self)
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            _cache = None
+
+    return _DaemonServer()
+
+
+def _daemon_listening(socket_path):
+    try:
+        with contextlib.closing(_connect(socket_path)):
+            return True
+    except (IOError, OSError):
+        return False
+
+
+def _connect(socket_path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except (IOError, OSError):
+        client.close()
+        raise
+    return client
+
+
+def serve(socket_path):
+    """Serve `rpx` requests over a Unix domain socket until interrupted
+
+    Parsed configs, compiled path objects, validator modules and file
+    lists are kept between requests.
+
+    :param string socket_path: path of the socket to listen on
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        raise RepexError(ERRORS['daemon_not_supported'])
+    server = _daemon_server(socket_path)
+    logger.info('Serving on %s. Press Ctrl+C to stop...', socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Stopped serving')
+    finally:
+        server.server_close()
+
+
+def _forward_to_daemon(socket_path, verbose, kwargs):
+    """Send a request to a daemon and print its output
+
+    Returns a tuple of whether the request was handled by the daemon
+    and the exit value of the request.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        return False, None
+    try:
+        client = _connect(socket_path)
+    except (IOError, OSError) as ex:
+        logger.debug('Could not connect to %s (%s). Running locally...',
+                     socket_path, ex)
+        return False, None
+
+    request = {
+        'cwd': os.getcwd(),
+        'environ': dict((k, v) for k, v in os.environ.items()
+                        if k.startswith(_REPEX_VAR_PREFIX)),
+        'verbose': verbose,
+        'kwargs': kwargs
+    }
+    with contextlib.closing(client):
+        with contextlib.closing(client.makefile('rwb')) as stream:
+            _send_message(stream, request)
+            for line in stream:
+                message = json.loads(line.decode('utf-8'))
+                if 'output' in message:
+                    sys.stdout.write(message['output'])
+                    sys.stdout.flush()
+                elif 'exit' in message:
+                    return True, message['exit']
+    raise RepexError(ERRORS['daemon_connection_lost'])
+
+
 def _build_vars_dict(vars_file='', variables=None):
     """Merge variables into a single dictionary
 
@@ -741,6 +4429,10 @@ _DIFF_HOME = os.path.join(os.getcwd(), '.rpx')
 _NORMALIZED_TIMESTAMP = _normalize_current_time(_get_current_time())
 _DIFF_FILE_PATH = os.path.join(_DIFF_HOME, 'diff-{0}'.format(
     _NORMALIZED_TIMESTAMP))
+# Unlike diffs, journals of transactions don't depend on the directory
+# runs are started from (see `_transaction_journal`)
+_TRANSACTIONS_HOME = os.path.join(
+    os.path.expanduser('~'), '.rpx', 'transactions')
 CLICK_CONTEXT_SETTINGS = dict(
     help_option_names=['-h', '--help'],
     token_normalize_func=lambda param: param.lower())
@@ -795,6 +4487,111 @@ CLICK_CONTEXT_SETTINGS = dict(
               multiple=True,
               help='Files found must include this string. '
                    'This can be used multiple times')
+@click.option('--max-file-size',
+              type=int,
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['config'],
+              help='Skip files larger than this amount of bytes '
+                   '[non-config only]')
+@click.option('--skip-binary/--no-skip-binary',
+              default=False,
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['config'],
+              help='Skip files which look like binary files '
+                   '(defaults to False) [non-config only]')
+@click.option('--in-place',
+              is_flag=True,
+              default=False,
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['config'],
+              help='Only overwrite the replaced bytes when replacements '
+                   'keep their length [non-config only]')
+@click.option('--mmap-threshold',
+              type=int,
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['config'],
+              help='Map files of at least this amount of bytes instead of '
+                   'reading them [non-config only]')
+@click.option('--line-mode',
+              is_flag=True,
+              default=False,
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['config'],
+              help='Matches never span lines, so that large files can be '
+                   'processed in parallel [non-config only]')
+@click.option('--record-separator',
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['config'],
+              help='Matches never span records separated by this string, '
+                   'so that large files can be processed in parallel '
+                   '[non-config only]')
+@click.option('--batch-size',
+              type=int,
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['config'],
+              help='Scan files found via `type` in batches of up to this '
+                   'amount of bytes [non-config only]')
+@click.option('--regex-timeout',
+              type=float,
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['config'],
+              help='Fail if scanning a file takes longer than this amount '
+                   'of seconds [non-config only]')
+@click.option('--archive-member',
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['config'],
+              help='Replace within the members of tar or zip archives whose '
+                   'names match this regex [non-config only]')
+@click.option('--max-bytes-per-second',
+              type=click.IntRange(min=1),
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['config'],
+              help='Limit the rate at which files are read and written '
+                   '[non-config only]')
+@click.option('--max-files-per-second',
+              type=click.FloatRange(min=0, min_open=True),
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['config'],
+              help='Limit the rate at which files are handled '
+                   '[non-config only]')
+@click.option('--progress',
+              type=click.Choice(['tty', 'json']),
+              help='Report the progress of each path to stderr, as a line '
+                   'rewritten in place or as JSON events')
+@click.option('--low-priority',
+              is_flag=True,
+              default=False,
+              help='Run at the lowest CPU and I/O priority')
+@click.option('--follow-symlinks',
+              is_flag=True,
+              default=False,
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['config'],
+              help='Follow symlinks to directories when looking for files '
+                   '[non-config only]')
+@click.option('--dedupe-content',
+              is_flag=True,
+              default=False,
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['config'],
+              help='Scan files with identical content only once '
+                   '[non-config only]')
+@click.option('--output-directory',
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['config'],
+              help='Write files to a mirror of the base directory under this '
+                   'directory instead of in place, linking unchanged files '
+                   '[non-config only]')
+@click.option('--compression',
+              type=click.Choice(['auto'] + sorted(_CODECS)),
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['config'],
+              help='Replace within gzip, bz2 or xz compressed files, '
+                   'detecting the compression with `auto` [non-config only]')
+@click.option('--engine',
+              type=click.Choice(_ENGINES),
+              help='Regex engine to use for paths which do not choose one '
+                   '(defaults to re)')
 @click.option('--validator',
               cls=_MutuallyExclusiveOption,
               mutually_exclusive=['config'],
@@ -846,11 +4643,60 @@ CLICK_CONTEXT_SETTINGS = dict(
               default=False,
               is_flag=True,
               help='Only validate the config, do not run (defaults to False)')
+@click.option('--watch',
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['validate_only'],
+              default=False,
+              is_flag=True,
+              help='Keep running and re-apply the replacements to files '
+                   'as they change (defaults to False)')
+@click.option('--watch-interval',
+              default=1.0,
+              type=float,
+              help='Seconds between checks for changes when inotify is not '
+                   'available (defaults to 1)')
 @click.option('--diff',
               default=False,
               is_flag=True,
               help='Write the diff to a file under `cwd/.rpx/diff-TIMESTAMP` '
                    '(defaults to False)')
+@click.option('--shard',
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['watch'],
+              help='Only handle the files which belong to this shard. '
+                   'Format should be `INDEX/COUNT` where INDEX is zero based '
+                   '(e.g. 0/4, 1/4, 2/4 and 3/4 for four machines)')
+@click.option('--report',
+              help='Write a JSON report of all handled files to this path. '
+                   'With `--merge-reports`, write the merged report to it')
+@click.option('--transactional',
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['watch'],
+              default=False,
+              is_flag=True,
+              help='Only change files once all paths were handled and '
+                   'validated, and change either all of them or none '
+                   '(defaults to False)')
+@click.option('--changed-files-out',
+              cls=_MutuallyExclusiveOption,
+              mutually_exclusive=['watch'],
+              help='Write the paths of all changed files to this path, '
+                   'one per line')
+@click.option('--merge-reports',
+              multiple=True,
+              help='Merge reports written using `--report` by the shards of a '
+                   'run and exit. Can be used multiple times')
+@click.option('--serve',
+              default=False,
+              is_flag=True,
+              help='Run as a daemon which handles requests sent over '
+                   '`--socket` (defaults to False)')
+@click.option('--socket',
+              envvar='REPEX_SOCKET',
+              help='Unix domain socket of a daemon started with `--serve`. '
+                   'If a daemon is listening on it, the request is sent to '
+                   'the daemon. Otherwise, it is handled locally. '
+                   'Can also be set via the REPEX_SOCKET env var')
 @click.option('-v',
               '--verbose',
               default=False,
@@ -868,9 +4714,76 @@ def main(verbose, **kwargs):
 
     It's important to note that if the `REGEX_PATH` is a path to a
     directory, the `-t,--ftype` flag must be provided.
+
+    If `REGEX_PATH` is `-`, stdin is replaced within and written to stdout.
     """
+    if kwargs['serve']:
+        if not kwargs['socket']:
+            raise click.UsageError('`--serve` requires `--socket`')
+        if verbose:
+            set_verbose()
+        try:
+            serve(kwargs['socket'])
+        except (RepexError, IOError, OSError) as ex:
+            sys.exit(str(ex))
+        return
+
+    if kwargs['low_priority']:
+        _lower_priority()
+
+    if kwargs['regex_path'] == '-':
+        _filter(verbose, kwargs)
+        return
+
+    # A watch never returns so it would block the daemon for everyone else,
+    # the daemon would keep running at a lowered priority and progress is
+    # reported by the process handling the run
+    if kwargs['socket'] and not kwargs['watch'] and \
+            not kwargs['low_priority'] and not kwargs['progress']:
+        forwarded, exit_value = _forward_to_daemon(
+            kwargs['socket'], verbose, kwargs)
+        if forwarded:
+            sys.exit(exit_value)
+
+    _execute(verbose, kwargs)
+
+
+def _filter(verbose, kwargs):
+    """Replace within stdin and write the result to stdout
+    """
+    incompatible = [name for name in _FILTER_INCOMPATIBLE if kwargs[name]]
+    if incompatible:
+        raise click.UsageError('`-` can not be used with: {0}'.format(
+            ', '.join('--' + name.replace('_', '-') for name in incompatible)))
+    if verbose:
+        set_verbose()
+
+    rpx = Repex(_set_path_defaults(_construct_path_object(**kwargs)))
+    output = sys.stdout.buffer
+    # stdout is the output, so log messages are written to stderr
+    with _logging_to(sys.stderr):
+        try:
+            rpx.transform_stream(sys.stdin.buffer, output)
+        except (RepexError, IOError, OSError) as ex:
+            sys.exit(str(ex))
+        finally:
+            output.flush()
+
+
+def _execute(verbose, kwargs):
     config = kwargs['config']
 
+    if kwargs['merge_reports']:
+        if verbose:
+            set_verbose()
+        try:
+            merged = merge_reports(kwargs['merge_reports'], kwargs['report'])
+        except (RepexError, IOError, OSError) as ex:
+            sys.exit(str(ex))
+        if not kwargs['report']:
+            click.echo(json.dumps(merged, indent=2))
+        return
+
     if not config and not kwargs['regex_path']:
         click.echo('Must either provide a path or a viable repex config file.')
         sys.exit(1)
@@ -878,26 +4791,73 @@ def main(verbose, **kwargs):
     if verbose:
         set_verbose()
 
+    with _reporting_progress(kwargs['progress']):
+        _run(config, kwargs)
+
+
+def _run(config, kwargs):
     if config:
         repex_vars = _build_vars_dict(kwargs['vars_file'], kwargs['var'])
         try:
-            iterate(
-                config_file_path=config,
-                variables=repex_vars,
-                tags=list(kwargs['tag']),
-                validate=kwargs['validate'],
-                validate_only=kwargs['validate_only'],
-                with_diff=kwargs['diff'])
+            if kwargs['watch']:
+                watch(
+                    config_file_path=config,
+                    variables=repex_vars,
+                    tags=list(kwargs['tag']),
+                    validate=kwargs['validate'],
+                    with_diff=kwargs['diff'],
+                    interval=kwargs['watch_interval'],
+                    engine=kwargs['engine'])
+            else:
+                outcomes = iterate(
+                    config_file_path=config,
+                    variables=repex_vars,
+                    tags=list(kwargs['tag']),
+                    validate=kwargs['validate'],
+                    validate_only=kwargs['validate_only'],
+                    with_diff=kwargs['diff'],
+                    shard=kwargs['shard'],
+                    report_path=kwargs['report'],
+                    engine=kwargs['engine'],
+                    transactional=kwargs['transactional'])
+                if kwargs['changed_files_out']:
+                    write_changed_files(
+                        outcomes, kwargs['changed_files_out'])
         except (RepexError, IOError, OSError) as ex:
             sys.exit(str(ex))
     else:
         pathobj = _construct_path_object(**kwargs)
         try:
-            handle_path(pathobj)
+            if kwargs['watch']:
+                watch(
+                    config={'paths': [pathobj]},
+                    validate=False,
+                    interval=kwargs['watch_interval'])
+            else:
+                shard = _parse_shard(kwargs['shard']) \
+                    if kwargs['shard'] else None
+                report = _Report(shard) if kwargs['report'] else None
+                outcomes = handle_path(
+                    pathobj,
+                    shard=shard,
+                    report=report,
+                    transactional=kwargs['transactional'])
+                if report is not None:
+                    report.write(kwargs['report'])
+                if kwargs['changed_files_out']:
+                    write_changed_files(
+                        outcomes, kwargs['changed_files_out'])
         except (RepexError, IOError, OSError) as ex:
             sys.exit(str(ex))
 
 
+_FILTER_INCOMPATIBLE = ('config', 'ftype', 'to_file', 'watch', 'shard',
+                        'report', 'in_place', 'diff', 'validator',
+                        'archive_member', 'compression',
+                        'output_directory', 'progress', 'changed_files_out',
+                        'transactional')
+
+
 def _construct_path_object(**kwargs):
     ftype = kwargs['ftype']
     match = kwargs['match']
@@ -912,6 +4872,22 @@ def _construct_path_object(**kwargs):
         'with': kwargs['replace_with'],
         'excluded': list(kwargs['exclude_paths']),
         'must_include': list(kwargs['must_include']),
+        'max_file_size': kwargs['max_file_size'],
+        'skip_binary': kwargs['skip_binary'],
+        'in_place': kwargs['in_place'],
+        'mmap_threshold': kwargs['mmap_threshold'],
+        'line_mode': kwargs['line_mode'],
+        'record_separator': kwargs['record_separator'],
+        'batch_size': kwargs['batch_size'],
+        'regex_timeout': kwargs['regex_timeout'],
+        'engine': kwargs['engine'],
+        'archive_member': kwargs['archive_member'],
+        'compression': kwargs['compression'],
+        'output_directory': kwargs['output_directory'],
+        'follow_symlinks': kwargs['follow_symlinks'],
+        'max_bytes_per_second': kwargs['max_bytes_per_second'],
+        'max_files_per_second': kwargs['max_files_per_second'],
+        'dedupe_content': kwargs['dedupe_content'],
         'diff': kwargs['diff']
     }
     validator = kwargs['validator']
@@ -27,6 +27,10 @@ setup(
         "pyyaml>=5.4.1",
         "jsonschema==4.16.0"
     ],
+    extras_require={
+        'regex': ['regex'],
+        're2': ['google-re2'],
+    },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Programming Language :: Python',
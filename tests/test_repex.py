@@ -13,10 +13,28 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
+import io
 import os
+import re
+import sys
+import bz2
+import copy
+import errno
+import gzip
+import json
+import lzma
+import time
 import shlex
+import signal
 import shutil
+import socket
+import hashlib
+import asyncio
+import tarfile
+import zipfile
 import tempfile
+import threading
+import subprocess
 
 import pytest
 import click.testing as clicktest
@@ -722,3 +740,2095 @@ class TestMatchReplaceLogic():
         assert '/something-2.9-2' == content[1]
         assert '/something-2.9-3' == content[2]
         assert '/something_else-1.3.1-1' == content[3]
+
+
+class TestFilterFiles():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.text_file = os.path.join(self.tmpdir, 'mock_VERSION')
+        self.binary_file = os.path.join(self.tmpdir, 'mock_VERSION.bin')
+        with open(self.text_file, 'w') as f:
+            f.write('"version": "3.1.0-m2"')
+        with open(self.binary_file, 'wb') as f:
+            f.write(b'"version": "3.1.0-m2"\0\x89PNG')
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_is_binary(self):
+        assert repex._is_binary(self.binary_file)
+        assert not repex._is_binary(self.text_file)
+
+    def test_skip_binary(self):
+        files = [self.text_file, self.binary_file]
+        assert repex._filter_files(files, skip_binary=True) == \
+            [self.text_file]
+        # Binary files are only skipped if asked to
+        assert repex._filter_files(files) == files
+
+    def test_max_file_size(self):
+        files = [self.text_file]
+        assert repex._filter_files(files, max_file_size=5) == []
+        assert repex._filter_files(files, max_file_size=1024) == files
+
+    def test_binary_files_are_not_handled(self):
+        path_object = {
+            'type': 'mock_VERSION.*',
+            'path': '.*',
+            'base_directory': self.tmpdir,
+            'match': '3.1.0-m2',
+            'replace': '3.1.0-m2',
+            'with': '3.1.0-m3',
+            'skip_binary': True
+        }
+        repex.handle_path(path_object)
+        with open(self.text_file) as f:
+            assert '3.1.0-m3' in f.read()
+        with open(self.binary_file, 'rb') as f:
+            assert b'3.1.0-m2' in f.read()
+
+
+class TestWatch():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.version_file = os.path.join(self.tmpdir, 'mock_VERSION')
+        self._write(self.version_file, '"version": "3.1.0-m2"')
+        self.config = {
+            'variables': {},
+            'paths': [{
+                'type': 'mock_VERSION',
+                'path': '.*',
+                'base_directory': self.tmpdir,
+                'match': '"version": "3.1.0-m2"',
+                'replace': '3.1.0-m2',
+                'with': '3.1.0-m3',
+            }]
+        }
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    @staticmethod
+    def _write(path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    @staticmethod
+    def _read(path):
+        with open(path) as f:
+            return f.read()
+
+    def _test(self, polling):
+        watcher = repex._Watcher(self.config, interval=0.1, polling=polling)
+        try:
+            watcher.start()
+            assert '3.1.0-m3' in self._read(self.version_file)
+            # The watcher's own write must not be handled again
+            assert watcher.run_once(timeout=0.2) == 0
+
+            self._write(self.version_file, '"version": "3.1.0-m2"')
+            new_dir = os.path.join(self.tmpdir, 'new')
+            os.makedirs(new_dir)
+            new_file = os.path.join(new_dir, 'mock_VERSION')
+            self._write(new_file, '"version": "3.1.0-m2"')
+            ignored_file = os.path.join(self.tmpdir, 'other')
+            self._write(ignored_file, '"version": "3.1.0-m2"')
+
+            assert watcher.run_once(timeout=1) == 2
+            assert '3.1.0-m3' in self._read(self.version_file)
+            assert '3.1.0-m3' in self._read(new_file)
+            assert '3.1.0-m2' in self._read(ignored_file)
+        finally:
+            watcher.close()
+
+    @pytest.mark.skipif(not sys.platform.startswith('linux'),
+                        reason='inotify is only available on Linux')
+    def test_watch_inotify(self):
+        self._test(polling=False)
+
+    def test_watch_polling(self):
+        self._test(polling=True)
+
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'),
+                    reason='Unix domain sockets are not supported')
+class TestDaemon():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, 'rpx.sock')
+        self.version_file = os.path.join(self.tmpdir, 'mock_VERSION')
+        with open(self.version_file, 'w') as f:
+            f.write('"version": "3.1.0-m2"')
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _read(self):
+        with open(self.version_file) as f:
+            return f.read()
+
+    def _start_daemon(self):
+        daemon = subprocess.Popen([
+            sys.executable, '-c',
+            'import repex; repex.serve({0!r})'.format(self.socket_path)])
+        for _ in range(100):
+            if os.path.exists(self.socket_path):
+                return daemon
+            time.sleep(0.1)
+        daemon.kill()
+        raise AssertionError('Daemon did not start')
+
+    def test_forward_to_daemon(self):
+        config_file = os.path.join(self.tmpdir, 'config.yaml')
+        with open(config_file, 'w') as f:
+            f.write(
+                'paths:\n'
+                '    -   path: {0}\n'
+                '        match: 3.1.0-m\\d\n'
+                '        replace: 3.1.0-m\\d\n'
+                '        with: "{{{{ .version }}}}"\n'.format(
+                    self.version_file))
+
+        daemon = self._start_daemon()
+        try:
+            result = _invoke(['-c', config_file, '--var', 'version=3.1.0-m3',
+                              '--socket', self.socket_path])
+            assert result.exit_code == 0
+            assert 'Importing config' in result.output
+            assert '3.1.0-m3' in self._read()
+
+            result = _invoke(['-c', config_file, '--var', 'version=3.1.0-m4',
+                              '--socket', self.socket_path])
+            assert result.exit_code == 0
+            assert 'Using cached config' in result.output
+            assert '3.1.0-m4' in self._read()
+
+            result = _invoke(['MISSING_FILE', '-r', 'x', '-w', 'y',
+                              '--socket', self.socket_path])
+            assert result.exit_code == 1
+            assert repex.ERRORS['file_not_found'] in result.output
+        finally:
+            daemon.send_signal(signal.SIGINT)
+            daemon.wait()
+        assert not os.path.exists(self.socket_path)
+
+    def test_no_daemon(self):
+        result = _invoke([
+            self.version_file, '-r', '3.1.0-m2', '-w', '3.1.0-m3',
+            '--socket', self.socket_path])
+        assert result.exit_code == 0
+        assert '3.1.0-m3' in self._read()
+
+    def test_serve_requires_socket(self):
+        result = _invoke('--serve')
+        assert result.exit_code == 2
+        assert '`--serve` requires `--socket`' in result.output
+
+
+class TestAsync():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = []
+        for index in range(20):
+            directory = os.path.join(self.tmpdir, str(index % 3))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            path = os.path.join(directory, 'mock_VERSION{0}'.format(index))
+            with open(path, 'w') as f:
+                f.write('"version": "3.1.0-m2"\n"other": "3.1.0-m2"\n')
+            self.files.append(path)
+        self.pathobj = {
+            'type': 'mock_VERSION.*',
+            'path': '.*',
+            'base_directory': self.tmpdir,
+            'match': '"version": "{{ .version }}"',
+            'replace': '{{ .version }}',
+            'with': '3.1.0-m3',
+        }
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _contents(self):
+        contents = []
+        for path in self.files:
+            with open(path) as f:
+                contents.append(f.read())
+        return contents
+
+    def test_async_handle_path_same_as_sync(self):
+        variables = {'version': '3.1.0-m2'}
+        progress = []
+
+        asyncio.run(repex.async_handle_path(
+            dict(self.pathobj),
+            variables=dict(variables),
+            concurrency=4,
+            progress=lambda path, done, total: progress.append(
+                (path, done, total))))
+        async_contents = self._contents()
+        assert sorted(p[0] for p in progress) == sorted(self.files)
+        assert sorted(p[1] for p in progress) == list(range(1, 21))
+        assert set(p[2] for p in progress) == set([20])
+
+        variables = {'version': '3.1.0-m3'}
+        self.pathobj['with'] = '3.1.0-m2'
+        repex.handle_path(dict(self.pathobj), variables=variables)
+        variables = {'version': '3.1.0-m2'}
+        self.pathobj['with'] = '3.1.0-m3'
+        repex.handle_path(dict(self.pathobj), variables=variables)
+        assert async_contents == self._contents()
+        assert '"version": "3.1.0-m3"\n"other": "3.1.0-m2"' in \
+            async_contents[0]
+
+    def test_async_iterate(self):
+        config = {'paths': [self.pathobj]}
+        asyncio.run(repex.async_iterate(
+            config=config, variables={'version': '3.1.0-m2'}))
+        for content in self._contents():
+            assert '"version": "3.1.0-m3"' in content
+
+    def test_cancel(self):
+
+        async def run():
+            task = asyncio.ensure_future(repex.async_handle_path(
+                self.pathobj,
+                variables={'version': '3.1.0-m2'},
+                concurrency=1,
+                progress=lambda *args: task.cancel()))
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run())
+        changed = [c for c in self._contents() if '3.1.0-m3' in c]
+        assert 1 <= len(changed) < len(self.files)
+
+    def test_nothing_changes_after_cancel(self, monkeypatch):
+        handle_file = repex.Repex.handle_file
+
+        def slow_handle_file(rpx, file_to_handle):
+            time.sleep(0.1)
+            return handle_file(rpx, file_to_handle)
+
+        monkeypatch.setattr(repex.Repex, 'handle_file', slow_handle_file)
+
+        async def run():
+            task = asyncio.ensure_future(repex.async_handle_path(
+                self.pathobj,
+                variables={'version': '3.1.0-m2'},
+                concurrency=4,
+                progress=lambda *args: task.cancel()))
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run())
+        contents = self._contents()
+        time.sleep(0.3)
+        assert contents == self._contents()
+
+    def test_loop_is_not_blocked_after_cancel(self, monkeypatch):
+        handle_file = repex.Repex.handle_file
+
+        def slow_handle_file(rpx, file_to_handle):
+            time.sleep(0.5)
+            return handle_file(rpx, file_to_handle)
+
+        monkeypatch.setattr(repex.Repex, 'handle_file', slow_handle_file)
+
+        async def run():
+            task = asyncio.ensure_future(repex.async_handle_path(
+                self.pathobj, variables={'version': '3.1.0-m2'}))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            ticks = []
+            while not task.done():
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+            return max(b - a for a, b in zip(ticks, ticks[1:]))
+
+        assert asyncio.run(run()) < 0.2
+
+    def test_async_error(self):
+        self.pathobj['must_include'] = ['MISSING_INCLUSION']
+        with pytest.raises(repex.RepexError) as ex:
+            asyncio.run(repex.async_handle_path(
+                self.pathobj, variables={'version': '3.1.0-m2'}))
+        assert repex.ERRORS['prevalidation_failed'] in str(ex)
+
+
+class TestShard():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = []
+        for index in range(30):
+            path = os.path.join(self.tmpdir, 'mock_VERSION{0}'.format(index))
+            with open(path, 'w') as f:
+                f.write('"version": "3.1.0-m2"\n')
+            self.files.append(path)
+        self.config = {
+            'paths': [{
+                'description': 'shard test',
+                'type': 'mock_VERSION.*',
+                'path': '.*',
+                'base_directory': self.tmpdir,
+                'match': '"version": "3.1.0-m2"',
+                'replace': '3.1.0-m2',
+                'with': '3.1.0-m3',
+            }]
+        }
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_parse_shard(self):
+        assert repex._parse_shard('1/4') == (1, 4)
+        assert repex._parse_shard((0, 2)) == (0, 2)
+        for shard in ('4/4', '-1/4', '0/0', 'x', '1/2/3'):
+            with pytest.raises(repex.RepexError) as ex:
+                repex._parse_shard(shard)
+            assert repex.ERRORS['invalid_shard'] in str(ex)
+
+    def test_shards_are_disjoint_and_complete(self):
+        shards = [[f for f in self.files
+                   if repex._in_shard(f, self.tmpdir, (index, 3))]
+                  for index in range(3)]
+        assert sorted(sum(shards, [])) == sorted(self.files)
+        assert all(shards)
+
+    def test_merge_reports(self):
+        reports = []
+        for index in range(3):
+            report_path = os.path.join(
+                self.tmpdir, 'report-{0}.json'.format(index))
+            repex.iterate(
+                config=copy.deepcopy(self.config),
+                shard='{0}/3'.format(index),
+                report_path=report_path)
+            reports.append(report_path)
+
+        for path in self.files:
+            with open(path) as f:
+                assert '3.1.0-m3' in f.read()
+
+        merged_path = os.path.join(self.tmpdir, 'merged.json')
+        result = _invoke(['--merge-reports', reports[0],
+                          '--merge-reports', reports[1],
+                          '--merge-reports', reports[2],
+                          '--report', merged_path])
+        assert result.exit_code == 0
+        with open(merged_path) as f:
+            merged = json.load(f)
+        assert merged['shards'] == [[0, 3], [1, 3], [2, 3]]
+        assert merged['stats'] == {'files': 30, 'changed': 30}
+        assert len(merged['paths']) == 1
+        files = merged['paths'][0]['files']
+        assert sorted(f['path'] for f in files) == sorted(self.files)
+        assert '+"version": "3.1.0-m3"\n' in files[0]['diff']
+
+    def test_merge_reports_of_different_runs(self):
+        first = os.path.join(self.tmpdir, 'first.json')
+        second = os.path.join(self.tmpdir, 'second.json')
+        repex.iterate(config=copy.deepcopy(self.config),
+                      shard='0/2', report_path=first)
+        repex.iterate(config=copy.deepcopy(self.config),
+                      shard='0/3', report_path=second)
+        with pytest.raises(repex.RepexError) as ex:
+            repex.merge_reports([first, second])
+        assert repex.ERRORS['report_mismatch'] in str(ex)
+
+
+class TestInPlace():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.version_file = os.path.join(self.tmpdir, 'mock_VERSION')
+        with open(self.version_file, 'wb') as f:
+            f.write(b'"version": "3.1.0-m2"\n' * 3)
+        self.path_object = {
+            'path': self.version_file,
+            'match': '"version": "3.1.0-m2"',
+            'replace': '3.1.0-m2',
+            'with': '3.1.0-m3',
+            'in_place': True
+        }
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _read(self):
+        with open(self.version_file, 'rb') as f:
+            return f.read()
+
+    def test_same_length_replacement_is_patched(self):
+        inode = os.stat(self.version_file).st_ino
+        repex.handle_path(self.path_object)
+        assert self._read() == b'"version": "3.1.0-m3"\n' * 3
+        assert os.stat(self.version_file).st_ino == inode
+        assert os.listdir(self.tmpdir) == ['mock_VERSION']
+
+    def test_length_change_rewrites_file(self):
+        self.path_object['with'] = '3.1.0'
+        inode = os.stat(self.version_file).st_ino
+        repex.handle_path(self.path_object)
+        assert self._read() == b'"version": "3.1.0"\n' * 3
+        assert os.stat(self.version_file).st_ino != inode
+
+    def test_must_include(self):
+        self.path_object['must_include'] = ['3.1.0-m4']
+        with pytest.raises(repex.RepexError) as ex:
+            repex.handle_path(self.path_object)
+        assert repex.ERRORS['prevalidation_failed'] in str(ex.value)
+        assert self._read() == b'"version": "3.1.0-m2"\n' * 3
+
+    def test_interrupted_run_is_rolled_back(self):
+        rpx = repex.Repex(repex._set_path_defaults(self.path_object))
+        with open(self.version_file, 'rb') as f:
+            patches = rpx._find_patches(f.read(), self.version_file)
+        assert [(offset, old) for offset, old, _ in patches] == \
+            [(19, b'2'), (41, b'2'), (63, b'2')]
+        repex._write_journal(self.version_file, patches)
+        # Simulate a run interrupted after writing the first patch only
+        with open(self.version_file, 'r+b') as f:
+            f.seek(19)
+            f.write(b'3')
+
+        repex._recover_journal(self.version_file)
+        assert self._read() == b'"version": "3.1.0-m2"\n' * 3
+        assert os.listdir(self.tmpdir) == ['mock_VERSION']
+
+    def test_journal_of_changed_file_is_discarded(self):
+        rpx = repex.Repex(repex._set_path_defaults(self.path_object))
+        with open(self.version_file, 'rb') as f:
+            patches = rpx._find_patches(f.read(), self.version_file)
+        for edit in (b'"version": "3.1.0-m7"\n' * 3,
+                     b'"version": "3.1.0-m2"\n'):
+            repex._write_journal(self.version_file, patches)
+            with open(self.version_file, 'wb') as f:
+                f.write(edit)
+            repex._recover_journal(self.version_file)
+            assert self._read() == edit
+            assert os.listdir(self.tmpdir) == ['mock_VERSION']
+
+    def test_non_ascii_file_is_rewritten(self):
+        self.path_object.update({'match': '.=1|\\w1', 'replace': '.',
+                                 'with': 'X'})
+        outputs = []
+        for in_place in (False, True):
+            with open(self.version_file, 'wb') as f:
+                f.write('é=1\ncafé1\n'.encode('utf-8'))
+            self.path_object['in_place'] = in_place
+            repex.handle_path(self.path_object)
+            outputs.append(self._read())
+        assert outputs == [b'XXX\ncafXX\n'] * 2
+
+
+class TestMmap():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.version_file = os.path.join(self.tmpdir, 'mock_VERSION')
+        with open(self.version_file, 'wb') as f:
+            f.write(b'"version": "3.1.0-m2"\n"other": "3.1.0-m2"\n' * 2)
+        os.chmod(self.version_file, 0o640)
+        self.path_object = {
+            'path': self.version_file,
+            'match': '"version": "3.1.0-m2"',
+            'replace': '3.1.0-m2',
+            'with': '3.1.0',
+            'mmap_threshold': 0
+        }
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_mapped_file(self):
+        repex.handle_path(self.path_object)
+        assert self._read(self.version_file) == \
+            b'"version": "3.1.0"\n"other": "3.1.0-m2"\n' * 2
+        assert os.stat(self.version_file).st_mode & 0o777 == 0o640
+        assert os.listdir(self.tmpdir) == ['mock_VERSION']
+
+    def test_mapped_file_to_file(self):
+        output_file = os.path.join(self.tmpdir, 'output')
+        self.path_object['to_file'] = output_file
+        repex.handle_path(self.path_object)
+        assert self._read(output_file) == \
+            b'"version": "3.1.0"\n"other": "3.1.0-m2"\n' * 2
+        assert b'"version": "3.1.0-m2"' in self._read(self.version_file)
+
+    def test_files_below_threshold_are_read(self):
+        self.path_object['mmap_threshold'] = 1024
+        repex.handle_path(self.path_object)
+        assert self._read(self.version_file) == \
+            b'"version": "3.1.0"\n"other": "3.1.0-m2"\n' * 2
+
+    def test_must_include(self):
+        self.path_object['must_include'] = ['"version": "3.1.0"']
+        with pytest.raises(repex.RepexError) as ex:
+            repex.handle_path(self.path_object)
+        assert repex.ERRORS['prevalidation_failed'] in str(ex.value)
+
+    def test_same_output_as_reading(self):
+        contents = [
+            b'"version": "3.1.0-m2"\r\n"other": "3.1.0-m2"\r\n',
+            b'"version": "3.1.0-m2"\n"caf\xc3\xa9": "3.1.0-m2"\n',
+            b'"version": "3.1.0-m2"\n"version": "3.1.0-m20"\n',
+        ]
+        self.path_object['match'] = '"version": "[^"]+"'
+        self.path_object['replace'] = '3.1.0-m2'
+        for content in contents:
+            outputs = []
+            for threshold in (0, None):
+                with open(self.version_file, 'wb') as f:
+                    f.write(content)
+                self.path_object['mmap_threshold'] = threshold
+                repex.handle_path(dict(self.path_object))
+                outputs.append(self._read(self.version_file))
+            assert outputs[0] == outputs[1]
+        assert outputs[0] == b'"version": "3.1.0"\n"version": "3.1.00"\n'
+
+    def test_write_replaced_in_order(self):
+        output = io.BytesIO()
+        replacements = {b'ab': b'1', b'abc': b'2', b'1c': b'3', b'': b'_'}
+        repex._write_replaced(b'abcab-ab', replacements, output)
+        assert output.getvalue() == b'_3_1_-_1_'
+        assert output.getvalue() == b'abcab-ab'.replace(
+            b'ab', b'1').replace(b'abc', b'2').replace(b'1c', b'3').replace(
+            b'', b'_')
+
+
+class TestChunked():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.version_file = os.path.join(self.tmpdir, 'mock_VERSION')
+        self.sequential_file = os.path.join(self.tmpdir, 'sequential')
+        lines = []
+        for index in range(200):
+            lines.append('"version": "3.1.{0}-m2"'.format(index % 7))
+            lines.append('"other": "3.1.0-m2"\r')
+        with open(self.version_file, 'w') as f:
+            f.write('\n'.join(lines))
+        shutil.copy(self.version_file, self.sequential_file)
+        self.path_object = {
+            'path': self.version_file,
+            'match': '"version": "3.1.[0-9]-m2"',
+            'replace': '3.1.[0-9]-m2',
+            'with': '3.1.0-m3',
+            'line_mode': True
+        }
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _assert_same_as_sequential(self):
+        path_object = copy.deepcopy(self.path_object)
+        path_object['path'] = self.sequential_file
+        path_object.pop('line_mode', None)
+        path_object.pop('record_separator', None)
+        repex.handle_path(path_object)
+        assert self._read(self.version_file) == \
+            self._read(self.sequential_file)
+
+    def test_split_records(self):
+        chunks = repex._split_records(self.version_file, '\n', 100)
+        content = self._read(self.version_file)
+        assert chunks[0][0] == 0
+        assert chunks[-1][1] == len(content)
+        for (_, end), (start, _) in zip(chunks, chunks[1:]):
+            assert end == start
+            assert content[end - 1:end] == b'\n'
+
+    def test_chunked_file(self, monkeypatch):
+        monkeypatch.setattr(repex, '_CHUNK_SIZE', 256)
+        rpx = repex.Repex(repex._set_path_defaults(self.path_object))
+        assert rpx._handle_chunked_file(self.version_file)
+        assert b'3.1.0-m3' in self._read(self.version_file)
+        self._assert_same_as_sequential()
+
+    def test_record_separator(self, monkeypatch):
+        monkeypatch.setattr(repex, '_CHUNK_SIZE', 256)
+        self.path_object['record_separator'] = '"'
+        repex.handle_path(self.path_object)
+        self._assert_same_as_sequential()
+
+    def test_matches_spanning_records_fall_back(self, monkeypatch):
+        monkeypatch.setattr(repex, '_CHUNK_SIZE', 256)
+        self.path_object['match'] = '-m2"\r?\n"version'
+        self.path_object['replace'] = 'm2'
+        rpx = repex.Repex(repex._set_path_defaults(self.path_object))
+        assert rpx._handle_chunked_file(self.version_file) is None
+        repex.handle_path(self.path_object)
+        self._assert_same_as_sequential()
+
+    def test_anchors_fall_back(self, monkeypatch):
+        monkeypatch.setattr(repex, '_CHUNK_SIZE', 256)
+        self.path_object['match'] = '"other": "3.1.0-m2"$'
+        self.path_object['replace'] = 'm2'
+        rpx = repex.Repex(repex._set_path_defaults(self.path_object))
+        assert rpx._handle_chunked_file(self.version_file) is None
+
+    def test_must_include(self, monkeypatch):
+        monkeypatch.setattr(repex, '_CHUNK_SIZE', 256)
+        self.path_object['must_include'] = ['3.1.6-m2', '3.1.7-m2']
+        with pytest.raises(repex.RepexError) as ex:
+            repex.handle_path(self.path_object)
+        assert repex.ERRORS['prevalidation_failed'] in str(ex.value)
+
+
+class TestBatch():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = []
+        for index in range(20):
+            path = os.path.join(self.tmpdir, 'mock_VERSION{0}'.format(index))
+            version = '3.1.0-m2' if index % 5 == 0 else '3.1.0-m1'
+            with open(path, 'w') as f:
+                f.write('"version": "{0}"\n"other": "x"'.format(version))
+            self.files.append(path)
+        self.path_object = {
+            'type': 'mock_VERSION.*',
+            'path': '.*',
+            'base_directory': self.tmpdir,
+            'match': '"version": "3.1.0-m2"',
+            'replace': '3.1.0-m2',
+            'with': '3.1.0-m3',
+            'batch_size': 200
+        }
+        self.handled = []
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _record_handled(self, monkeypatch):
+        handle_file = repex.Repex.handle_file
+
+        def record(rpx, file_to_handle):
+            self.handled.append(file_to_handle)
+            return handle_file(rpx, file_to_handle)
+
+        monkeypatch.setattr(repex.Repex, 'handle_file', record)
+
+    def test_only_files_with_matches_are_handled(self, monkeypatch):
+        self._record_handled(monkeypatch)
+        repex.handle_path(self.path_object)
+        assert sorted(self.handled) == sorted(self.files[::5])
+        for index, path in enumerate(self.files):
+            with open(path) as f:
+                expected = '3.1.0-m3' if index % 5 == 0 else '3.1.0-m1'
+                assert expected in f.read()
+
+    def test_files_lacking_required_strings_are_handled(self, monkeypatch):
+        with open(self.files[1], 'w') as f:
+            f.write('"version": "3.1.0-m1"')
+        self.path_object['must_include'] = ['"other"']
+        self._record_handled(monkeypatch)
+        with pytest.raises(repex.RepexError) as ex:
+            repex.handle_path(self.path_object)
+        assert repex.ERRORS['prevalidation_failed'] in str(ex.value)
+        assert self.handled[-1] == self.files[1]
+
+    def test_hits_spanning_files(self):
+        rpx = repex.Repex(repex._set_path_defaults(self.path_object))
+        rpx.match_expression = re.compile('(?P<matchgroup>x".*"version)')
+        candidates = repex._scan_batch(
+            rpx, ['a', 'b', 'c'], ['"x"', '"version"', '"other"'])
+        assert candidates == set(['a', 'b'])
+
+    def test_anchored_patterns_are_not_batched(self):
+        self.path_object['match'] = '^"version": "3.1.0-m2"'
+        rpx = repex.Repex(repex._set_path_defaults(self.path_object))
+        assert repex._batch_candidates(rpx, self.files, 200) == \
+            set(self.files)
+
+    def test_batching_stops_when_most_files_hit(self, monkeypatch):
+        self.path_object['match'] = '"version"'
+        read = []
+        read_for_batch = repex._read_for_batch
+        monkeypatch.setattr(repex, '_read_for_batch', lambda *args: (
+            read.append(args[1]), read_for_batch(*args))[1])
+        rpx = repex.Repex(repex._set_path_defaults(self.path_object))
+        assert repex._batch_candidates(rpx, self.files, 200) == \
+            set(self.files)
+        # The first batch is scanned, and the file which did not fit in it
+        assert len(read) == 6
+
+    def test_report(self, monkeypatch):
+        report = repex._Report()
+        report.add_path('batch')
+        repex.handle_path(self.path_object, report=report)
+        stats = report.to_dict()['stats']
+        assert stats == {'files': 20, 'changed': 4}
+
+
+class TestCombineLiterals():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.version_file = os.path.join(self.tmpdir, 'mock_VERSION')
+        with open(self.version_file, 'w') as f:
+            f.write('"version": "3.1.0-m2"\nhost: old.example.com\n')
+        self.paths = [
+            {
+                'description': 'version',
+                'path': self.version_file,
+                'match': '"version": "3\\.1\\.0-m2"',
+                'replace': 'm2',
+                'with': '{{ .milestone }}'
+            },
+            {
+                'description': 'host',
+                'path': self.version_file,
+                'match': 'old\\.example\\.com',
+                'replace': 'old',
+                'with': 'new'
+            }
+        ]
+        self.variables = {'milestone': 'm3'}
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _iterate(self):
+        repex.iterate(config={'variables': self.variables,
+                              'paths': self.paths})
+        with open(self.version_file) as f:
+            return f.read()
+
+    def test_literal(self):
+        assert repex._literal('3\\.1\\.0') == '3.1.0'
+        assert repex._literal('3.1.0') is None
+        assert repex._literal('(?i)version') is None
+        assert repex._literal('a|b') is None
+
+    def test_combine(self):
+        paths = repex._combine_literal_paths(self.paths, self.variables)
+        assert len(paths) == 1
+        assert paths[0]['description'] == 'version, host'
+        assert paths[0]['_literals'] == {
+            '"version": "3.1.0-m2"': '"version": "3.1.0-m3"',
+            'old.example.com': 'new.example.com'
+        }
+
+    def test_combined_paths_scan_once(self, monkeypatch):
+        handled = []
+        handle_file = repex.Repex.handle_file
+
+        def record(rpx, file_to_handle):
+            handled.append(file_to_handle)
+            return handle_file(rpx, file_to_handle)
+
+        monkeypatch.setattr(repex.Repex, 'handle_file', record)
+        assert self._iterate() == \
+            '"version": "3.1.0-m3"\nhost: new.example.com\n'
+        assert handled == [self.version_file]
+
+    def test_overlapping_paths_are_not_combined(self):
+        self.paths.append({
+            'path': self.version_file,
+            'match': 'new\\.example',
+            'replace': 'new',
+            'with': 'newer'
+        })
+        paths = repex._combine_literal_paths(self.paths, self.variables)
+        assert len(paths) == 2
+        assert self._iterate() == \
+            '"version": "3.1.0-m3"\nhost: newer.example.com\n'
+
+    def test_regular_expressions_are_not_combined(self):
+        self.paths[1]['match'] = 'old.example.com'
+        paths = repex._combine_literal_paths(self.paths, self.variables)
+        assert paths == self.paths
+
+
+class TestRegexGuard():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.version_file = os.path.join(self.tmpdir, 'mock_VERSION')
+        with open(self.version_file, 'w') as f:
+            f.write('"version": "3.1.0-m2"\n' + 'a' * 40 + '!')
+        self.path_object = {
+            'description': 'slow',
+            'path': self.version_file,
+            'match': '"version": "3.1.0-m2"',
+            'replace': '3.1.0-m2',
+            'with': '3.1.0-m3',
+            'regex_timeout': 5
+        }
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_has_nested_repeats(self):
+        assert repex._has_nested_repeats('(a+)+$')
+        assert repex._has_nested_repeats('((\\w+\\s?)*)$')
+        assert repex._has_nested_repeats('x(?=(a*)*)')
+        assert not repex._has_nested_repeats('a+b*')
+        assert not repex._has_nested_repeats('(ab+){2}')
+
+    def test_validation_warns(self, caplog):
+        self.path_object['match'] = '(a+)+$'
+        repex._validate_config_schema({'paths': [self.path_object]})
+        assert '`(a+)+$` of path `slow`' in caplog.text
+
+    def test_later_path_without_match(self):
+        second_path = dict(self.path_object, description='second')
+        del second_path['match']
+        del second_path['regex_timeout']
+        config = {'paths': [self.path_object, second_path]}
+        repex._validate_config_schema(config)
+        repex.iterate(config=config)
+        with open(self.version_file) as f:
+            assert '3.1.0-m3' in f.read()
+
+    def test_scan_within_timeout(self):
+        repex.handle_path(self.path_object)
+        with open(self.version_file) as f:
+            assert '3.1.0-m3' in f.read()
+
+    def test_scan_timeout(self):
+        self.path_object['match'] = '(a+)+$'
+        self.path_object['replace'] = 'a'
+        self.path_object['regex_timeout'] = 0.5
+        with pytest.raises(repex.RepexError) as ex:
+            repex.handle_path(self.path_object)
+        assert repex.ERRORS['regex_timeout'] in str(ex.value)
+        assert self.version_file in str(ex.value)
+        assert '(a+)+$' in str(ex.value)
+        assert not os.path.exists(self.version_file + '.repex.tmp')
+
+    def test_must_include_timeout(self):
+        self.path_object['must_include'] = ['(a+)+$']
+        self.path_object['regex_timeout'] = 0.5
+        with pytest.raises(repex.RepexError) as ex:
+            repex.handle_path(self.path_object)
+        assert repex.ERRORS['regex_timeout'] in str(ex.value)
+
+
+class TestEngine():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.version_file = os.path.join(self.tmpdir, 'mock_VERSION')
+        with open(self.version_file, 'w') as f:
+            f.write('"version": "3.1.0-m2"\n')
+        self.path_object = {
+            'path': self.version_file,
+            'match': '"version": "\\d++\\.\\d+\\.\\d+-m2"',
+            'replace': 'm2',
+            'with': 'm3'
+        }
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _read(self):
+        with open(self.version_file) as f:
+            return f.read()
+
+    def test_default_engine(self):
+        assert repex._get_engine() is re
+        assert repex._get_engine('re') is re
+        self.path_object['match'] = '"version": "\\d+\\.\\d+\\.\\d+-m2"'
+        repex.handle_path(self.path_object)
+        assert self._read() == '"version": "3.1.0-m3"\n'
+
+    def test_engine_not_installed(self):
+        with pytest.raises(repex.RepexError) as ex:
+            repex._get_engine('no_such_engine')
+        assert repex.ERRORS['engine_not_installed'] in str(ex.value)
+
+    def test_regex_engine(self):
+        pytest.importorskip('regex')
+        self.path_object['engine'] = 'regex'
+        repex.handle_path(self.path_object)
+        assert self._read() == '"version": "3.1.0-m3"\n'
+
+    def test_regex_engine_timeout(self):
+        pytest.importorskip('regex')
+        with open(self.version_file, 'w') as f:
+            f.write('a' * 40 + '!')
+        self.path_object.update({
+            'engine': 'regex',
+            'match': '(a|aa)+$',
+            'replace': 'a',
+            'regex_timeout': 0.5
+        })
+        with pytest.raises(repex.RepexError) as ex:
+            repex.handle_path(self.path_object)
+        assert repex.ERRORS['regex_timeout'] in str(ex.value)
+
+    def test_re2_engine(self):
+        pytest.importorskip('re2')
+        self.path_object['match'] = '"version": "\\d+\\.\\d+\\.\\d+-m2"'
+        repex.iterate(config={'paths': [self.path_object]}, engine='re2')
+        assert self._read() == '"version": "3.1.0-m3"\n'
+
+    def test_unsupported_pattern_fails_validation(self):
+        pytest.importorskip('re2')
+        self.path_object['match'] = '(?<=")version'
+        self.path_object['engine'] = 're2'
+        with pytest.raises(repex.RepexError) as ex:
+            repex._validate_config_schema({'paths': [self.path_object]})
+        assert repex.ERRORS['invalid_pattern'] in str(ex.value)
+        assert '(?<=")version' in str(ex.value)
+
+
+class TestMustInclude():
+
+    def _search(self, patterns, content):
+        expressions = (repex._combine_required(patterns),
+                       [re.compile(pattern) for pattern in patterns])
+        return repex._search_required(expressions, content)
+
+    def test_single_scan(self):
+        assert self._search(['version', '3\\.1', 'm\\d'],
+                            '"version": "3.1.0-m2"') == [True, True, True]
+
+    def test_shadowed_patterns_are_found(self):
+        # `3.1` matches wherever `3` does, so it is only found on its own
+        assert self._search(['3', '3.1'], 'x3.1') == [True, True]
+
+    def test_stops_at_first_missing_pattern(self):
+        assert self._search(['version', 'm3', 'm4', 'm2'],
+                            '"version": "3.1.0-m2"') == \
+            [True, False, None, True]
+
+    def test_uncombinable_patterns(self):
+        assert repex._combine_required(['(a)\\1', 'b']) is None
+        assert repex._combine_required(['(?i)a', 'b']) is None
+        assert repex._combine_required(['(?P<x>a)', '(?P<x>b)']) is None
+        assert repex._combine_required(['a']) is None
+        assert self._search(['(a)\\1', 'b'], 'aab') == [True, True]
+
+    def test_must_include_checked_before_temp_file(self, monkeypatch):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'mock_VERSION')
+            with open(path, 'w') as f:
+                f.write('"version": "3.1.0-m2"')
+            rpx = repex.Repex(repex._set_path_defaults({
+                'path': path,
+                'match': '3.1.0-m2',
+                'replace': '3.1.0-m2',
+                'with': '3.1.0-m3',
+                'must_include': ['version', 'm4']
+            }))
+            with pytest.raises(repex.RepexError):
+                rpx.handle_file(path)
+            assert os.listdir(tmpdir) == ['mock_VERSION']
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+class TestTransform():
+
+    def setup_method(self, test_method):
+        self.rpx = repex.Repex({
+            'match': '"version": "\\d+\\.\\d+\\.\\d+-m\\d"',
+            'replace': 'm\\d',
+            'with': 'm3'
+        })
+        self.content = '"version": "3.1.0-m2"\n"version": "3.1.1-m1"\nm2'
+
+    def test_transform(self):
+        result, stats = self.rpx.transform(self.content)
+        assert result == '"version": "3.1.0-m3"\n"version": "3.1.1-m3"\nm2'
+        assert stats == {'matches': 2, 'replacements': 2}
+
+    def test_transform_bytes(self):
+        result, stats = self.rpx.transform(self.content.encode('utf-8'))
+        assert result == b'"version": "3.1.0-m3"\n"version": "3.1.1-m3"\nm2'
+        assert stats == {'matches': 2, 'replacements': 2}
+
+    def test_transform_without_matches(self):
+        assert self.rpx.transform('m2') == \
+            ('m2', {'matches': 0, 'replacements': 0})
+
+    def test_transform_must_include(self):
+        self.rpx.must_include = ['version', '3\\.2']
+        with pytest.raises(repex.RepexError) as ex:
+            self.rpx.transform(self.content)
+        assert repex.ERRORS['prevalidation_failed'] in str(ex.value)
+
+    def test_transform_stream(self):
+        reader = io.BytesIO(self.content.encode('utf-8'))
+        writer = io.BytesIO()
+        stats = self.rpx.transform_stream(reader, writer)
+        assert writer.getvalue() == \
+            b'"version": "3.1.0-m3"\n"version": "3.1.1-m3"\nm2'
+        assert stats == {'matches': 2, 'replacements': 2}
+
+
+class TestFilter():
+
+    def setup_method(self, test_method):
+        self.content = '"version": "3.1.0-m2"\r\nother: 3.1.0-m2\n'
+
+    def _filter(self, params, content=None):
+        runner = clicktest.CliRunner(mix_stderr=False)
+        return runner.invoke(
+            repex.main, ['-'] + shlex.split(params),
+            input=(content or self.content).encode('utf-8'))
+
+    def test_filter(self):
+        result = self._filter("-r m2 -w m3 -m '\"version\": \"3.1.0-m2\"'")
+        assert result.exit_code == 0
+        assert result.stdout_bytes == \
+            b'"version": "3.1.0-m3"\r\nother: 3.1.0-m2\n'
+        assert 'Found 1 matches in <content>' in result.stderr
+
+    def test_filter_line_mode(self):
+        result = self._filter("-r m2 -w m3 -m 'version.*m2' --line-mode")
+        assert result.exit_code == 0
+        assert result.stdout_bytes == \
+            b'"version": "3.1.0-m3"\r\nother: 3.1.0-m2\n'
+
+    def test_filter_must_include(self):
+        result = self._filter('-r m2 -w m3 --line-mode -i m2 -i m4')
+        assert result.exit_code != 0
+        # No content is written before all required strings are found
+        assert b'version' not in result.stdout_bytes
+        assert 'Required string `m4` not found' in result.stderr
+
+    def test_filter_incompatible_options(self):
+        result = self._filter('-r m2 -w m3 --to-file out')
+        assert result.exit_code == 2
+        assert '--to-file' in result.stderr
+
+    def test_read_records(self):
+        reader = io.StringIO('a\nbb\nccc\nd')
+        blocks = list(repex._read_records(reader, '\n', block_size=3))
+        assert ''.join(blocks) == 'a\nbb\nccc\nd'
+        assert all(block.endswith('\n') for block in blocks[:-1])
+        assert blocks[-1] == 'd'
+
+    def test_transform_stream_in_blocks(self, monkeypatch):
+        monkeypatch.setattr(repex, '_CHUNK_SIZE', 8)
+        rpx = repex.Repex({'match': 'm2', 'replace': 'm2', 'with': 'm3',
+                           'line_mode': True, 'must_include': ['other']})
+        reader = io.BytesIO(self.content.encode('utf-8') * 3)
+        writer = io.BytesIO()
+        stats = rpx.transform_stream(reader, writer)
+        assert writer.getvalue() == \
+            b'"version": "3.1.0-m3"\r\nother: 3.1.0-m3\n' * 3
+        assert stats == {'matches': 1, 'replacements': 1}
+
+    def test_blocks_give_same_output(self, monkeypatch):
+        monkeypatch.setattr(repex, '_CHUNK_SIZE', 4)
+        path_object = {'match': 'a+', 'replace': 'a', 'with': 'b'}
+        content = 'aaa\naaaa\n' * 3 + 'end\n'
+        expected, _ = repex.Repex(path_object).transform(content)
+        rpx = repex.Repex(dict(path_object, line_mode=True,
+                               must_include=['end']))
+        for reader, writer in ((io.StringIO(content, newline=''),
+                                io.StringIO(newline='')),
+                               (io.BytesIO(content.encode('utf-8')),
+                                io.BytesIO())):
+            rpx.transform_stream(reader, writer)
+            output = writer.getvalue()
+            if isinstance(output, bytes):
+                output = output.decode('utf-8')
+            assert output == expected == 'bbb\nbbba\n' * 3 + 'end\n'
+
+    def test_whole_stream_is_spilled(self, monkeypatch):
+        monkeypatch.setattr(repex, '_CHUNK_SIZE', 8)
+        rpx = repex.Repex({'match': '"version": "3.1.0-m2"',
+                           'replace': 'm2', 'with': 'm3'})
+        content = self.content.encode('utf-8') * 3
+        expected, expected_stats = rpx.transform(content)
+        writer = io.BytesIO()
+        stats = rpx.transform_stream(io.BytesIO(content), writer)
+        assert writer.getvalue() == expected
+        assert stats == expected_stats == {'matches': 1, 'replacements': 1}
+
+        rpx.must_include = ['m4']
+        with pytest.raises(repex.RepexError) as ex:
+            rpx.transform_stream(io.BytesIO(content), io.BytesIO())
+        assert repex.ERRORS['prevalidation_failed'] in str(ex.value)
+
+
+class TestArchive():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.members = {
+            'conf/app.yaml': b'version: 3.1.0-m2\r\n',
+            'conf/logo.bin': b'\0version: 3.1.0-m2',
+            'README': b'version: 3.1.0-m2\n',
+        }
+        self.path_object = {
+            'type': r'.*\.(tar\.gz|zip)$',
+            'path': '.',
+            'base_directory': self.tmpdir,
+            'archive_member': r'conf/.*',
+            'replace': '3.1.0-m2',
+            'with': '3.1.0'
+        }
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _make_tar(self):
+        path = os.path.join(self.tmpdir, 'archive.tar.gz')
+        with tarfile.open(path, 'w:gz') as archive:
+            for name, content in self.members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                info.mode = 0o600
+                archive.addfile(info, io.BytesIO(content))
+        return path
+
+    def _make_zip(self):
+        path = os.path.join(self.tmpdir, 'archive.zip')
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.comment = b'comment'
+            for name, content in self.members.items():
+                archive.writestr(name, content)
+        return path
+
+    def _read_tar(self, path):
+        with tarfile.open(path, 'r:gz') as archive:
+            return dict((member.name, archive.extractfile(member).read())
+                        for member in archive)
+
+    def test_tar(self):
+        path = self._make_tar()
+        repex.handle_path(self.path_object)
+        members = self._read_tar(path)
+        assert list(members) == list(self.members)
+        assert members['conf/app.yaml'] == b'version: 3.1.0\r\n'
+        assert members['conf/logo.bin'] == self.members['conf/logo.bin']
+        assert members['README'] == self.members['README']
+        with tarfile.open(path) as archive:
+            assert archive.getmember('conf/app.yaml').mode == 0o600
+        assert os.listdir(self.tmpdir) == ['archive.tar.gz']
+
+    def test_zip(self):
+        path = self._make_zip()
+        repex.handle_path(self.path_object)
+        with zipfile.ZipFile(path) as archive:
+            assert archive.namelist() == list(self.members)
+            assert archive.read('conf/app.yaml') == b'version: 3.1.0\r\n'
+            assert archive.read('README') == self.members['README']
+            assert archive.comment == b'comment'
+            assert archive.getinfo('README').compress_type == \
+                zipfile.ZIP_DEFLATED
+
+    def test_unchanged_archive_is_not_rewritten(self):
+        path = self._make_zip()
+        self.path_object['archive_member'] = 'README.md'
+        mtime = os.stat(path).st_mtime_ns
+        os.utime(path, ns=(mtime - 10 ** 9, mtime - 10 ** 9))
+        repex.handle_path(self.path_object)
+        assert os.stat(path).st_mtime_ns == mtime - 10 ** 9
+
+    def test_not_an_archive(self):
+        path = os.path.join(self.tmpdir, 'plain.zip')
+        with open(path, 'w') as f:
+            f.write('version: 3.1.0-m2')
+        with pytest.raises(repex.RepexError) as ex:
+            repex.handle_path(self.path_object)
+        assert repex.ERRORS['not_an_archive'] in str(ex.value)
+
+    def test_archive_report(self):
+        self._make_tar()
+        report = repex._Report()
+        repex.handle_path(self.path_object, report=report)
+        summary = report.to_dict()['paths'][0]['files'][0]
+        assert summary['changed']
+        assert '+version: 3.1.0\r\n' in summary['diff']
+        assert ' [conf/app.yaml]\n' in summary['diff']
+
+
+class TestCompression():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.content = b'"version": "3.1.0-m2"\r\nother: 3.1.0-m2\n'
+        self.path_object = {
+            'type': r'.*\.(gz|bz2|xz)$',
+            'path': '.',
+            'base_directory': self.tmpdir,
+            'match': '"version": "3.1.0-m2"',
+            'replace': '3.1.0-m2',
+            'with': '3.1.0',
+            'compression': 'auto'
+        }
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_gzip(self):
+        path = os.path.join(self.tmpdir, 'file.gz')
+        with open(path, 'wb') as f:
+            with gzip.GzipFile('original', 'wb', 1, f, mtime=0) as writer:
+                writer.write(self.content)
+        repex.handle_path(self.path_object)
+        assert gzip.decompress(self._read(path)) == \
+            b'"version": "3.1.0"\r\nother: 3.1.0-m2\n'
+        assert repex._gzip_header(path) == (1, 'original', 0)
+        assert os.listdir(self.tmpdir) == ['file.gz']
+
+    def test_bz2_and_xz(self):
+        bz2_path = self._write(
+            'file.bz2', bz2.compress(self.content, compresslevel=3))
+        xz_path = self._write(
+            'file.xz', lzma.compress(self.content, check=lzma.CHECK_SHA256))
+        self.path_object['line_mode'] = True
+        repex.handle_path(self.path_object)
+        expected = b'"version": "3.1.0"\r\nother: 3.1.0-m2\n'
+        assert bz2.decompress(self._read(bz2_path)) == expected
+        assert self._read(bz2_path)[:4] == b'BZh3'
+        assert lzma.decompress(self._read(xz_path)) == expected
+        assert self._read(xz_path)[7] == lzma.CHECK_SHA256
+
+    def test_file_without_matches_is_not_recompressed(self):
+        compressed = gzip.compress(b'other: 3.1.0-m2\n')
+        path = self._write('file.gz', compressed)
+        repex.handle_path(self.path_object)
+        assert self._read(path) == compressed
+
+    def test_auto_handles_uncompressed_files(self):
+        path = self._write('file.gz', self.content)
+        repex.handle_path(self.path_object)
+        assert b'"version": "3.1.0"' in self._read(path)
+
+    def test_wrong_compression(self):
+        self._write('file.gz', bz2.compress(self.content))
+        self.path_object['compression'] = 'gzip'
+        with pytest.raises(repex.RepexError) as ex:
+            repex.handle_path(self.path_object)
+        assert repex.ERRORS['not_compressed'] in str(ex.value)
+
+    def test_compressed_binary_files_are_skipped(self):
+        compressed = gzip.compress(b'\0' + self.content)
+        path = self._write('file.gz', compressed)
+        self.path_object['skip_binary'] = True
+        repex.handle_path(self.path_object)
+        assert self._read(path) == compressed
+
+    def test_failed_prevalidation_leaves_no_temp_file(self):
+        path = self._write('file.gz', gzip.compress(self.content))
+        self.path_object['must_include'] = ['missing']
+        with pytest.raises(repex.RepexError):
+            repex.handle_path(self.path_object)
+        assert os.listdir(self.tmpdir) == ['file.gz']
+        assert gzip.decompress(self._read(path)) == self.content
+
+    def test_must_include_without_matches(self):
+        compressed = gzip.compress(b'other: 3.1.0-m2\n')
+        self._write('file.gz', compressed)
+        self.path_object['must_include'] = ['missing']
+        for line_mode in (False, True):
+            self.path_object['line_mode'] = line_mode
+            with pytest.raises(repex.RepexError) as ex:
+                repex.handle_path(dict(self.path_object))
+            assert repex.ERRORS['prevalidation_failed'] in str(ex.value)
+        assert os.listdir(self.tmpdir) == ['file.gz']
+
+    def test_decompressed_once(self, monkeypatch):
+        path = self._write('file.gz', gzip.compress(self.content))
+        opened = []
+        gzip_open = gzip.open
+
+        def counting_open(*args, **kwargs):
+            opened.append(args[0])
+            return gzip_open(*args, **kwargs)
+
+        monkeypatch.setattr(gzip, 'open', counting_open)
+        # Skipping binary files decompresses the start of each file
+        self.path_object['skip_binary'] = False
+        repex.handle_path(self.path_object)
+        assert opened == [path]
+        assert gzip.decompress(self._read(path)) == \
+            b'"version": "3.1.0"\r\nother: 3.1.0-m2\n'
+
+    def test_same_output_as_plain_file(self, monkeypatch):
+        monkeypatch.setattr(repex, '_CHUNK_SIZE', 4)
+        self.path_object.update({
+            'type': 'file.*', 'replace': 'a', 'with': 'b', 'line_mode': True})
+        cases = (
+            (b'aaa\naaaa\n', 'a+', b'bbb\nbbba\n'),
+            # A match spanning records
+            (b'a\na\naaaa\n', 'a+\na', b'b\nb\naaaa\n'))
+        for content, match, expected in cases:
+            plain = self._write('file', content)
+            compressed = self._write('file.gz', gzip.compress(content))
+            self.path_object['match'] = match
+            repex.handle_path(dict(self.path_object))
+            assert self._read(plain) == expected
+            assert gzip.decompress(self._read(compressed)) == expected
+
+
+class TestOutputDirectory():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.base_directory = os.path.join(self.tmpdir, 'source')
+        self.output_directory = os.path.join(self.tmpdir, 'output')
+        os.makedirs(os.path.join(self.base_directory, 'nested'))
+        self.files = {
+            'VERSION': '"version": "3.1.0-m2"\n',
+            os.path.join('nested', 'VERSION'): '"version": "3.1.0-m3"\n',
+            os.path.join('nested', 'other'): '"version": "3.1.0-m2"\n',
+        }
+        for name, content in self.files.items():
+            with open(os.path.join(self.base_directory, name), 'w') as f:
+                f.write(content)
+        self.path_object = {
+            'type': 'VERSION',
+            'path': '.',
+            'base_directory': self.base_directory,
+            'output_directory': self.output_directory,
+            'replace': '3.1.0-m2',
+            'with': '3.1.0'
+        }
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _read(self, *path):
+        with open(os.path.join(*path)) as f:
+            return f.read()
+
+    def test_output_directory(self):
+        repex.handle_path(self.path_object)
+        for name, content in self.files.items():
+            assert self._read(self.base_directory, name) == content
+        assert self._read(self.output_directory, 'VERSION') == \
+            '"version": "3.1.0"\n'
+        assert self._read(self.output_directory, 'nested', 'VERSION') == \
+            self.files[os.path.join('nested', 'VERSION')]
+        assert self._read(self.output_directory, 'nested', 'other') == \
+            self.files[os.path.join('nested', 'other')]
+        assert not os.path.samefile(
+            os.path.join(self.base_directory, 'VERSION'),
+            os.path.join(self.output_directory, 'VERSION'))
+
+    def test_paths_build_on_each_other(self):
+        path_object = copy.deepcopy(self.path_object)
+        path_object.update({'replace': '3.1.0', 'with': '3.2.0'})
+        repex.handle_path(self.path_object)
+        repex.handle_path(path_object)
+        assert self._read(self.output_directory, 'VERSION') == \
+            '"version": "3.2.0"\n'
+
+    def test_output_directory_under_base_directory(self):
+        output_directory = os.path.join(self.base_directory, 'output')
+        self.path_object['output_directory'] = output_directory
+        repex.handle_path(self.path_object)
+        repex.handle_path(self.path_object)
+        assert not os.path.exists(os.path.join(output_directory, 'output'))
+        assert self._read(output_directory, 'VERSION') == \
+            '"version": "3.1.0"\n'
+
+    def test_in_place_does_not_write_through_links(self):
+        self.path_object['in_place'] = True
+        self.path_object['with'] = '3.1.0-m4'
+        repex.handle_path(self.path_object)
+        assert self._read(self.base_directory, 'VERSION') == \
+            self.files['VERSION']
+        assert self._read(self.output_directory, 'VERSION') == \
+            '"version": "3.1.0-m4"\n'
+
+    def test_per_type_validator_validates_output(self, monkeypatch):
+        validated = []
+        monkeypatch.setattr(repex, '_assert_validated',
+                            lambda validator, path: validated.append(path))
+        self.path_object['validator'] = {
+            'type': 'per_type',
+            'path': os.path.join(TEST_RESOURCES_DIR, 'validator.py'),
+            'function': 'succeed_validate'
+        }
+        repex.handle_path(dict(self.path_object))
+        asyncio.run(repex.async_handle_path(dict(self.path_object)))
+        assert len(validated) == 2
+        assert validated[0] == validated[1]
+        assert validated[0].startswith(self.output_directory)
+
+    def test_link_or_copy_falls_back_to_copying(self, monkeypatch):
+        def fail(*args):
+            raise OSError(errno.EXDEV, 'Cross-device link')
+
+        monkeypatch.setattr(repex, 'fcntl', None)
+        monkeypatch.setattr(os, 'link', fail)
+        source = os.path.join(self.base_directory, 'VERSION')
+        target = os.path.join(self.tmpdir, 'copy')
+        repex._link_or_copy(source, target)
+        assert self._read(target) == self.files['VERSION']
+        assert not os.path.samefile(source, target)
+
+    def test_output_directory_and_to_file(self):
+        self.path_object['to_file'] = os.path.join(self.tmpdir, 'file')
+        with pytest.raises(repex.RepexError) as ex:
+            repex.handle_path(self.path_object)
+        assert repex.ERRORS['output_directory_and_to_file'] in str(ex.value)
+
+
+class TestDedupe():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.real_directory = os.path.join(self.tmpdir, 'real')
+        os.makedirs(self.real_directory)
+        self.version_file = os.path.join(self.real_directory, 'VERSION')
+        with open(self.version_file, 'w') as f:
+            f.write('"version": "3.1.0-m2"\n')
+        self.path_object = {
+            'type': 'VERSION.*',
+            'path': '.',
+            'base_directory': self.tmpdir,
+            'replace': '3.1.0-m2',
+            'with': '3.1.0'
+        }
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_hard_links_are_handled_once_and_kept(self):
+        hard_link = os.path.join(self.tmpdir, 'VERSION')
+        os.link(self.version_file, hard_link)
+        files = repex._find_files(repex._prepare_path(self.path_object))
+        assert files == [hard_link]
+        repex.handle_path(self.path_object)
+        assert os.path.samefile(hard_link, self.version_file)
+        assert self._read(self.version_file) == '"version": "3.1.0"\n'
+
+    def test_symlinks_are_written_through(self):
+        symlink = os.path.join(self.tmpdir, 'VERSION')
+        os.symlink(self.version_file, symlink)
+        files = repex._find_files(repex._prepare_path(self.path_object))
+        assert files == [self.version_file]
+        self.path_object['type'] = 'VERSION'
+        self.path_object['path'] = '^{0}$'.format(self.tmpdir)
+        repex.handle_path(self.path_object)
+        assert os.path.islink(symlink)
+        assert self._read(self.version_file) == '"version": "3.1.0"\n'
+
+    def test_follow_symlinks(self):
+        linked_directory = os.path.join(self.tmpdir, 'linked')
+        os.symlink(self.real_directory, linked_directory)
+        # A cycle
+        os.symlink(self.tmpdir, os.path.join(self.real_directory, 'loop'))
+        self.path_object['path'] = 'linked'
+        files = repex._find_files(repex._prepare_path(self.path_object))
+        assert files == []
+        self.path_object['follow_symlinks'] = True
+        files = repex._find_files(repex._prepare_path(self.path_object))
+        assert files == [os.path.join(linked_directory, 'VERSION')]
+
+    def test_dedupe_content(self, monkeypatch):
+        copied_file = os.path.join(self.tmpdir, 'VERSION')
+        shutil.copy(self.version_file, copied_file)
+        self.path_object['dedupe_content'] = True
+        transformed = []
+        transform = repex.Repex._transform
+
+        def counting_transform(rpx, content, source, *args, **kwargs):
+            transformed.append(source)
+            return transform(rpx, content, source, *args, **kwargs)
+
+        monkeypatch.setattr(repex.Repex, '_transform', counting_transform)
+        repex.handle_path(self.path_object)
+        assert len(transformed) == 1
+        assert self._read(copied_file) == '"version": "3.1.0"\n'
+        assert self._read(self.version_file) == '"version": "3.1.0"\n'
+
+
+class TestConcurrentRuns():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.version_file = os.path.join(self.tmpdir, 'VERSION')
+        with open(self.version_file, 'w') as f:
+            f.write('"version": "3.1.0-m2"\n"other": "3.1.0-m2"\n')
+        self.path_object = {
+            'path': self.version_file,
+            'match': '"version": "3.1.0-m2"',
+            'replace': '3.1.0-m2',
+            'with': '3.1.0'
+        }
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _read(self):
+        with open(self.version_file) as f:
+            return f.read()
+
+    def test_temp_files_are_unique(self):
+        first = repex._temp_path(self.version_file)
+        second = repex._temp_path(self.version_file)
+        assert first != second
+        assert repex._is_temp_file(first)
+        assert os.path.dirname(first) == self.tmpdir
+
+    @pytest.mark.skipif(repex.fcntl is None, reason='Requires flock')
+    def test_handling_waits_for_lock(self):
+        with repex._file_lock(self.version_file):
+            handling = threading.Thread(
+                target=repex.handle_path, args=(self.path_object,))
+            handling.start()
+            handling.join(0.2)
+            assert handling.is_alive()
+            # Replace the file, as another run would, while the lock
+            # is waited for
+            replacement = self.version_file + '.new'
+            with open(replacement, 'w') as f:
+                f.write('"version": "3.1.0-m2"\n"other": "3.2.0"\n')
+            os.replace(replacement, self.version_file)
+        handling.join()
+        assert self._read() == '"version": "3.1.0"\n"other": "3.2.0"\n'
+
+    def test_file_changed_while_handled(self, monkeypatch):
+        transform = repex.Repex._transform
+
+        def transform_and_change(rpx, content, source, *args, **kwargs):
+            result = transform(rpx, content, source, *args, **kwargs)
+            with open(self.version_file, 'a') as f:
+                f.write('appended\n')
+            return result
+
+        monkeypatch.setattr(repex.Repex, '_transform', transform_and_change)
+        with pytest.raises(repex.RepexError) as ex:
+            repex.handle_path(self.path_object)
+        assert repex.ERRORS['file_changed'] in str(ex.value)
+        assert self._read().endswith('appended\n')
+        assert os.listdir(self.tmpdir) == ['VERSION']
+
+
+class TestThrottle():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        for index in range(3):
+            path = os.path.join(self.tmpdir, 'VERSION{0}'.format(index))
+            with open(path, 'w') as f:
+                f.write('"version": "3.1.0-m2"\n')
+        self.path_object = {
+            'type': 'VERSION.*',
+            'path': '.',
+            'base_directory': self.tmpdir,
+            'replace': '3.1.0-m2',
+            'with': '3.1.0'
+        }
+        self.now = 0.0
+        self.sleeps = []
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _mock_time(self, monkeypatch):
+        def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+        monkeypatch.setattr(repex.time, 'monotonic', lambda: self.now)
+        monkeypatch.setattr(repex.time, 'sleep', sleep)
+
+    def test_token_bucket(self, monkeypatch):
+        self._mock_time(monkeypatch)
+        bucket = repex._TokenBucket(100)
+        bucket.take(100)
+        assert self.sleeps == []
+        bucket.take(50)
+        assert self.sleeps == [0.5]
+        self.now += 10
+        bucket.take(250)
+        assert self.sleeps == [0.5, 1.5]
+
+    def test_unlimited_bucket(self, monkeypatch):
+        self._mock_time(monkeypatch)
+        repex._TokenBucket().take(10 ** 9)
+        assert self.sleeps == []
+
+    def test_max_files_per_second(self, monkeypatch):
+        self._mock_time(monkeypatch)
+        self.path_object['max_files_per_second'] = 1
+        repex.handle_path(self.path_object)
+        assert self.sleeps == [1.0, 1.0]
+
+    def test_max_bytes_per_second(self, monkeypatch):
+        self._mock_time(monkeypatch)
+        # 22 bytes are read and 19 are written per file
+        self.path_object['max_bytes_per_second'] = 41
+        repex.handle_path(self.path_object)
+        assert sum(self.sleeps) == pytest.approx(2 * 41 / 41.0)
+
+    def _record_throttled(self, monkeypatch):
+        throttled = []
+        monkeypatch.setattr(repex.Repex, 'throttle',
+                            lambda rpx, size, files=0: throttled.append(size))
+        return throttled
+
+    def test_report_reads_are_throttled(self, monkeypatch):
+        throttled = self._record_throttled(monkeypatch)
+        report = repex._Report()
+        report.add_path('throttle')
+        repex.handle_path(self.path_object, report=report)
+        # Each file is read for the report before and after handling it
+        assert sum(throttled) == 3 * (22 + 22 + 19 + 19)
+
+    def test_copies_to_output_directory_are_throttled(self, monkeypatch):
+        def fail(*args):
+            raise OSError(errno.EXDEV, 'Cross-device link')
+
+        monkeypatch.setattr(repex, 'fcntl', None)
+        monkeypatch.setattr(os, 'link', fail)
+        throttled = self._record_throttled(monkeypatch)
+        self.path_object['output_directory'] = \
+            os.path.join(self.tmpdir, 'output')
+        repex.handle_path(self.path_object)
+        # Each file is copied, then read and written
+        assert sum(throttled) == 3 * (22 + 22 + 22 + 19)
+
+    @pytest.mark.skipif(not hasattr(os, 'nice'), reason='Requires nice')
+    def test_low_priority(self):
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import os, repex; repex._lower_priority(); print(os.nice(0))'])
+        assert output.strip() == b'19'
+
+
+class TestInclude():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.version_file = os.path.join(self.tmpdir, 'VERSION')
+        with open(self.version_file, 'w') as f:
+            f.write('"version": "3.1.0-m2"\n"other": "3.1.0-m2"\n')
+        os.makedirs(os.path.join(self.tmpdir, 'teams'))
+        self._write_config('teams/version.yaml', {
+            'variables': {'version': '3.1.0'},
+            'paths': [self._path('"version": "3.1.0-m2"', '{{ .version }}')]
+        })
+        self._write_config('teams/other.yaml', {
+            'paths': [dict(self._path('"other": "3.1.0-m2"', '3.2.0'),
+                           tags=['other'])]
+        })
+        self.config_file = self._write_config('config.yaml', {
+            'include': [
+                {'path': 'teams/version.yaml', 'tags': ['version']},
+                {'path': 'teams/oth*.yaml', 'tags': ['other']}
+            ]
+        })
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _path(self, match, replace_with):
+        return {
+            'path': self.version_file,
+            'match': match,
+            'replace': '3.1.0-m2',
+            'with': replace_with
+        }
+
+    def _write_config(self, name, config):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(json.dumps(config))
+        return path
+
+    def _read(self):
+        with open(self.version_file) as f:
+            return f.read()
+
+    def test_include(self):
+        repex.iterate(self.config_file, tags=['any'])
+        assert self._read() == '"version": "3.1.0"\n"other": "3.2.0"\n'
+
+    def test_includes_are_tagged(self):
+        config = repex._load_config(
+            self.config_file, None, None, ['any'], True)
+        assert [path['tags'] for path in config['paths']] == \
+            [['version'], ['other']]
+        assert config['variables'] == {'version': '3.1.0'}
+        assert 'include' not in config
+
+    def test_unmatched_includes_are_not_read(self, monkeypatch):
+        imported = []
+        import_yaml = repex._import_yaml
+
+        def recording_import_yaml(config_file_path):
+            imported.append(os.path.basename(config_file_path))
+            return import_yaml(config_file_path)
+
+        monkeypatch.setattr(repex, '_import_yaml', recording_import_yaml)
+        repex.iterate(self.config_file, tags=['other'])
+        assert imported == ['config.yaml', 'other.yaml']
+        assert self._read() == '"version": "3.1.0-m2"\n"other": "3.2.0"\n'
+
+    def test_include_cycles(self):
+        self._write_config('teams/version.yaml', {
+            'include': ['../config.yaml', 'version.yaml'],
+            'paths': [self._path('"version": "3.1.0-m2"', '3.1.0')]
+        })
+        config = repex._load_config(
+            self.config_file, None, None, ['any'], True)
+        assert len(config['paths']) == 2
+
+    def test_invalid_include(self):
+        self._write_config('teams/other.yaml', {'paths': [{'path': 'x'}]})
+        with pytest.raises(repex.RepexError) as ex:
+            repex.iterate(self.config_file, tags=['other'])
+        assert "'match' is a required property" in str(ex.value)
+
+    def test_config_passed_in_is_not_changed(self, monkeypatch):
+        monkeypatch.chdir(self.tmpdir)
+        with open(self.config_file) as f:
+            config = json.load(f)
+        original = copy.deepcopy(config)
+        for tags, count in ((['version'], 1), (['other'], 1), (['any'], 2)):
+            loaded = repex._load_config(None, config, None, tags, True)
+            assert len(loaded['paths']) == count
+        assert config == original
+
+    def test_includes_are_cached(self):
+        repex._cache = repex._Cache()
+        try:
+            repex._load_config(self.config_file, None, None, ['any'], True)
+            assert len(repex._cache.includes) == 2
+            with open(os.path.join(self.tmpdir, 'teams', 'version.yaml'),
+                      'w') as f:
+                f.write('paths: []')
+            config = repex._load_config(
+                self.config_file, None, None, ['any'], True)
+            assert len(config['paths']) == 1
+        finally:
+            repex._cache = None
+
+    def test_repexes_are_bounded(self, monkeypatch):
+        monkeypatch.setattr(repex, '_REPEX_CACHE_SIZE', 2)
+        pathobj = {'path': 'x', 'match': 'a', 'replace': 'a', 'with': 'b'}
+        repex._cache = repex._Cache()
+        try:
+            first = repex._get_repex(dict(pathobj, path='0'))
+            repex._get_repex(dict(pathobj, path='1'))
+            assert repex._get_repex(dict(pathobj, path='0')) is first
+            repex._get_repex(dict(pathobj, path='2'))
+            assert len(repex._cache.repexes) == 2
+            assert repex._get_repex(dict(pathobj, path='0')) is first
+            assert '"1"' not in ''.join(repex._cache.repexes)
+        finally:
+            repex._cache = None
+
+
+class TestProgress():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        for index, version in enumerate(('3.1.0-m2', '3.1.0-m2', '3.1.0')):
+            path = os.path.join(self.tmpdir, 'VERSION{0}'.format(index))
+            with open(path, 'w') as f:
+                f.write('"version": "{0}"\n'.format(version))
+        self.path_object = {
+            'description': 'versions',
+            'type': 'VERSION.*',
+            'path': '.',
+            'base_directory': self.tmpdir,
+            'replace': '3.1.0-m2',
+            'with': '3.1.0'
+        }
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _events(self, stream):
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    def test_progress_events(self):
+        stream = io.StringIO()
+        with repex._reporting_progress('json', stream):
+            repex.handle_path(self.path_object)
+        assert repex._progress is None
+        event = self._events(stream)[-1]
+        assert event['event'] == 'path_done'
+        assert event['path'] == 'versions'
+        assert (event['discovered'], event['processed'], event['changed']) \
+            == (3, 3, 2)
+        # The size of the files before they were handled
+        assert event['bytes'] == 22 + 22 + 19
+
+    def test_progress_while_stuck(self):
+        stream = io.StringIO()
+        progress = repex._Progress(stream, structured=True, interval=0.01)
+        progress.start()
+        progress.path_started('versions')
+        progress.discovered(2)
+        progress.file_started('VERSION', 10)
+        progress.file_done()
+        progress.validating('VERSION')
+        time.sleep(0.1)
+        progress.stop()
+        event = self._events(stream)[-1]
+        assert event['stage'] == 'validating'
+        assert event['current'] == 'VERSION'
+        assert event['eta'] is None
+        assert event['current_elapsed'] is not None
+
+    def test_format_progress(self):
+        line = repex._format_progress({
+            'path': 'versions',
+            'stage': 'handling',
+            'discovered': 10,
+            'processed': 4,
+            'changed': 1,
+            'bytes': 3 * 1024 ** 2,
+            'bytes_per_second': 1536,
+            'eta': 12.5,
+            'current': 'VERSION',
+            'current_elapsed': 2.0
+        })
+        assert line == 'versions: handling 4/10 files, 1 changed, ' \
+            '3.0MB (1.5KB/s), ETA 12s - VERSION (2s)'
+
+    def test_progress_option(self):
+        runner = clicktest.CliRunner(mix_stderr=False)
+        result = runner.invoke(repex.main, [
+            '.', '-b', self.tmpdir, '-t', 'VERSION.*', '-r', '3.1.0-m2',
+            '-w', '3.1.0', '--progress', 'json'])
+        assert result.exit_code == 0
+        event = json.loads(result.stderr.splitlines()[-1])
+        assert event['changed'] == 2
+
+
+class TestOutcomes():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        for name, version in (('VERSION0', '3.1.0-m2'), ('VERSION1', '3.1.0')):
+            with open(os.path.join(self.tmpdir, name), 'w') as f:
+                f.write('"version": "{0}"\n'.format(version))
+        self.path_object = {
+            'type': 'VERSION.*',
+            'path': '.',
+            'base_directory': self.tmpdir,
+            'match': '3.1.0-m2',
+            'replace': '3.1.0-m2',
+            'with': '3.1.0'
+        }
+
+    def teardown_method(self, test_method):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_outcomes(self):
+        outcomes = repex.handle_path(self.path_object)
+        changed, unchanged = sorted(outcomes, key=lambda o: o.path)
+        assert changed.changed
+        assert (changed.size_before, changed.size_after) == (22, 19)
+        assert changed.sha256 == \
+            hashlib.sha256(b'"version": "3.1.0"\n').hexdigest()
+        assert not unchanged.changed
+        assert (unchanged.size_before, unchanged.size_after) == (19, 19)
+        assert unchanged.sha256 == changed.sha256
+
+    def test_match_without_replacement_is_unchanged(self, monkeypatch):
+        monkeypatch.setattr(repex, '_CHUNK_SIZE', 4)
+        path = os.path.join(self.tmpdir, 'VERSION0')
+        self.path_object.update({
+            'match': r'"version": "\S+"', 'replace': r'3\.1\.0-m5',
+            'with': '3.1.0'})
+        for params in ({}, {'mmap_threshold': 0}, {'line_mode': True}):
+            inode = os.stat(path).st_ino
+            outcomes = repex.handle_path(dict(self.path_object, **params))
+            assert not any(outcome.changed for outcome in outcomes)
+            assert os.stat(path).st_ino == inode
+
+    def test_files_are_hashed_lazily(self, monkeypatch):
+        digested = []
+        file_digest = repex._file_digest
+        monkeypatch.setattr(repex, '_file_digest', lambda path: (
+            digested.append(path), file_digest(path))[1])
+        monkeypatch.setattr(repex, '_TRANSACTIONS_HOME',
+                            os.path.join(self.tmpdir, '.rpx'))
+        with repex._transacting():
+            outcomes = repex.handle_path(self.path_object)
+            assert not digested
+            changed = [o for o in outcomes if o.changed][0]
+            assert changed.sha256 == \
+                hashlib.sha256(b'"version": "3.1.0"\n').hexdigest()
+        assert len(digested) == 1
+
+    def test_handle_file_outcome(self):
+        self.path_object['in_place'] = True
+        rpx = repex.Repex(self.path_object)
+        path = os.path.join(self.tmpdir, 'VERSION0')
+        outcome = rpx.handle_file(path)
+        assert outcome.changed
+        assert outcome.output_path == os.path.realpath(path)
+        assert not rpx.handle_file(path).changed
+
+    def test_iterate_outcomes(self):
+        config = {'paths': [self.path_object, dict(self.path_object)]}
+        outcomes = repex.iterate(config=config)
+        assert len(outcomes) == 4
+        assert [o.changed for o in outcomes].count(True) == 1
+
+    def test_changed_files_out(self):
+        manifest = os.path.join(self.tmpdir, 'changed.txt')
+        result = clicktest.CliRunner().invoke(repex.main, [
+            '.', '-b', self.tmpdir, '-t', 'VERSION.*', '-r', '3.1.0-m2',
+            '-w', '3.1.0', '--changed-files-out', manifest])
+        assert result.exit_code == 0
+        with open(manifest) as f:
+            assert f.read() == os.path.join(
+                os.path.realpath(self.tmpdir), 'VERSION0') + '\n'
+
+
+class TestTransaction():
+
+    def setup_method(self, test_method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.original_transactions_home = repex._TRANSACTIONS_HOME
+        repex._TRANSACTIONS_HOME = os.path.join(self.tmpdir, '.rpx')
+        for name in ('VERSION0', 'VERSION1'):
+            with open(os.path.join(self.tmpdir, name), 'w') as f:
+                f.write('"version": "3.1.0-m2"\n')
+        self.path_object = {
+            'type': 'VERSION.*',
+            'path': '.',
+            'base_directory': self.tmpdir,
+            'match': '3.1.0-m2',
+            'replace': '3.1.0-m2',
+            'with': '3.1.0-m3'
+        }
+        self.second_path_object = dict(
+            self.path_object, match='m3', replace='m3', **{'with': 'rc1'})
+
+    def teardown_method(self, test_method):
+        repex._TRANSACTIONS_HOME = self.original_transactions_home
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _read(self, name):
+        with open(os.path.join(self.tmpdir, name)) as f:
+            return f.read()
+
+    def _files(self):
+        return sorted(os.listdir(self.tmpdir))
+
+    def test_later_paths_handle_staged_files(self):
+        config = {'paths': [self.path_object, self.second_path_object]}
+        outcomes = repex.iterate(config=config, transactional=True)
+        assert self._read('VERSION0') == '"version": "3.1.0-rc1"\n'
+        assert self._read('VERSION1') == '"version": "3.1.0-rc1"\n'
+        assert all(o.changed for o in outcomes)
+        assert outcomes[0].output_path == \
+            os.path.join(os.path.realpath(self.tmpdir), 'VERSION0')
+        assert self._files() == ['.rpx', 'VERSION0', 'VERSION1']
+        assert os.listdir(repex._TRANSACTIONS_HOME) == []
+        assert repex._transaction is None
+
+    def test_failed_validation_changes_nothing(self):
+        self.second_path_object['validator'] = {
+            'type': 'per_type',
+            'path': os.path.join(TEST_RESOURCES_DIR, 'validator.py'),
+            'function': 'fail_validate'
+        }
+        config = {'paths': [self.path_object, self.second_path_object]}
+        with pytest.raises(repex.RepexError) as ex:
+            repex.iterate(config=config, transactional=True)
+        assert repex.ERRORS['validation_failed'] in str(ex.value)
+        assert self._read('VERSION0') == '"version": "3.1.0-m2"\n'
+        assert self._files() == ['VERSION0', 'VERSION1']
+
+    def test_file_changed_before_commit(self):
+        path = os.path.join(self.tmpdir, 'VERSION0')
+        with pytest.raises(repex.RepexError) as ex:
+            with repex._transacting():
+                repex.handle_path(self.path_object)
+                with open(path, 'a') as f:
+                    f.write('\n')
+        assert repex.ERRORS['file_changed'] in str(ex.value)
+        assert self._read('VERSION0') == '"version": "3.1.0-m2"\n\n'
+        assert self._read('VERSION1') == '"version": "3.1.0-m2"\n'
+        assert self._files() == ['VERSION0', 'VERSION1']
+
+    def test_keeps_hard_links(self):
+        path = os.path.join(self.tmpdir, 'VERSION0')
+        link = os.path.join(self.tmpdir, 'LINK')
+        os.link(path, link)
+        repex.handle_path(dict(self.path_object, type='VERSION0'),
+                          transactional=True)
+        assert os.path.samefile(path, link)
+        assert self._read('LINK') == '"version": "3.1.0-m3"\n'
+
+    def test_recover_interrupted_commit(self):
+        paths = [os.path.join(self.tmpdir, n)
+                 for n in ('VERSION0', 'VERSION1')]
+        entries = []
+        for path in paths:
+            staged = repex._temp_path(path)
+            with open(staged, 'w') as f:
+                f.write('"version": "3.1.0"\n')
+            entries.append((staged, path, False, repex._stat_key(path)))
+        # The second file was changed after the interrupted commit
+        with open(paths[1], 'a') as f:
+            f.write('\n')
+        os.makedirs(repex._TRANSACTIONS_HOME)
+        journal_path = os.path.join(
+            repex._TRANSACTIONS_HOME,
+            'transaction-1' + repex._JOURNAL_FILE_SUFFIX)
+        with open(journal_path, 'w') as f:
+            json.dump(entries, f)
+        repex._recover_transactions()
+        assert self._read('VERSION0') == '"version": "3.1.0"\n'
+        assert self._read('VERSION1') == '"version": "3.1.0-m2"\n\n'
+        assert self._files() == ['.rpx', 'VERSION0', 'VERSION1']
+        assert os.listdir(repex._TRANSACTIONS_HOME) == []
+
+    def test_journal_does_not_depend_on_cwd(self, monkeypatch):
+        monkeypatch.chdir(self.tmpdir)
+        staged = repex._temp_path('VERSION0')
+        with open(staged, 'w') as f:
+            f.write('"version": "3.1.0"\n')
+        entries = [(staged, 'VERSION0', False, repex._stat_key('VERSION0'))]
+        with repex._transaction_journal(entries) as journal_path:
+            with open(journal_path) as f:
+                assert json.load(f)[0][:2] == [
+                    os.path.join(self.tmpdir, staged),
+                    os.path.join(self.tmpdir, 'VERSION0')]
+            # Simulate a commit interrupted before moving any file
+            shutil.copy(journal_path, journal_path + '.copy')
+        os.rename(journal_path + '.copy', journal_path)
+        monkeypatch.chdir(tempfile.gettempdir())
+        repex._recover_transactions()
+        assert self._read('VERSION0') == '"version": "3.1.0"\n'
+        assert self._files() == ['.rpx', 'VERSION0', 'VERSION1']
+
+    def test_transactional_option(self):
+        result = clicktest.CliRunner().invoke(repex.main, [
+            '.', '-b', self.tmpdir, '-t', 'VERSION.*', '-r', '3.1.0-m2',
+            '-w', '3.1.0', '--transactional'])
+        assert result.exit_code == 0
+        assert self._read('VERSION1') == '"version": "3.1.0"\n'